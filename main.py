@@ -1,75 +1,872 @@
 import os
 import json
 from datetime import datetime, timezone, timedelta, date
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, Callable, List
 import re
 import hashlib
 import base64
+import zlib
+import gzip
+import shutil
+import random
+import math
+import tempfile
+import hmac
+import csv
+import io
+import threading
+import sqlite3
+import time
+import asyncio
+import importlib
+import contextvars
+import contextlib
+import socket
+import heapq
+import itertools
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeout
+from zoneinfo import ZoneInfo
 
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
 from dotenv import load_dotenv
 
-import stripe
-from twilio.request_validator import RequestValidator
-from twilio.rest import Client as TwilioClient
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
 
-import snowflake.connector as sf
-from cryptography.hazmat.primitives import serialization
+_PROCESS_STARTED = time.perf_counter()
+
+class _LazyModule:
+    """
+    Stands in for a heavy SDK module and imports it on first attribute access,
+    so importing main.py stays fast. on_load runs once with the real module.
+    """
+
+    def __init__(self, name: str, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    if self._on_load:
+                        self._on_load(module)
+                    self._module = module
+                    metric_observe(f"startup.import.{self._name}", time.perf_counter() - started)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
 
 # ---------- Env & third-party setup ----------
 load_dotenv()
 
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "")
+# ---------- Outbound HTTP (shared keep-alive pools for Stripe / Twilio) ----------
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))   # host pools per session
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))          # kept-alive sockets per host
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF_SEC = float(os.getenv("HTTP_RETRY_BACKOFF_SEC", "0.3"))
+STRIPE_TIMEOUT_SEC = float(os.getenv("STRIPE_TIMEOUT_SEC", "20"))
+TWILIO_TIMEOUT_SEC = float(os.getenv("TWILIO_TIMEOUT_SEC", "10"))
+
+_http_sessions: Dict[str, Any] = {}
+_http_sessions_lock = threading.Lock()
+
+def _http_session(name: str, retry_reads: bool = True):
+    """
+    One requests.Session per SDK with a tuned connection pool. urllib3 retries
+    connect errors for any method (nothing was sent) but only retries read/status
+    failures for idempotent methods. Pass retry_reads=False when the SDK already
+    retries (Stripe does, with its own idempotency keys).
+    """
+    with _http_sessions_lock:
+        sess = _http_sessions.get(name)
+        if sess is None:
+            sess = _http_sessions[name] = _build_http_session(retry_reads)
+        return sess
+
+def _build_http_session(retry_reads: bool):
+    requests = importlib.import_module("requests")
+    adapters = importlib.import_module("requests.adapters")
+    Retry = importlib.import_module("urllib3.util.retry").Retry
+    retry_kwargs = dict(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=HTTP_MAX_RETRIES if retry_reads else 0,
+        status=HTTP_MAX_RETRIES if retry_reads else 0,
+        backoff_factor=HTTP_RETRY_BACKOFF_SEC,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "DELETE", "PUT"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    try:
+        retry = Retry(backoff_jitter=HTTP_RETRY_BACKOFF_SEC, **retry_kwargs)
+    except TypeError:  # urllib3 < 2 has no jitter option
+        retry = Retry(**retry_kwargs)
+    sess = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                   pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    return sess
+
+def http_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Per host: sockets opened vs requests sent; reuse_ratio near 1.0 means keep-alive works."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for name, sess in list(_http_sessions.items()):
+        for adapter in set(sess.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent = getattr(pool, "num_requests", 0)
+                opened = getattr(pool, "num_connections", 0)
+                out[f"{name}:{pool.host}"] = {
+                    "requests": requests_sent,
+                    "connections_opened": opened,
+                    "reuse_ratio": (1 - opened / requests_sent) if requests_sent else None,
+                }
+    return out
+
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", "2"))
+
+def _configure_stripe(m):
+    m.api_key = os.getenv("STRIPE_SECRET_KEY", "")
+    # Stripe retries with exponential backoff + jitter and its own idempotency keys
+    m.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+    requests_client = getattr(m, "RequestsClient", None) or m.http_client.RequestsClient
+    m.default_http_client = requests_client(timeout=STRIPE_TIMEOUT_SEC, session=_http_session("stripe", retry_reads=False))
+
+stripe = _LazyModule("stripe", on_load=_configure_stripe)
+sf = _LazyModule("snowflake.connector")
+serialization = _LazyModule("cryptography.hazmat.primitives.serialization")
+_twilio_rest = _LazyModule("twilio.rest")
+_twilio_request_validator = _LazyModule("twilio.request_validator")
 
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
 TWILIO_MESSAGING_SERVICE_SID = os.getenv("TWILIO_MESSAGING_SERVICE_SID", "")
 TWILIO_FROM_NUMBER = os.getenv("TWILIO_FROM_NUMBER", "")
 
-twilio_validator = RequestValidator(TWILIO_AUTH_TOKEN) if TWILIO_AUTH_TOKEN else None
-twilio_client = (TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-                 if (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN) else None)
+_twilio_client = None
+_twilio_validator = None
+
+def get_twilio_client():
+    """Twilio REST client, built on first use; None when credentials are missing."""
+    global _twilio_client
+    if _twilio_client is None and TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
+        http_client = importlib.import_module("twilio.http.http_client").TwilioHttpClient(
+            pool_connections=True, timeout=TWILIO_TIMEOUT_SEC,
+        )
+        http_client.session = _http_session("twilio")
+        _twilio_client = _twilio_rest.Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
+    return _twilio_client
+
+def get_twilio_validator():
+    global _twilio_validator
+    if _twilio_validator is None and TWILIO_AUTH_TOKEN:
+        _twilio_validator = _twilio_request_validator.RequestValidator(TWILIO_AUTH_TOKEN)
+    return _twilio_validator
 
-SNOW_USER = os.environ["SNOW_USER"]
-SNOW_ACCOUNT = os.environ["SNOW_ACCOUNT"]  # e.g., su53882.canada-central.azure
+# SNOW_USER / SNOW_ACCOUNT / SNOW_PRIVATE_KEY_PATH are checked when connecting, not at import
+SNOW_USER = os.getenv("SNOW_USER", "")
+SNOW_ACCOUNT = os.getenv("SNOW_ACCOUNT", "")  # e.g., su53882.canada-central.azure
 SNOW_WAREHOUSE = os.environ.get("SNOW_WAREHOUSE", "APP_WH")
 SNOW_ROLE = os.environ.get("SNOW_ROLE", "APP_WRITER")
 SNOW_DATABASE = os.environ.get("SNOW_DATABASE", "PHOENIX_APP_DEV")
 SNOW_SCHEMA = os.environ.get("SNOW_SCHEMA", "CORE")
-KEY_PATH = os.environ["SNOW_PRIVATE_KEY_PATH"]
+KEY_PATH = os.getenv("SNOW_PRIVATE_KEY_PATH", "")
 PASSPHRASE = os.environ.get("SNOW_PRIVATE_KEY_PASSPHRASE")  # may be None
 
+SNOW_POOL_MIN = int(os.getenv("SNOW_POOL_MIN", "2"))
+SNOW_POOL_MAX_IDLE = int(os.getenv("SNOW_POOL_MAX_IDLE", "8"))
+SNOW_POOL_IDLE_TIMEOUT_SEC = float(os.getenv("SNOW_POOL_IDLE_TIMEOUT_SEC", "1800"))
+
 # New internal stage just for signatures (no @ here)
 SIGNATURE_STAGE_NAME = "PHOENIX_APP_DEV.CORE.ASSETS_INT"
 SIGNATURE_STAGE_URI_PREFIX = f"@{SIGNATURE_STAGE_NAME}"  # -> "@PHOENIX_APP_DEV.CORE.ASSETS_INT"
 
+_private_key_der: Optional[bytes] = None
 
-
-def get_snowflake_ctx():
-    # Load private key (DER PKCS8)
-    with open(KEY_PATH, "rb") as f:
-        pk = serialization.load_pem_private_key(
-            f.read(),
-            password=PASSPHRASE.encode("utf-8") if PASSPHRASE else None,
+def _snowflake_private_key() -> bytes:
+    # Load private key (DER PKCS8) once per process
+    global _private_key_der
+    if _private_key_der is None:
+        missing = [n for n, v in (("SNOW_USER", SNOW_USER), ("SNOW_ACCOUNT", SNOW_ACCOUNT),
+                                  ("SNOW_PRIVATE_KEY_PATH", KEY_PATH)) if not v]
+        if missing:
+            raise RuntimeError(f"Snowflake not configured, missing: {', '.join(missing)}")
+        with open(KEY_PATH, "rb") as f:
+            pk = serialization.load_pem_private_key(
+                f.read(),
+                password=PASSPHRASE.encode("utf-8") if PASSPHRASE else None,
+            )
+        _private_key_der = pk.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
         )
-    private_key_der = pk.private_bytes(
-        encoding=serialization.Encoding.DER,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption(),
-    )
-    return sf.connect(
+    return _private_key_der
+
+def _snowflake_connect(warehouse: str = SNOW_WAREHOUSE, role: str = SNOW_ROLE, workload: str = "interactive"):
+    started = time.perf_counter()
+    conn = sf.connect(
         user=SNOW_USER,
         account=SNOW_ACCOUNT,
-        private_key=private_key_der,
-        warehouse=SNOW_WAREHOUSE,
-        role=SNOW_ROLE,
+        private_key=_snowflake_private_key(),
+        warehouse=warehouse,
+        role=role,
         database=SNOW_DATABASE,
         schema=SNOW_SCHEMA,
+        session_parameters={"QUERY_TAG": f"globalfaces:{workload}"},
+    )
+    metric_observe("snowflake.connect", time.perf_counter() - started)
+    return conn
+
+class _PooledConnection:
+    """Connection handle whose close() hands the session back to its pool."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return self._conn.cursor(*args, **kwargs)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class SnowflakePool:
+    """
+    Keeps up to max_idle authenticated sessions around for reuse; sessions idle
+    longer than idle_timeout_sec are dropped rather than risk an expired token.
+    max_open > 0 caps sessions checked out at once; callers past the cap queue,
+    and the wait is recorded as snowflake_pool.<name>.queue_wait.
+    """
+
+    def __init__(self, name: str, connect, max_idle: int, idle_timeout_sec: float, max_open: int = 0):
+        self.name = name
+        self._connect = connect
+        self.max_idle = max_idle
+        self.idle_timeout_sec = idle_timeout_sec
+        self.max_open = max_open
+        self._slots = threading.BoundedSemaphore(max_open) if max_open > 0 else None
+        self._idle = deque()  # (conn, released_at)
+        self._lock = threading.Lock()
+        self._in_use = 0
+
+    def acquire(self) -> _PooledConnection:
+        started = time.monotonic()
+        if self._slots is not None:
+            self._slots.acquire()
+        metric_observe(f"snowflake_pool.{self.name}.queue_wait", time.monotonic() - started)
+        with self._lock:
+            self._in_use += 1
+        try:
+            return _PooledConnection(self, self._checkout())
+        except Exception:
+            self._free_slot()
+            raise
+
+    def _checkout(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released_at = self._idle.pop()
+            if now - released_at <= self.idle_timeout_sec and not conn.is_closed():
+                metric_inc(f"snowflake_pool.{self.name}.reuse")
+                return conn
+            self._discard(conn)
+        metric_inc(f"snowflake_pool.{self.name}.new")
+        return self._connect()
+
+    def _free_slot(self):
+        with self._lock:
+            self._in_use -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def release(self, conn):
+        self._free_slot()
+        try:
+            closed = conn.is_closed()
+        except Exception:
+            closed = True
+        with self._lock:
+            if not closed and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._discard(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"in_use": self._in_use, "idle": len(self._idle), "max_open": self.max_open}
+
+    def prefill(self, n: int):
+        conns = [self.acquire() for _ in range(n)]
+        for c in conns:
+            c.close()
+
+    @staticmethod
+    def _discard(conn):
+        try: conn.close()
+        except Exception: pass
+
+# ---------- Workload classes (warehouse / role / pool per class) ----------
+# interactive: tablet lookups and inserts; background: webhooks, SMS receipts,
+# journal forwarding; batch: exports, stats, snapshot/reconcile/backfill jobs.
+# Each class reads SNOW_WAREHOUSE_<CLASS> / SNOW_ROLE_<CLASS> / SNOW_POOL_MAX_IDLE_<CLASS> /
+# SNOW_POOL_MAX_OPEN_<CLASS>, falling back to the shared settings.
+WORKLOAD_CLASSES = ("interactive", "background", "batch")
+_WORKLOAD_DEFAULT_MAX_OPEN = {"interactive": 0, "background": 8, "batch": 4}
+
+_workload: contextvars.ContextVar = contextvars.ContextVar("workload", default="interactive")
+
+def _workload_setting(cls: str, key: str, default: str) -> str:
+    return os.getenv(f"SNOW_{key}_{cls.upper()}", default)
+
+def _make_workload_pool(cls: str) -> SnowflakePool:
+    warehouse = _workload_setting(cls, "WAREHOUSE", SNOW_WAREHOUSE)
+    role = _workload_setting(cls, "ROLE", SNOW_ROLE)
+    return SnowflakePool(
+        cls,
+        lambda: _snowflake_connect(warehouse, role, cls),
+        int(_workload_setting(cls, "POOL_MAX_IDLE", str(SNOW_POOL_MAX_IDLE))),
+        SNOW_POOL_IDLE_TIMEOUT_SEC,
+        max_open=int(_workload_setting(cls, "POOL_MAX_OPEN", str(_WORKLOAD_DEFAULT_MAX_OPEN[cls]))),
     )
 
+snowflake_pools: Dict[str, SnowflakePool] = {cls: _make_workload_pool(cls) for cls in WORKLOAD_CLASSES}
+snowflake_pool = snowflake_pools["interactive"]
+
+def current_workload() -> str:
+    return _workload.get()
+
+@contextlib.contextmanager
+def workload(cls: str):
+    """Tags Snowflake work in this block (and threadpool calls made from it) with a workload class."""
+    token = _workload.set(cls)
+    try:
+        yield
+    finally:
+        _workload.reset(token)
+
+def run_as_workload(cls: str, fn: Callable) -> Callable:
+    """Thread target wrapper: new threads start in the default (interactive) class."""
+    def run(*args, **kwargs):
+        with workload(cls):
+            return fn(*args, **kwargs)
+    return run
+
+def in_current_workload(fn: Callable) -> Callable:
+    """Pool task wrapper: ThreadPoolExecutor workers don't inherit the submitter's contextvars."""
+    return run_as_workload(current_workload(), fn)
+
+def workload_pool_stats() -> Dict[str, Any]:
+    return {cls: pool.stats() for cls, pool in snowflake_pools.items()}
+
+# ---------- Storage backends (Snowflake, or embedded SQLite for dev/edge) ----------
+# Routes keep writing Snowflake SQL against a DB-API cursor. The local backend
+# translates the dialect the app uses (pyformat params, CURRENT_TIMESTAMP(),
+# DATEADD(unit, ...), col:path JSON access, ::casts, MERGE, CREATE OR REPLACE
+# TEMPORARY, ADD COLUMN IF NOT EXISTS) and keeps stage files in a local directory,
+# which PUT, GET and CSV COPY INTO read and write.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "snowflake").lower()
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "local.sqlite")
+LOCAL_BLOB_DIR = os.getenv("LOCAL_BLOB_DIR", "local_blobs")
+LOCAL_BLOB_BASE_URL = os.getenv("LOCAL_BLOB_BASE_URL", "http://127.0.0.1:8000")
+LOCAL_BLOB_SECRET = (os.getenv("LOCAL_BLOB_SECRET") or base64.urlsafe_b64encode(os.urandom(24)).decode()).encode()
+
+_STAGE_URI_RE = re.compile(r"^@(?P<stage>%?[A-Za-z0-9_\.]+)/(?P<path>.*)$")
+
+def _split_stage_uri(stage_uri: str) -> Optional[Tuple[str, str]]:
+    m = _STAGE_URI_RE.match((stage_uri or "").strip())
+    return (m.group("stage"), m.group("path")) if m else None
+
+class SnowflakeStorage:
+    name = "snowflake"
+
+    def connect(self):
+        cls = _workload.get()
+        metric_inc(f"workload.{cls}.connections")
+        return snowflake_pools.get(cls, snowflake_pool).acquire()
+
+    def put_blob(self, cur, stage_uri: str, data: bytes):
+        """Uploads data to exactly stage_uri (PUT keeps the local file name, so stage it under that name)."""
+        stage, path = _split_stage_uri(stage_uri)
+        folder, _, filename = path.rpartition("/")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            local_path = os.path.join(tmpdir, filename)
+            with open(local_path, "wb") as f:
+                f.write(data)
+            cur.execute(f"PUT file://{local_path} @{stage}/{folder}/ AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+
+    def presign(self, cur, stage: str, path: str, expires_sec: int) -> Optional[str]:
+        row = cur.execute(f"SELECT GET_PRESIGNED_URL(@{stage}, %s, %s)", (path, expires_sec)).fetchone()
+        return row[0] if row and row[0] else None
+
+# Tables main.py reads/writes; tables the app creates itself (_ensure_table) are left to that.
+LOCAL_SCHEMA_DDL = [
+    """CREATE TABLE IF NOT EXISTS EVENT_LOG (EVENT_ID STRING PRIMARY KEY, SESSION_ID STRING, DONOR_ID STRING,
+        FUNDRAISER_ID STRING, EVENT_TYPE STRING, ATTRIBUTES VARIANT,
+        CREATED_AT TIMESTAMP_NTZ DEFAULT (STRFTIME('%Y-%m-%d %H:%M:%f', 'now')))""",
+    "CREATE INDEX IF NOT EXISTS EVENT_LOG_SESSION ON EVENT_LOG (SESSION_ID)",
+    """CREATE TABLE IF NOT EXISTS SESSION (SESSION_ID STRING PRIMARY KEY, FUNDRAISER_ID STRING, CHARITY_ID STRING,
+        CAMPAIGN_ID STRING, DEVICE_ID STRING, STATE STRING, CREATED_AT TIMESTAMP_NTZ)""",
+    """CREATE TABLE IF NOT EXISTS DONOR (DONOR_ID STRING PRIMARY KEY, TITLE STRING, FIRST_NAME STRING,
+        MIDDLE_NAME STRING, LAST_NAME STRING, DOB_DATE DATE, MOBILE_E164 STRING, EMAIL STRING, ADDRESS1 STRING,
+        ADDRESS2 STRING, CITY STRING, REGION STRING, POSTAL_CODE STRING, COUNTRY STRING, CONSENT_SMS BOOLEAN,
+        CONSENT_EMAIL BOOLEAN, CONSENT_MAIL BOOLEAN, CREATED_AT TIMESTAMP_NTZ, UPDATED_AT TIMESTAMP_NTZ)""",
+    "CREATE INDEX IF NOT EXISTS DONOR_EMAIL ON DONOR (EMAIL)",
+    """CREATE TABLE IF NOT EXISTS DONOR_SESSION (SESSION_ID STRING, DONOR_ID STRING, FUNDRAISER_ID STRING,
+        CHARITY_ID STRING, CAMPAIGN_ID STRING, CREATED_AT TIMESTAMP_NTZ)""",
+    """CREATE TABLE IF NOT EXISTS VERIFICATION_SMS (VERIF_ID STRING PRIMARY KEY, SESSION_ID STRING,
+        DONOR_ID STRING, SENT_TS TIMESTAMP_NTZ, MESSAGE_BODY STRING, INBOUND_TS TIMESTAMP_NTZ, INBOUND_BODY STRING,
+        RESULT STRING, TWILIO_MSG_SID STRING, MOBILE_E164 STRING, TO_NUMBER STRING)""",
+    "CREATE INDEX IF NOT EXISTS VERIFICATION_SMS_MOBILE ON VERIFICATION_SMS (MOBILE_E164, SENT_TS)",
+    "CREATE INDEX IF NOT EXISTS VERIFICATION_SMS_SID ON VERIFICATION_SMS (TWILIO_MSG_SID)",
+    """CREATE TABLE IF NOT EXISTS PAYMENT (PAYMENT_ID STRING PRIMARY KEY, SESSION_ID STRING, DONOR_ID STRING,
+        TYPE STRING, AMOUNT NUMBER, CURRENCY STRING, STRIPE_CUSTOMER_ID STRING, STRIPE_SUBSCRIPTION_ID STRING,
+        STATUS STRING, CREATED_AT TIMESTAMP_NTZ DEFAULT (STRFTIME('%Y-%m-%d %H:%M:%f', 'now')))""",
+    """CREATE TABLE IF NOT EXISTS PAYMENT_METHOD (PM_ID STRING PRIMARY KEY, DONOR_ID STRING,
+        STRIPE_CUSTOMER_ID STRING, STRIPE_PAYMENT_METHOD_ID STRING, USAGE STRING)""",
+    """CREATE TABLE IF NOT EXISTS SIGNATURE (SIGNATURE_ID STRING PRIMARY KEY, DONOR_ID STRING, SESSION_ID STRING,
+        SIGNATURE_IMAGE STRING, HASH_SHA256 STRING, CAPTURED_AT TIMESTAMP_NTZ)""",
+    """CREATE TABLE IF NOT EXISTS PRODUCT (PRODUCT_ID STRING PRIMARY KEY, CAMPAIGN_ID STRING, PRODUCT_TYPE STRING,
+        AMOUNT_CENTS NUMBER, CURRENCY STRING, DISPLAY_NAME STRING, STRIPE_PRICE_ID STRING, ACTIVE BOOLEAN)""",
+    """CREATE TABLE IF NOT EXISTS CHARITY (CHARITY_ID STRING PRIMARY KEY, NAME STRING, BRAND_PRIMARY_HEX STRING,
+        LOGO_URL STRING, BLURB STRING, TERMS_URL STRING, COUNTRY STRING)""",
+    """CREATE TABLE IF NOT EXISTS CAMPAIGN (CAMPAIGN_ID STRING PRIMARY KEY, CHARITY_ID STRING, NAME STRING,
+        START_DATE DATE, END_DATE DATE, MONTHLY_DEFAULT NUMBER, PRESET_AMOUNTS STRING, MIN_AMOUNT NUMBER,
+        CURRENCY STRING)""",
+    """CREATE TABLE IF NOT EXISTS FUNDRAISER (FUNDRAISER_ID STRING PRIMARY KEY, DISPLAY_NAME STRING, EMAIL STRING,
+        ACTIVE BOOLEAN, CHARITY_ID STRING, CAMPAIGN_ID STRING)""",
+]
+
+_SQLITE_TS_FMT = "%Y-%m-%d %H:%M:%S.%f"
+_SQLITE_NOW = "STRFTIME('%Y-%m-%d %H:%M:%f', 'now')"
+_UNIT_SECONDS = {"second": 1, "seconds": 1, "minute": 60, "minutes": 60, "hour": 3600, "hours": 3600,
+                 "day": 86400, "days": 86400}
+
+def _sqlite_ts(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+def _sqlite_ts_str(dt: Optional[datetime]) -> Optional[str]:
+    return dt.strftime(_SQLITE_TS_FMT)[:-3] if dt is not None else None
+
+def _sqlite_to_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) or str(value).lstrip("-").replace(".", "", 1).isdigit():
+        return _sqlite_ts_str(datetime.fromtimestamp(float(value), timezone.utc).replace(tzinfo=None))
+    return _sqlite_ts_str(_sqlite_ts(value))
+
+def _sqlite_dateadd(unit, n, value):
+    dt = _sqlite_ts(value)
+    return _sqlite_ts_str(dt + timedelta(seconds=_UNIT_SECONDS[unit.lower()] * n)) if dt and n is not None else None
+
+def _sqlite_datediff(unit, a, b):
+    a, b = _sqlite_ts(a), _sqlite_ts(b)
+    return int((b - a).total_seconds() // _UNIT_SECONDS[unit.lower()]) if a and b else None
+
+def _sqlite_date_part(part, value):
+    dt = _sqlite_ts(value)
+    if dt is None:
+        return None
+    if part.upper() == "EPOCH_SECOND":
+        return int(dt.replace(tzinfo=timezone.utc).timestamp())
+    return getattr(dt, part.lower())
+
+def _sqlite_decode(expr, *args):
+    for i in range(0, len(args) - 1, 2):
+        if expr == args[i]:
+            return args[i + 1]
+    return args[-1] if len(args) % 2 else None
+
+class _SqliteAnyValue:
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        if self.value is None:
+            self.value = value
+
+    def finalize(self):
+        return self.value
+
+_sqlite_params_re = re.compile(r"%%|%s")
+_sqlite_json_path_re = re.compile(r"\b([A-Z][A-Z0-9_.]*):([a-z_]\w*(?:\.\w+)*)")
+_sqlite_date_unit_re = re.compile(r"\b(DATEADD|DATEDIFF|DATE_PART)\(\s*([A-Za-z_]+)\s*,")
+_sqlite_merge_re = re.compile(r"^\s*MERGE\s+INTO\s+(?P<target>[\w.]+)\s+(?:AS\s+)?(?P<talias>\w+)\s+USING\s+", re.I | re.S)
+_sqlite_when_re = re.compile(r"\bWHEN\s+(NOT\s+)?MATCHED\b", re.I)
+
+# SQLite gives an unknown declared type like STRING numeric affinity, which would turn
+# "+15550001111" or postal code "01234" into integers; Snowflake's text-ish types become TEXT
+_sqlite_text_types_re = re.compile(r"\b(STRING|VARIANT|OBJECT|ARRAY)\b", re.I)
+
+def _sqlite_ddl_types(sql: str) -> str:
+    return _sqlite_text_types_re.sub("TEXT", sql)
+
+def _sqlite_dialect(sql: str, has_params: bool) -> str:
+    if sql[:6].upper() in ("CREATE", "ALTER "):
+        sql = _sqlite_ddl_types(sql)
+    if has_params:
+        sql = _sqlite_params_re.sub(lambda m: "%" if m.group(0) == "%%" else "?", sql)
+    sql = re.sub(r"\bCURRENT_TIMESTAMP\(\)", _SQLITE_NOW, sql)
+    sql = _sqlite_date_unit_re.sub(lambda m: f"{m.group(1)}('{m.group(2)}',", sql)
+    sql = _sqlite_json_path_re.sub(lambda m: f"json_extract({m.group(1)}, '$.{m.group(2)}')", sql)
+    sql = re.sub(r"(\?|\b[\w.]+)::DATE\b", r"DATE(\1)", sql)
+    sql = re.sub(r"::\w+(\([\d,\s]*\))?", "", sql)
+    return sql
+
+def _sqlite_matching_paren(sql: str, start: int) -> int:
+    depth = 0
+    for i in range(start, len(sql)):
+        if sql[i] == "(":
+            depth += 1
+        elif sql[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("unbalanced parentheses in MERGE source")
+
+def _sqlite_merge(sql: str, params: tuple) -> List[Tuple[str, tuple]]:
+    """
+    MERGE -> UPDATE ... FROM / DELETE / INSERT ... WHERE NOT EXISTS, run in that order
+    so inserts only see rows that existed before the MERGE (as in Snowflake).
+    `sql` is already in SQLite dialect; params are split per clause by placeholder count.
+    """
+    m = _sqlite_merge_re.match(sql)
+    target, talias = m.group("target"), m.group("talias")
+    pos = m.end()
+    if sql[pos] == "(":
+        end = _sqlite_matching_paren(sql, pos)
+        source, pos = sql[pos:end + 1], end + 1
+    else:
+        sm = re.match(r"[\w.]+", sql[pos:])
+        source, pos = sm.group(0), pos + sm.end()
+    am = re.match(r"\s+(?:AS\s+)?(\w+)\s+ON\s+", sql[pos:], re.I)
+    salias, pos = am.group(1), pos + am.end()
+    whens = list(_sqlite_when_re.finditer(sql, pos))
+    on = sql[pos:whens[0].start()].strip()
+
+    cursor = [0]
+    def take(fragment: str) -> tuple:
+        n = fragment.count("?")
+        out = tuple(params[cursor[0]:cursor[0] + n])
+        cursor[0] += n
+        return out
+
+    source_p, on_p = take(source), take(on)
+    updates, inserts = [], []
+    for i, w in enumerate(whens):
+        body = sql[w.end():whens[i + 1].start() if i + 1 < len(whens) else len(sql)].strip()
+        bm = re.match(r"(?:AND\s+(?P<cond>.+?)\s+)?THEN\s+(?P<action>.+)$", body, re.I | re.S)
+        cond, action = bm.group("cond"), bm.group("action").strip()
+        cond_p = take(cond) if cond else ()
+        extra, extra_p = (f" AND ({cond})", cond_p) if cond else ("", ())
+        if w.group(1):  # NOT MATCHED -> INSERT (cols) VALUES (exprs)
+            im = re.match(r"INSERT\s*(\(.*?\))\s*VALUES\s*\((?P<vals>.*)\)\s*;?\s*$", action, re.I | re.S)
+            vals = im.group("vals")
+            vals_p = take(vals)
+            inserts.append((
+                f"INSERT INTO {target} {im.group(1)} SELECT {vals} FROM {source} AS {salias} "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {target} AS {talias} WHERE {on}){extra}",
+                vals_p + source_p + on_p + extra_p,
+            ))
+        elif re.match(r"DELETE\b", action, re.I):
+            updates.append((
+                f"DELETE FROM {target} AS {talias} WHERE EXISTS "
+                f"(SELECT 1 FROM {source} AS {salias} WHERE {on}{extra})",
+                source_p + on_p + extra_p,
+            ))
+        else:
+            assignments = re.sub(r"^UPDATE\s+SET\s+", "", action, flags=re.I)
+            set_p = take(assignments)
+            updates.append((
+                f"UPDATE {target} AS {talias} SET {assignments} FROM {source} AS {salias} WHERE {on}{extra}",
+                set_p + source_p + on_p + extra_p,
+            ))
+    return updates + inserts
+
+class _LocalCursor:
+    """DB-API cursor over SQLite that accepts the app's Snowflake SQL."""
+
+    def __init__(self, storage: "LocalStorage", conn: sqlite3.Connection):
+        self._storage = storage
+        self._conn = conn
+        self._cur = conn.cursor()
+        self._merge_rowcount = None
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        # A MERGE runs as several statements and PUT/GET/COPY as file operations; report totals like Snowflake does
+        return self._cur.rowcount if self._merge_rowcount is None else self._merge_rowcount
+
+    def execute(self, sql: str, params=None):
+        stripped = sql.strip()
+        head = stripped[:40].upper()
+        if head.startswith(("USE ", "ALTER WAREHOUSE", "ALTER SESSION")):
+            return self
+        if head.startswith("PUT "):
+            return self._put(stripped)
+        if head.startswith("GET "):
+            return self._get(stripped)
+        if head.startswith("COPY "):
+            return self._copy(stripped)
+        params = tuple(params) if params is not None else ()
+        stmt = _sqlite_dialect(stripped, bool(params))
+        self._merge_rowcount = None
+        if head.startswith("MERGE"):
+            total = 0
+            for q, p in _sqlite_merge(stmt, params):
+                self._cur.execute(q, p)
+                total += max(self._cur.rowcount, 0)
+            self._merge_rowcount = total
+            return self
+        m = re.match(r"CREATE\s+OR\s+REPLACE\s+(TEMPORARY\s+|TEMP\s+)?TABLE\s+([\w.]+)", stmt, re.I)
+        if m:
+            self._cur.execute(f"DROP TABLE IF EXISTS {'temp.' if m.group(1) else ''}{m.group(2)}")
+            stmt = re.sub(r"^CREATE\s+OR\s+REPLACE\s+(TEMPORARY\s+)?", lambda x: "CREATE TEMP " if x.group(1) else "CREATE ",
+                          stmt, flags=re.I)
+        m = re.match(r"ALTER\s+TABLE\s+([\w.]+)\s+ADD\s+COLUMN\s+IF\s+NOT\s+EXISTS\s+(.+)$", stmt, re.I | re.S)
+        if m:
+            table = m.group(1)
+            have = {r[1].upper() for r in self._conn.execute(f"PRAGMA table_info({table})")}
+            for coldef in (c.strip() for c in m.group(2).split(",")):
+                if coldef and coldef.split()[0].upper() not in have:
+                    self._cur.execute(f"ALTER TABLE {table} ADD COLUMN {coldef}")
+            return self
+        self._cur.execute(stmt, params)
+        return self
+
+    # Stages are directories under the blob dir; table stages (@%TABLE) keep their "%"
+    def _stage_files(self, stage_ref: str) -> List[Tuple[str, str]]:
+        """(stage-relative name, local path) for every file under a stage prefix."""
+        stage, _, prefix = stage_ref.lstrip("@").partition("/")
+        root = self._storage._blob_path(stage, "")
+        found = []
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                full = os.path.join(dirpath, name)
+                rel = os.path.relpath(full, root).replace(os.sep, "/")
+                if rel.startswith(prefix) and ".tmp" not in name:
+                    found.append((rel, full))
+        return sorted(found)
+
+    def _put(self, sql: str):
+        m = re.match(r"PUT\s+file://(\S+)\s+@([^/\s]+)(?:/(\S*))?(.*)$", sql, re.I | re.S)
+        if not m:
+            raise ValueError(f"unrecognised PUT: {sql[:80]}")
+        local_path, stage, folder, opts = m.groups()
+        compress = re.search(r"AUTO_COMPRESS\s*=\s*FALSE", opts, re.I) is None
+        name = os.path.basename(local_path) + (".gz" if compress else "")
+        with open(local_path, "rb") as f:
+            data = f.read()
+        self._storage.put_blob(self, f"@{stage}/{(folder or '').strip('/')}/{name}".replace("//", "/"),
+                               gzip.compress(data) if compress else data)
+        self._merge_rowcount = 1
+        return self
+
+    def _get(self, sql: str):
+        m = re.match(r"GET\s+(@\S+)\s+file://(\S+)", sql, re.I)
+        if not m:
+            raise ValueError(f"unrecognised GET: {sql[:80]}")
+        files = self._stage_files(m.group(1))
+        os.makedirs(m.group(2), exist_ok=True)
+        for rel, full in files:
+            shutil.copyfile(full, os.path.join(m.group(2), os.path.basename(rel)))
+        self._merge_rowcount = len(files)
+        return self
+
+    def _copy(self, sql: str):
+        """COPY INTO <table> FROM @stage[/prefix] for CSV files; one row per record like Snowflake's COPY."""
+        m = re.match(r"COPY\s+INTO\s+([\w.]+)\s+FROM\s+(@\S+)(.*)$", sql, re.I | re.S)
+        if not m:
+            raise ValueError(f"unrecognised COPY: {sql[:80]}")
+        table, stage_ref, opts = m.groups()
+        fmt = re.search(r"\bTYPE\s*=\s*'?(\w+)", opts, re.I)
+        if fmt and fmt.group(1).upper() != "CSV":
+            raise ValueError("the local backend only loads CSV files with COPY")
+        empty_as_null = re.search(r"EMPTY_FIELD_AS_NULL\s*=\s*FALSE", opts, re.I) is None
+        cols = [r[1] for r in self._conn.execute(f"PRAGMA table_info({table})")]
+        insert = f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+        files = self._stage_files(stage_ref)
+        total = 0
+        for _, full in files:
+            with open(full, "rb") as f:
+                data = f.read()
+            if full.endswith(".gz"):
+                data = gzip.decompress(data)
+            rows = [tuple(None if empty_as_null and v == "" else v for v in row)
+                    for row in csv.reader(io.StringIO(data.decode("utf-8"))) if row]
+            self._cur.executemany(insert, rows)
+            total += len(rows)
+        if re.search(r"PURGE\s*=\s*TRUE", opts, re.I):
+            for _, full in files:
+                os.unlink(full)
+        self._merge_rowcount = total
+        return self
+
+    def executemany(self, sql: str, seq_of_params):
+        rows = [tuple(p) for p in seq_of_params]
+        stmt = _sqlite_dialect(sql.strip(), True)
+        self._cur.executemany(stmt, rows)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def fetchmany(self, size: Optional[int] = None):
+        return self._cur.fetchmany(size) if size else self._cur.fetchmany()
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def close(self):
+        try: self._cur.close()
+        except Exception: pass
+
+class _LocalConnection:
+    """Per-thread SQLite connection; close() is a no-op so the handle is reused like a pooled session."""
+
+    def __init__(self, storage: "LocalStorage", conn: sqlite3.Connection):
+        self._storage = storage
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return _LocalCursor(self._storage, self._conn)
+
+    def is_closed(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+class LocalStorage:
+    """Embedded SQLite (WAL, autocommit) plus a directory-backed blob store with signed URLs."""
+    name = "local"
+
+    def __init__(self, db_path: str, blob_dir: str):
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.create_function("PARSE_JSON", 1, lambda s: None if s is None else json.dumps(json.loads(s)),
+                             deterministic=True)
+        conn.create_function("TO_TIMESTAMP_NTZ", 1, _sqlite_to_timestamp, deterministic=True)
+        conn.create_function("DATEADD", 3, _sqlite_dateadd, deterministic=True)
+        conn.create_function("DATEDIFF", 3, _sqlite_datediff, deterministic=True)
+        conn.create_function("DATE_PART", 2, _sqlite_date_part, deterministic=True)
+        conn.create_function("TO_BINARY", 2, lambda s, fmt: base64.b64decode(s) if s is not None else None,
+                             deterministic=True)
+        conn.create_function("DECODE", -1, _sqlite_decode, deterministic=True)
+        conn.create_function("IFF", 3, lambda c, a, b: a if c else b, deterministic=True)
+        for fn in ("CURRENT_WAREHOUSE", "CURRENT_ROLE", "CURRENT_USER"):
+            conn.create_function(fn, 0, lambda: "LOCAL")
+        conn.create_function("CURRENT_DATABASE", 0, lambda: os.path.basename(self.db_path))
+        conn.create_function("CURRENT_SCHEMA", 0, lambda: "main")
+        conn.create_aggregate("ANY_VALUE", 1, _SqliteAnyValue)
+        with self._schema_lock:
+            if not self._schema_ready:
+                for ddl in LOCAL_SCHEMA_DDL:
+                    conn.execute(_sqlite_ddl_types(ddl))
+                declared = {r[1]: r[2] for r in conn.execute("PRAGMA table_info(DONOR)")}
+                if declared.get("MOBILE_E164", "").upper() == "STRING":
+                    print(f"=== DEBUG: {self.db_path} predates TEXT columns; phone numbers/postal codes may be "
+                          f"stored as numbers. Delete it to recreate the local schema. ===")
+                self._schema_ready = True
+        return conn
+
+    def connect(self) -> _LocalConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        return _LocalConnection(self, conn)
+
+    def _blob_path(self, stage: str, path: str) -> str:
+        full = os.path.normpath(os.path.join(self.blob_dir, stage, path))
+        if not full.startswith(os.path.normpath(self.blob_dir) + os.sep):
+            raise ValueError("blob path escapes the blob directory")
+        return full
+
+    def put_blob(self, cur, stage_uri: str, data: bytes):
+        stage, path = _split_stage_uri(stage_uri)
+        full = self._blob_path(stage, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f"{full}.tmp{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, full)
+
+    def _blob_sig(self, stage: str, path: str, exp: int) -> str:
+        return hmac.new(LOCAL_BLOB_SECRET, f"{stage}/{path}:{exp}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def presign(self, cur, stage: str, path: str, expires_sec: int) -> Optional[str]:
+        exp = int(time.time()) + int(expires_sec)
+        return f"{LOCAL_BLOB_BASE_URL}/local-blob/{stage}/{path}?exp={exp}&sig={self._blob_sig(stage, path, exp)}"
+
+    def read_blob(self, stage: str, path: str, exp: int, sig: str) -> Optional[bytes]:
+        if exp < time.time() or not hmac.compare_digest(sig, self._blob_sig(stage, path, exp)):
+            return None
+        try:
+            with open(self._blob_path(stage, path), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+sqlite3.register_converter("TIMESTAMP_NTZ", lambda b: datetime.fromisoformat(b.decode("utf-8")))
+sqlite3.register_converter("DATE", lambda b: date.fromisoformat(b.decode("utf-8")[:10]))
+sqlite3.register_adapter(datetime, lambda d: _sqlite_ts_str(d.astimezone(timezone.utc).replace(tzinfo=None)
+                                                            if d.tzinfo else d))
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+
+if STORAGE_BACKEND in ("sqlite", "local"):
+    storage = LocalStorage(LOCAL_DB_PATH, LOCAL_BLOB_DIR)
+else:
+    storage = SnowflakeStorage()
+
+def get_snowflake_ctx():
+    """Connection from the configured storage backend (name kept: every route calls it)."""
+    return storage.connect()
+
 # ---------- App ----------
 app = FastAPI(title="Globalfaces Backend", version="0.1.0")
 
@@ -83,13 +880,27 @@ app.add_middleware(
 
 
 # ---------- Models ----------
+# Written only by the server (and the only events that feed rollups); clients may not post them
+SERVER_EVENT_TYPES = {
+    "SESSION_STARTED", "DONOR_INSERT", "DONOR_UPDATE", "DONOR_CONSENT_UPDATE", "SIGNATURE_CAPTURED",
+    "SMS_SENT", "SUBSCRIPTION_CREATED", "CUSTOMER_UPSERT", "PAYMENT_METHOD_ATTACHED", "PLEDGE_IMPORT_CHUNK",
+}
+SERVER_EVENT_PREFIXES = ("STRIPE_", "SMS_REPLY_")
+
+def is_server_event_type(event_type: str) -> bool:
+    et = (event_type or "").strip().upper()
+    return et in SERVER_EVENT_TYPES or et.startswith(SERVER_EVENT_PREFIXES)
+
 class LogEventIn(BaseModel):
-    event_type: str = Field(..., examples=["CONNECTOR_BOOT", "SESSION_STARTED"])
+    event_type: str = Field(..., examples=["CONNECTOR_BOOT", "SCREEN_VIEW"])
     session_id: Optional[str] = None
     donor_id: Optional[str] = None
     fundraiser_id: Optional[str] = None
     attributes: Dict[str, Any] = Field(default_factory=dict)
 
+class ClientEventIn(LogEventIn):
+    event_id: Optional[str] = Field(default=None, description="Client-generated id; makes retries idempotent")
+
 class PaymentIntentIn(BaseModel):
     amount: int = Field(..., description="Amount in cents, e.g., 2000 for $20.00")
     currency: str = Field(default="cad")
@@ -198,16 +1009,201 @@ def years_from_now_utc(years: int) -> int:
         dt = dt + timedelta(days=365 * years)
     return int(dt.timestamp())
 
-def insert_event(cur, ev: LogEventIn, event_id: Optional[str] = None):
-    eid = event_id or f"evt-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}"
+# ---------- IDs (prefix + monotonic ULID) ----------
+# 48-bit ms timestamp | 16-bit worker | 64-bit sequence, Crockford base32. IDs from
+# one process are strictly increasing; across processes they sort by ms, so
+# EVENT_LOG / SESSION ids follow insert order and range-prune like a timestamp.
+_CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ID_WORKER_ID = os.getenv("ID_WORKER_ID", "")
+
+class IdGenerator:
+    def __init__(self, worker_id: Optional[int] = None):
+        self._fixed_worker = worker_id
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker = 0
+        self._last_ms = -1
+        self._seq = 0
+
+    def _reseed(self):
+        # Re-derived after fork so pre-forked workers never share a worker component
+        self._pid = os.getpid()
+        if self._fixed_worker is not None:
+            self._worker = self._fixed_worker & 0xFFFF
+        else:
+            digest = hashlib.sha256(f"{socket.gethostname()}:{self._pid}".encode("utf-8")).digest()
+            self._worker = int.from_bytes(digest[:2], "big")
+        self._last_ms = -1
+
+    def next_int(self) -> int:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reseed()
+            ms = int(time.time() * 1000)
+            if ms > self._last_ms:
+                self._last_ms = ms
+                self._seq = int.from_bytes(os.urandom(8), "big") >> 1   # random start, room to count up
+            else:
+                # Same ms or clock stepped back: stay on the last ms and count up
+                self._seq += 1
+                if self._seq >= 1 << 64:
+                    self._last_ms += 1
+                    self._seq = 0
+            return (self._last_ms << 80) | (self._worker << 64) | self._seq
+
+    def new(self, prefix: str) -> str:
+        return f"{prefix}-{_ulid_encode(self.next_int())}"
+
+def _ulid_encode(value: int) -> str:
+    out = []
+    for _ in range(26):
+        out.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return "".join(reversed(out))
+
+id_generator = IdGenerator(int(ID_WORKER_ID) if ID_WORKER_ID else None)
+
+def new_id(prefix: str) -> str:
+    """e.g. new_id("evt") -> "evt-01JA2V3M7K..." (26 chars after the prefix)."""
+    return id_generator.new(prefix)
+
+def id_floor(prefix: str, when: datetime) -> str:
+    """Smallest id minted at or after `when`; use as `ID >= %s` for range pruning."""
+    return f"{prefix}-{_ulid_encode(int(when.timestamp() * 1000) << 80)}"
+
+# ---------- Event attributes: projection, size cap, serialization ----------
+EVENT_ATTR_PROJECTION = os.getenv("EVENT_ATTR_PROJECTION", "1") == "1"
+EVENT_ATTR_MAX_BYTES = int(os.getenv("EVENT_ATTR_MAX_BYTES", "16384"))
+EVENT_ATTR_OVERFLOW_TABLE = "EVENT_ATTR_OVERFLOW"
+EVENT_ATTR_OVERFLOW_DDL = f"""
+CREATE TABLE IF NOT EXISTS {EVENT_ATTR_OVERFLOW_TABLE} (
+    EVENT_ID STRING NOT NULL PRIMARY KEY,
+    CODEC STRING,
+    RAW_BYTES NUMBER,
+    PAYLOAD BINARY,
+    CREATED_AT TIMESTAMP_NTZ
+)
+"""
+
+# Stripe objects: keep ids/links used for enrichment and reconciliation, state, money and errors
+_STRIPE_COMMON_FIELDS = (
+    "id", "object", "status", "livemode", "created", "customer", "metadata",
+    "amount", "currency", "payment_intent", "invoice", "subscription",
+)
+STRIPE_ATTR_PROJECTIONS: Dict[str, tuple] = {
+    "payment_intent": _STRIPE_COMMON_FIELDS + (
+        "amount_received", "payment_method", "latest_charge", "cancellation_reason",
+        "last_payment_error.code", "last_payment_error.decline_code", "last_payment_error.message",
+    ),
+    "charge": _STRIPE_COMMON_FIELDS + (
+        "amount_captured", "amount_refunded", "paid", "refunded", "payment_method",
+        "failure_code", "failure_message", "outcome.type", "outcome.reason",
+    ),
+    "invoice": _STRIPE_COMMON_FIELDS + (
+        "amount_due", "amount_paid", "amount_remaining", "attempt_count", "billing_reason",
+        "number", "paid", "period_start", "period_end", "next_payment_attempt",
+        "status_transitions.paid_at",
+    ),
+    "subscription": _STRIPE_COMMON_FIELDS + (
+        "cancel_at", "canceled_at", "cancel_at_period_end", "current_period_start",
+        "current_period_end", "billing_cycle_anchor", "default_payment_method", "latest_invoice",
+    ),
+    "customer": _STRIPE_COMMON_FIELDS + ("email", "name", "phone", "invoice_settings.default_payment_method"),
+    "payment_method": _STRIPE_COMMON_FIELDS + ("type", "card.brand", "card.last4", "card.exp_month", "card.exp_year"),
+    "setup_intent": _STRIPE_COMMON_FIELDS + ("payment_method", "usage", "last_setup_error.code"),
+}
+
+# App event types; types not listed keep all attributes
+EVENT_ATTR_PROJECTIONS: Dict[str, tuple] = {
+    "SESSION_STARTED": (
+        "fundraiser.FUNDRAISER_ID", "fundraiser.DISPLAY_NAME",
+        "charity.CHARITY_ID", "charity.NAME",
+        "campaign.CAMPAIGN_ID", "campaign.NAME", "campaign.CURRENCY",
+    ),
+}
+
+_MISSING = object()
+
+def _project(attrs: Dict[str, Any], fields: tuple) -> Dict[str, Any]:
+    """Copies the dotted paths in fields out of attrs, preserving nesting."""
+    out: Dict[str, Any] = {}
+    for field in fields:
+        parts = field.split(".")
+        value = attrs
+        for part in parts:
+            value = value.get(part, _MISSING) if isinstance(value, dict) else _MISSING
+            if value is _MISSING:
+                break
+        if value is _MISSING or value is None:
+            continue
+        target = out
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return out
+
+def project_event_attributes(event_type: str, attrs: Dict[str, Any]) -> Dict[str, Any]:
+    if not EVENT_ATTR_PROJECTION or not attrs:
+        return attrs
+    if event_type.startswith("STRIPE_"):
+        fields = STRIPE_ATTR_PROJECTIONS.get(attrs.get("object"), _STRIPE_COMMON_FIELDS)
+    else:
+        fields = EVENT_ATTR_PROJECTIONS.get(event_type)
+    return _project(attrs, fields) if fields else attrs
+
+def _dumps_attrs(attrs: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(attrs, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(attrs, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+def serialize_event_attributes(cur, event_id: str, event_type: str, attrs: Dict[str, Any]) -> str:
+    """
+    Projects attrs for the event type and, when the result is still larger than
+    EVENT_ATTR_MAX_BYTES, parks it zlib-compressed in EVENT_ATTR_OVERFLOW and
+    returns a small stub that points there.
+    """
+    projected = project_event_attributes(event_type, attrs)
+    raw = _dumps_attrs(projected)
+    metric_inc("event_attrs.count")
+    metric_inc("event_attrs.bytes", len(raw))
+    if EVENT_ATTR_MAX_BYTES <= 0 or len(raw) <= EVENT_ATTR_MAX_BYTES:
+        return raw.decode("utf-8")
+    metric_inc("event_attrs.overflow")
+    _ensure_table(cur, EVENT_ATTR_OVERFLOW_TABLE, EVENT_ATTR_OVERFLOW_DDL)
+    cur.execute(
+        f"""
+        INSERT INTO {EVENT_ATTR_OVERFLOW_TABLE} (EVENT_ID, CODEC, RAW_BYTES, PAYLOAD, CREATED_AT)
+        SELECT %s, 'zlib', %s, TO_BINARY(%s, 'BASE64'), CURRENT_TIMESTAMP()
+        """,
+        (event_id, len(raw), base64.b64encode(zlib.compress(raw, 6)).decode("ascii")),
+    )
+    stub = {"_overflow": True, "_bytes": len(raw)}
+    for key in ("id", "object", "status"):
+        if key in projected:
+            stub[key] = projected[key]
+    return _dumps_attrs(stub).decode("utf-8")
+
+def insert_event(cur, ev: LogEventIn, event_id: Optional[str] = None, rollups: bool = False):
+    """
+    Appends to EVENT_LOG. rollups=True only from server-side write paths: rollups
+    must never be fed by client-posted events (see SERVER_EVENT_TYPES).
+    """
+    eid = event_id or new_id("evt")
     cur.execute(
         """
         INSERT INTO EVENT_LOG (EVENT_ID, SESSION_ID, DONOR_ID, FUNDRAISER_ID, EVENT_TYPE, ATTRIBUTES)
         SELECT %s, %s, %s, %s, %s, PARSE_JSON(%s)
         """,
         (eid, ev.session_id, ev.donor_id, ev.fundraiser_id, ev.event_type,
-         json.dumps(ev.attributes, default=_json_default)),
+         serialize_event_attributes(cur, eid, ev.event_type, ev.attributes)),
     )
+    if rollups:
+        try:
+            apply_event_rollups(cur, ev)
+        except Exception as e:
+            # Rollups are derived data; never fail the write that feeds them
+            metric_inc("rollups.error")
+            print(f"=== DEBUG: rollup update failed for {eid}: {e} ===")
     return eid
 
 def row_to_dict(cur, row, cols=None):
@@ -223,215 +1219,2159 @@ def presign_stage_url(cur, stage_uri: str, expires_sec: int = 3600) -> str | Non
     """
     Accepts a Snowflake stage URI like:
       @DB.SCHEMA.STAGE/path/to/file.png
-    Returns a presigned HTTPS URL via GET_PRESIGNED_URL. Works for internal and external stages.
+    Returns a presigned HTTPS URL via GET_PRESIGNED_URL (or the local blob store's
+    signed URL). Works for internal and external stages.
     """
-    if not stage_uri or not stage_uri.strip().startswith("@"):
-        return None
-
-    m = re.match(r"^@(?P<stage>[A-Za-z0-9_\.]+)/(.*)$", stage_uri.strip())
-    if not m:
+    parts = _split_stage_uri(stage_uri)
+    if not parts:
         return None
-
-    stage_name = m.group("stage")  # e.g., "PHOENIX_APP_DEV.CORE.ASSETS" or "...ASSETS_INT"
-    path = stage_uri.strip()[len(f"@{stage_name}/"):]  # e.g., "logos/CH003.png" or "signatures/xxx.png"
+    stage_name, path = parts  # e.g., "PHOENIX_APP_DEV.CORE.ASSETS", "logos/CH003.png"
 
     try:
-        row = cur.execute(
-            f"SELECT GET_PRESIGNED_URL(@{stage_name}, %s, %s)",
-            (path, expires_sec)
-        ).fetchone()
-        return row[0] if row and row[0] else None
+        return storage.presign(cur, stage_name, path, expires_sec)
     except Exception as e:
         print(f"=== DEBUG: GET_PRESIGNED_URL failed for {stage_name}/{path}: {e} ===")
         return None
 
-    
- 
+_ensured_tables: set = set()
 
-# ---------- Routes ----------
-@app.get("/healthz")
-def healthz():
-    ctx = get_snowflake_ctx()
+def _ensure_table(cur, name: str, ddl: str):
+    """
+    Runs a CREATE TABLE IF NOT EXISTS once per process. The app role may not
+    have CREATE privileges in every environment, so failures are only logged.
+    """
+    if name in _ensured_tables:
+        return
     try:
-        cur = ctx.cursor()
-        who = cur.execute(
-            "SELECT CURRENT_USER(), CURRENT_ROLE(), CURRENT_WAREHOUSE(), CURRENT_DATABASE(), CURRENT_SCHEMA()"
-        ).fetchone()
+        cur.execute(ddl)
+    except Exception as e:
+        print(f"=== DEBUG: ensure table {name} failed: {e} ===")
+    _ensured_tables.add(name)
+
+# ---------- Metrics (in-process) ----------
+_metrics_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_timings: Dict[str, Dict[str, float]] = {}
+
+def metric_inc(name: str, value: float = 1):
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def metric_set(name: str, value: float):
+    with _metrics_lock:
+        _gauges[name] = value
+
+def metric_observe(name: str, seconds: float):
+    with _metrics_lock:
+        t = _timings.get(name)
+        if t is None:
+            t = _timings[name] = {"count": 0, "sum_sec": 0.0, "max_sec": 0.0}
+        t["count"] += 1
+        t["sum_sec"] += seconds
+        t["max_sec"] = max(t["max_sec"], seconds)
+
+def metrics_snapshot() -> Dict[str, Any]:
+    with _metrics_lock:
         return {
-            "ok": True,
-            "snowflake": {
-                "user": who[0],
-                "role": who[1],
-                "wh": who[2],
-                "db": who[3],
-                "schema": who[4],
-            },
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {k: dict(v) for k, v in _timings.items()},
         }
-    finally:
-        try: cur.close()
-        except Exception: pass
-        ctx.close()
 
-@app.post("/log-event")
-def log_event(ev: LogEventIn):
-    ctx = get_snowflake_ctx()
-    try:
-        cur = ctx.cursor()
-        event_id = insert_event(cur, ev)
-        return {"ok": True, "event_id": event_id}
-    finally:
-        try: cur.close()
-        except Exception: pass
-        ctx.close()
+# ---------- Token bucket ----------
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens/sec, bursts up to `capacity`."""
 
-# ---------- SMS: outbound send (FINAL MESSAGE FORMAT) ----------
-@app.post("/verification/sms/send")
-def send_verification_sms(payload: SendSmsIn, request: Request):
-    if not twilio_client:
-        raise HTTPException(status_code=500, detail="Twilio client not configured")
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-    ctx = get_snowflake_ctx()
-    try:
-        cur = ctx.cursor()
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
 
-        # --- Donor fields for message ---
-        cur.execute(
-            """
-            SELECT TITLE, FIRST_NAME, MIDDLE_NAME, LAST_NAME,
-                   EMAIL, ADDRESS1, ADDRESS2, CITY, REGION, POSTAL_CODE, COUNTRY,
-                   DOB_DATE
-            FROM DONOR
-            WHERE DONOR_ID = %s
-            """,
-            (payload.donor_id,)
-        )
-        drow = cur.fetchone()
-        if not drow:
-            raise HTTPException(status_code=404, detail="Donor not found")
+    def wait_time(self, n: float = 1) -> float:
+        """Seconds until n tokens are available (0 if they are now); takes nothing."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= n:
+                return 0.0
+            return (n - self._tokens) / self.rate if self.rate > 0 else float("inf")
 
-        (title, first, middle, last,
-         email, addr1, addr2, city, region, postal, country,
-         dob_date) = drow
+    def try_acquire(self, n: float = 1) -> float:
+        """Takes n tokens and returns 0, or returns the seconds to wait until they'd be available."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= n:
+                self._tokens -= n
+                return 0.0
+            return (n - self._tokens) / self.rate if self.rate > 0 else float("inf")
 
-        # --- Fundraiser first name from session ---
-        cur.execute(
-            """
-            SELECT F.DISPLAY_NAME
-            FROM SESSION S
-            JOIN FUNDRAISER F ON F.FUNDRAISER_ID = S.FUNDRAISER_ID
-            WHERE S.SESSION_ID = %s
-            """,
-            (payload.session_id,)
-        )
-        frow = cur.fetchone()
-        fundraiser_display = (frow[0] if frow else "") or ""
-        fundraiser_first = (fundraiser_display.strip().split(" ")[0]) if fundraiser_display else "your fundraiser"
+    def acquire(self, n: float = 1):
+        while True:
+            wait = self.try_acquire(n)
+            if wait <= 0:
+                return
+            time.sleep(wait)
 
-        # Donor full name: Title + First + Middle + Last (non-blank)
-        name_parts = [_nz(title), _nz(first), _nz(middle), _nz(last)]
-        donor_full_name = " ".join([p for p in name_parts if p])
+# ---------- Rate limiting (token buckets per route + caller key) ----------
+# Limits are "<route>.<key>" -> (tokens/sec, burst); a request spends one token from
+# each of its route's buckets (fundraiser, device, phone number, IP, ...). Override
+# or add limits with RATE_LIMITS="sms_send.to=0.05:3,login.ip=5:100" (rate 0 disables).
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()   # memory | sqlite | off
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", "rate_limits.sqlite")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000"))
+# Shared buckets idle this long are dropped (they'd have refilled already at any configured rate)
+RATE_LIMIT_IDLE_SEC = int(os.getenv("RATE_LIMIT_IDLE_SEC", "3600"))
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    # Every send is a paid Twilio message: a handset gets a few resends, a tablet a steady trickle
+    "sms_send.to": (1 / 60, 3),
+    "sms_send.session": (1 / 30, 5),
+    "sms_send.fundraiser": (0.2, 20),
+    "sms_send.device": (0.2, 20),
+    "sms_send.ip": (1, 60),
+    # Every login writes a SESSION row
+    "login.fundraiser": (0.1, 10),
+    "login.device": (0.1, 10),
+    "login.ip": (1, 60),
+    "log_event.fundraiser": (10, 200),
+    "log_event.device": (10, 200),
+    "log_event.ip": (50, 1000),
+    # Per batch (up to LOG_EVENTS_MAX_ITEMS events each)
+    "log_events.device": (2, 60),
+    "log_events.ip": (10, 300),
+}
 
-        # Address line (skip address2 if blank)
-        addr_parts = [_nz(addr1)]
-        if _nz(addr2):
-            addr_parts.append(_nz(addr2))
-        addr_parts += [_nz(city), _nz(region), _nz(postal), _nz(country)]
-        address_line = ", ".join([p for p in addr_parts if p])
+def _parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    out = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, burst = value.partition(":")
+        out[name.strip()] = (float(rate), float(burst) if burst else max(float(rate), 1.0))
+    return out
 
-        # DOB as ISO
-        dob_iso = dob_date.isoformat() if hasattr(dob_date, "isoformat") else _nz(dob_date)
+RATE_LIMITS.update(_parse_rate_limits(os.getenv("RATE_LIMITS", "")))
 
-        # Amount + frequency + charity
-        amount_str = f"${payload.amount_cents/100:.2f} {payload.currency.upper()}"
-        freq_txt = "(monthly)" if (payload.gift_type or "").upper() == "MONTHLY" else "(one-time)"
-        charity_txt = _nz(payload.charity_name)
+class _MemoryLimiterBackend:
+    """Per-worker buckets in a bounded LRU; an evicted (idle) key simply starts full again."""
 
-        # FINAL BODY — EXACT WORDING
-        desired_body = (
-            f"Hi {donor_full_name}! It's {fundraiser_first}.  "
-            f"Thank you for committing to donate {amount_str} {freq_txt} to {charity_txt}.\n\n"
-            f"Your information is as follows:\n"
-            f"Email address: {email}\n"
-            f"Address: {address_line}\n"
-            f"Date of Birth: {dob_iso}\n\n"
-            f"Please confirm (yes/no) that everything above is correct."
-        )
-        body = payload.preview_message or desired_body
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
 
-        # --- Send SMS via Twilio ---
-        msg_kwargs = {"to": payload.to_e164, "body": body}
-        if TWILIO_MESSAGING_SERVICE_SID:
-            msg_kwargs["messaging_service_sid"] = TWILIO_MESSAGING_SERVICE_SID
-        elif TWILIO_FROM_NUMBER:
-            msg_kwargs["from_"] = TWILIO_FROM_NUMBER
+    def _bucket(self, key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
         else:
-            raise HTTPException(status_code=500, detail="Set TWILIO_MESSAGING_SERVICE_SID or TWILIO_FROM_NUMBER")
+            self._buckets.move_to_end(key)
+        return bucket
 
-        msg = twilio_client.messages.create(**msg_kwargs)
+    def take_all(self, items: List[Tuple[str, float, float]]) -> Tuple[Optional[int], float]:
+        """
+        One token from every bucket, or none: returns (None, 0), or the index of the
+        first empty bucket and its wait. Buckets are only touched under self._lock,
+        so nothing can drain one between the check and the take.
+        """
+        with self._lock:
+            buckets = [self._bucket(key, rate, burst) for key, rate, burst in items]
+            for i, bucket in enumerate(buckets):
+                wait = bucket.wait_time()
+                if wait > 0:
+                    return i, wait
+            for bucket in buckets:
+                bucket.try_acquire()
+        return None, 0.0
 
-        # Persist tracking row
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+class _SqliteLimiterBackend:
+    """Buckets in a SQLite file shared by every worker process on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._takes = itertools.count()
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")   # losing a few tokens on power loss is fine
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS BUCKET (K TEXT PRIMARY KEY, TOKENS REAL NOT NULL, UPDATED REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def take_all(self, items: List[Tuple[str, float, float]]) -> Tuple[Optional[int], float]:
+        """Same contract as _MemoryLimiterBackend.take_all; one IMMEDIATE transaction covers every bucket."""
+        # Keys hold phone numbers / IPs; only a digest is written to disk
+        ks = [hashlib.sha1(key.encode("utf-8")).hexdigest() for key, _, _ in items]
+        conn = self._db()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            for i, (k, (_, rate, burst)) in enumerate(zip(ks, items)):
+                row = conn.execute("SELECT TOKENS, UPDATED FROM BUCKET WHERE K = ?", (k,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                if tokens < 1:
+                    conn.execute("ROLLBACK")
+                    return i, (1 - tokens) / rate if rate > 0 else float("inf")
+                levels.append(tokens - 1)
+            conn.executemany("INSERT OR REPLACE INTO BUCKET (K, TOKENS, UPDATED) VALUES (?, ?, ?)",
+                             [(k, tokens, now) for k, tokens in zip(ks, levels)])
+            if next(self._takes) % 1000 == 0:
+                conn.execute("DELETE FROM BUCKET WHERE UPDATED < ?", (now - RATE_LIMIT_IDLE_SEC,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return None, 0.0
+
+    def __len__(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM BUCKET").fetchone()[0]
+
+class RateLimiter:
+    def __init__(self, backend, limits: Dict[str, Tuple[float, float]]):
+        self.backend = backend
+        self.limits = limits
+
+    def check(self, route: str, keys: Dict[str, Optional[str]]) -> float:
+        """
+        Spends a token from each configured key's bucket, but only if every one of
+        them has a token; returns 0, or the Retry-After of the first empty bucket.
+        """
+        names, items = [], []
+        for kind, value in keys.items():
+            name = f"{route}.{kind}"
+            limit = self.limits.get(name)
+            if not value or not limit or limit[0] <= 0:
+                continue
+            names.append(name)
+            items.append((f"{name}:{value}", limit[0], limit[1]))
+        if not items:
+            return 0.0
+        try:
+            limited, wait = self.backend.take_all(items)
+        except sqlite3.Error as e:
+            # Shared store busy/broken: fail open rather than reject tablet traffic
+            print(f"=== DEBUG: rate limiter backend error: {e} ===")
+            metric_inc("rate_limit.backend_errors")
+            return 0.0
+        if limited is not None:
+            metric_inc(f"rate_limit.{names[limited]}.limited")
+            return wait
+        for name in names:
+            metric_inc(f"rate_limit.{name}.allowed")
+        return 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            keys = len(self.backend)
+        except sqlite3.Error:
+            keys = None
+        return {"backend": RATE_LIMIT_BACKEND, "keys": keys}
+
+if RATE_LIMIT_BACKEND == "off":
+    rate_limiter: Optional[RateLimiter] = None
+elif RATE_LIMIT_BACKEND == "sqlite":
+    rate_limiter = RateLimiter(_SqliteLimiterBackend(RATE_LIMIT_DB_PATH), RATE_LIMITS)
+else:
+    rate_limiter = RateLimiter(_MemoryLimiterBackend(RATE_LIMIT_MAX_KEYS), RATE_LIMITS)
+
+def client_ip(request: Request) -> Optional[str]:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+def enforce_rate_limit(route: str, request: Request, **keys: Optional[str]):
+    """Raises 429 (with Retry-After) if any of the caller's buckets for `route` is empty."""
+    if rate_limiter is None:
+        return
+    keys.setdefault("device", request.headers.get("x-device-id"))
+    keys.setdefault("ip", client_ip(request))
+    wait = rate_limiter.check(route, keys)
+    if wait > 0:
+        raise HTTPException(status_code=429, detail="Too many requests, retry later",
+                            headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+# ---------- Single-flight (coalesce identical concurrent reads) ----------
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Concurrent callers of do() with the same key share one execution of fn and
+    its result (or exception). Nothing is cached once the leader returns.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights: Dict[Any, _Flight] = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        metric_inc(f"singleflight.{self.name}.calls")
+        if not leader:
+            metric_inc(f"singleflight.{self.name}.shared")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+def singleflight_stats() -> Dict[str, Dict[str, float]]:
+    counters = metrics_snapshot()["counters"]
+    out: Dict[str, Dict[str, float]] = {}
+    for name, value in counters.items():
+        if name.startswith("singleflight.") and name.endswith(".calls"):
+            flight = name[len("singleflight."):-len(".calls")]
+            shared = counters.get(f"singleflight.{flight}.shared", 0)
+            out[flight] = {"calls": value, "shared": shared,
+                           "coalescing_ratio": (shared / value) if value else 0.0}
+    return out
+
+# ---------- Stripe customer index (normalized email -> customer id) ----------
+CUSTOMER_INDEX_TABLE = "STRIPE_CUSTOMER_INDEX"
+CUSTOMER_INDEX_DDL = f"""
+CREATE TABLE IF NOT EXISTS {CUSTOMER_INDEX_TABLE} (
+    EMAIL_NORM STRING NOT NULL PRIMARY KEY,
+    STRIPE_CUSTOMER_ID STRING NOT NULL,
+    SOURCE STRING,
+    UPDATED_AT TIMESTAMP_NTZ
+)
+"""
+
+_customer_index: Dict[str, str] = {}        # email_norm -> customer_id
+_customer_index_by_id: Dict[str, str] = {}  # customer_id -> email_norm
+_customer_index_loaded = False
+_customer_index_lock = threading.Lock()
+_customer_email_locks: Dict[str, threading.Lock] = {}
+
+def _norm_email(email: Optional[str]) -> str:
+    return _nz(email).lower()
+
+def _customer_index_load(cur):
+    """Fills the in-memory index from Snowflake once per process."""
+    global _customer_index_loaded
+    if _customer_index_loaded:
+        return
+    with _customer_index_lock:
+        if _customer_index_loaded:
+            return
+        _ensure_table(cur, CUSTOMER_INDEX_TABLE, CUSTOMER_INDEX_DDL)
+        try:
+            rows = cur.execute(
+                f"SELECT EMAIL_NORM, STRIPE_CUSTOMER_ID FROM {CUSTOMER_INDEX_TABLE}"
+            ).fetchall()
+        except Exception as e:
+            print(f"=== DEBUG: customer index load failed: {e} ===")
+            return
+        for email_norm, customer_id in rows:
+            _customer_index[email_norm] = customer_id
+            _customer_index_by_id[customer_id] = email_norm
+        _customer_index_loaded = True
+
+def _customer_index_get(email: str) -> Optional[str]:
+    return _customer_index.get(_norm_email(email))
+
+def _customer_index_put(cur, email: Optional[str], customer_id: str, source: str):
+    email_norm = _norm_email(email)
+    if not email_norm or not customer_id:
+        return
+    with _customer_index_lock:
+        if _customer_index.get(email_norm) == customer_id:
+            return
+        # A customer whose email changed must not stay reachable under the old one
+        old_email = _customer_index_by_id.get(customer_id)
+        if old_email and old_email != email_norm and _customer_index.get(old_email) == customer_id:
+            del _customer_index[old_email]
+        _customer_index[email_norm] = customer_id
+        _customer_index_by_id[customer_id] = email_norm
+    _ensure_table(cur, CUSTOMER_INDEX_TABLE, CUSTOMER_INDEX_DDL)
+    cur.execute(
+        f"""
+        MERGE INTO {CUSTOMER_INDEX_TABLE} T
+        USING (SELECT %s AS EMAIL_NORM, %s AS STRIPE_CUSTOMER_ID, %s AS SOURCE) S
+        ON T.EMAIL_NORM = S.EMAIL_NORM
+        WHEN MATCHED THEN UPDATE SET
+            STRIPE_CUSTOMER_ID = S.STRIPE_CUSTOMER_ID, SOURCE = S.SOURCE, UPDATED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (EMAIL_NORM, STRIPE_CUSTOMER_ID, SOURCE, UPDATED_AT)
+            VALUES (S.EMAIL_NORM, S.STRIPE_CUSTOMER_ID, S.SOURCE, CURRENT_TIMESTAMP())
+        """,
+        (email_norm, customer_id, source),
+    )
+    cur.execute(
+        f"DELETE FROM {CUSTOMER_INDEX_TABLE} WHERE STRIPE_CUSTOMER_ID = %s AND EMAIL_NORM <> %s",
+        (customer_id, email_norm),
+    )
+
+def _customer_index_put_many(cur, pairs: List[Tuple[str, str]], source: str):
+    """Bulk variant of _customer_index_put for import jobs: one MERGE for all pairs."""
+    pairs = [(_norm_email(e), c) for e, c in pairs if _norm_email(e) and c]
+    if not pairs:
+        return
+    with _customer_index_lock:
+        for email_norm, customer_id in pairs:
+            _customer_index[email_norm] = customer_id
+            _customer_index_by_id[customer_id] = email_norm
+    _ensure_table(cur, CUSTOMER_INDEX_TABLE, CUSTOMER_INDEX_DDL)
+    cur.execute("CREATE OR REPLACE TEMPORARY TABLE CUSTOMER_INDEX_LOAD (EMAIL_NORM STRING, STRIPE_CUSTOMER_ID STRING)")
+    cur.executemany("INSERT INTO CUSTOMER_INDEX_LOAD VALUES (%s, %s)", pairs)
+    cur.execute(
+        f"""
+        MERGE INTO {CUSTOMER_INDEX_TABLE} T
+        USING (SELECT EMAIL_NORM, ANY_VALUE(STRIPE_CUSTOMER_ID) AS STRIPE_CUSTOMER_ID
+               FROM CUSTOMER_INDEX_LOAD GROUP BY EMAIL_NORM) S
+        ON T.EMAIL_NORM = S.EMAIL_NORM
+        WHEN MATCHED THEN UPDATE SET
+            STRIPE_CUSTOMER_ID = S.STRIPE_CUSTOMER_ID, SOURCE = %s, UPDATED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (EMAIL_NORM, STRIPE_CUSTOMER_ID, SOURCE, UPDATED_AT)
+            VALUES (S.EMAIL_NORM, S.STRIPE_CUSTOMER_ID, %s, CURRENT_TIMESTAMP())
+        """,
+        (source, source),
+    )
+
+def _customer_index_remove(cur, customer_id: str):
+    with _customer_index_lock:
+        email_norm = _customer_index_by_id.pop(customer_id, None)
+        if email_norm and _customer_index.get(email_norm) == customer_id:
+            del _customer_index[email_norm]
+    _ensure_table(cur, CUSTOMER_INDEX_TABLE, CUSTOMER_INDEX_DDL)
+    cur.execute(f"DELETE FROM {CUSTOMER_INDEX_TABLE} WHERE STRIPE_CUSTOMER_ID = %s", (customer_id,))
+
+def _customer_email_lock(email_norm: str) -> threading.Lock:
+    with _customer_index_lock:
+        lock = _customer_email_locks.get(email_norm)
+        if lock is None:
+            lock = _customer_email_locks[email_norm] = threading.Lock()
+        return lock
+
+def _customer_index_lookup_db(cur, email_norm: str) -> Optional[str]:
+    """Catches entries written by other workers since this process loaded the index."""
+    try:
+        row = cur.execute(
+            f"SELECT STRIPE_CUSTOMER_ID FROM {CUSTOMER_INDEX_TABLE} WHERE EMAIL_NORM = %s",
+            (email_norm,),
+        ).fetchone()
+    except Exception as e:
+        print(f"=== DEBUG: customer index lookup failed: {e} ===")
+        return None
+    return row[0] if row else None
+
+
+# ---------- Idempotency-Key (mutating endpoints) ----------
+IDEMPOTENCY_TABLE = "IDEMPOTENCY_KEY"
+IDEMPOTENCY_DDL = f"""
+CREATE TABLE IF NOT EXISTS {IDEMPOTENCY_TABLE} (
+    IDEM_KEY STRING NOT NULL PRIMARY KEY,
+    FINGERPRINT STRING,
+    STATUS STRING,
+    RESPONSE_STATUS NUMBER,
+    RESPONSE_CONTENT_TYPE STRING,
+    RESPONSE_BODY_B64 STRING,
+    RESPONSE_HEADERS STRING,
+    CLAIM_TOKEN STRING,
+    CREATED_AT TIMESTAMP_NTZ,
+    COMPLETED_AT TIMESTAMP_NTZ
+)
+"""
+IDEMPOTENCY_HEADERS_DDL = f"ALTER TABLE {IDEMPOTENCY_TABLE} ADD COLUMN IF NOT EXISTS RESPONSE_HEADERS STRING"
+IDEMPOTENCY_CLAIM_TOKEN_DDL = f"ALTER TABLE {IDEMPOTENCY_TABLE} ADD COLUMN IF NOT EXISTS CLAIM_TOKEN STRING"
+IDEMPOTENCY_TTL_SEC = int(os.getenv("IDEMPOTENCY_TTL_SEC", "86400"))
+IDEMPOTENCY_CACHE_MAX = int(os.getenv("IDEMPOTENCY_CACHE_MAX", "5000"))
+# An IN_PROGRESS claim older than this is assumed to belong to a dead worker
+IDEMPOTENCY_CLAIM_STALE_SEC = int(os.getenv("IDEMPOTENCY_CLAIM_STALE_SEC", "120"))
+IDEMPOTENT_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+# Not stored (nor are 5xx): the client is expected to retry and should get a fresh answer
+IDEMPOTENCY_TRANSIENT_STATUSES = {408, 425, 429}
+# Recomputed on replay, or meaningless for a replayed response
+_IDEM_SKIP_HEADERS = {"content-length", "date", "server", "transfer-encoding", "connection"}
+
+# key -> (expires_at, fingerprint, status, headers, body); headers is [(name, value)] incl. content-type
+_idem_cache: "OrderedDict[str, Tuple[float, str, int, List[Tuple[str, str]], bytes]]" = OrderedDict()
+_idem_cache_lock = threading.Lock()
+_idem_inflight: Dict[str, "asyncio.Future"] = {}
+
+def _idem_cache_get(key: str):
+    with _idem_cache_lock:
+        hit = _idem_cache.get(key)
+        if hit is None:
+            return None
+        if hit[0] < time.time():
+            del _idem_cache[key]
+            return None
+        _idem_cache.move_to_end(key)
+        return hit
+
+def _idem_cache_put(key: str, fingerprint: str, status: int, headers: List[Tuple[str, str]], body: bytes):
+    with _idem_cache_lock:
+        _idem_cache[key] = (time.time() + IDEMPOTENCY_TTL_SEC, fingerprint, status, headers, body)
+        _idem_cache.move_to_end(key)
+        while len(_idem_cache) > IDEMPOTENCY_CACHE_MAX:
+            _idem_cache.popitem(last=False)
+
+def _idem_db_claim(key: str, fingerprint: str):
+    """
+    Returns ("CLAIMED", token) when this worker owns the key, ("COMPLETE", row) for a
+    stored response, or ("IN_PROGRESS", None) when another worker is executing it.
+
+    The claim is a single MERGE that stamps CLAIM_TOKEN only when it inserts the key or
+    takes over a stale claim / expired response; Snowflake serialises MERGEs on a table,
+    so exactly one concurrent caller reads its own token back and runs the request.
+    """
+    token = new_id("claim")
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_table(cur, IDEMPOTENCY_TABLE, IDEMPOTENCY_DDL)
+        _ensure_table(cur, f"{IDEMPOTENCY_TABLE}.headers", IDEMPOTENCY_HEADERS_DDL)
+        _ensure_table(cur, f"{IDEMPOTENCY_TABLE}.claim_token", IDEMPOTENCY_CLAIM_TOKEN_DDL)
+        cur.execute(
+            f"""
+            MERGE INTO {IDEMPOTENCY_TABLE} T
+            USING (SELECT %s AS IDEM_KEY, %s AS FINGERPRINT, %s AS CLAIM_TOKEN) S
+            ON T.IDEM_KEY = S.IDEM_KEY
+            WHEN MATCHED AND (
+                (T.STATUS = 'IN_PROGRESS' AND DATEDIFF('second', T.CREATED_AT, CURRENT_TIMESTAMP()) >= %s)
+                OR (T.STATUS = 'COMPLETE' AND DATEDIFF('second', T.CREATED_AT, CURRENT_TIMESTAMP()) >= %s)
+            ) THEN UPDATE SET
+                FINGERPRINT = S.FINGERPRINT, STATUS = 'IN_PROGRESS', CLAIM_TOKEN = S.CLAIM_TOKEN,
+                RESPONSE_STATUS = NULL, RESPONSE_CONTENT_TYPE = NULL, RESPONSE_BODY_B64 = NULL,
+                RESPONSE_HEADERS = NULL, CREATED_AT = CURRENT_TIMESTAMP(), COMPLETED_AT = NULL
+            WHEN NOT MATCHED THEN INSERT (IDEM_KEY, FINGERPRINT, STATUS, CLAIM_TOKEN, CREATED_AT)
+                VALUES (S.IDEM_KEY, S.FINGERPRINT, 'IN_PROGRESS', S.CLAIM_TOKEN, CURRENT_TIMESTAMP())
+            """,
+            (key, fingerprint, token, IDEMPOTENCY_CLAIM_STALE_SEC, IDEMPOTENCY_TTL_SEC),
+        )
+        row = cur.execute(
+            f"""
+            SELECT FINGERPRINT, STATUS, RESPONSE_STATUS, RESPONSE_CONTENT_TYPE, RESPONSE_BODY_B64, RESPONSE_HEADERS,
+                   CLAIM_TOKEN
+            FROM {IDEMPOTENCY_TABLE} WHERE IDEM_KEY = %s
+            """,
+            (key,),
+        ).fetchone()
+        if not row:
+            # The other claimant released the key between our MERGE and this read
+            return "IN_PROGRESS", None
+        fp, status, resp_status, content_type, body_b64, headers_json, claim_token = row
+        if status == "IN_PROGRESS" and claim_token == token:
+            return "CLAIMED", token
+        if status == "COMPLETE":
+            headers = ([tuple(h) for h in json.loads(headers_json)] if headers_json
+                       else [("content-type", content_type or "application/json")])
+            return "COMPLETE", (fp, int(resp_status), headers, base64.b64decode(body_b64 or ""))
+        return "IN_PROGRESS", None
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+def _idem_db_complete(key: str, token: str, status: int, headers: List[Tuple[str, str]], body: bytes):
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        cur.execute(
+            f"""
+            UPDATE {IDEMPOTENCY_TABLE}
+            SET STATUS = 'COMPLETE', RESPONSE_STATUS = %s, RESPONSE_CONTENT_TYPE = %s,
+                RESPONSE_BODY_B64 = %s, RESPONSE_HEADERS = %s, COMPLETED_AT = CURRENT_TIMESTAMP()
+            WHERE IDEM_KEY = %s AND CLAIM_TOKEN = %s
+            """,
+            (status, dict(headers).get("content-type", "application/json"), base64.b64encode(body).decode("ascii"),
+             json.dumps(headers), key, token),
+        )
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+def _idem_db_release(key: str, token: str):
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        cur.execute(
+            f"DELETE FROM {IDEMPOTENCY_TABLE} WHERE IDEM_KEY = %s AND STATUS = 'IN_PROGRESS' AND CLAIM_TOKEN = %s",
+            (key, token),
+        )
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+def _idem_key(request: Request, suffix: str) -> Optional[str]:
+    """Derives a Stripe idempotency key from the client's Idempotency-Key, if one was sent."""
+    key = getattr(request.state, "idempotency_key", None)
+    return f"{key}-{suffix}" if key else None
+
+class IdempotencyMiddleware:
+    """
+    Replays the first response (status, headers, body) for a repeated (method, path, Idempotency-Key).
+    Responses live in a bounded in-memory LRU backed by IDEMPOTENCY_KEY; concurrent
+    duplicates in this worker await the in-flight request, duplicates racing on
+    another worker get 409. 5xx and transient 4xx (429 etc.) responses are not stored so the client can retry.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in IDEMPOTENT_METHODS:
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers") or []}
+        client_key = (headers.get("idempotency-key") or "").strip()
+        if not client_key:
+            return await self.app(scope, receive, send)
+
+        # Buffer the request body so it can be fingerprinted and replayed downstream
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+        key = f"{scope['method']} {scope['path']} {client_key}"
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        while key in _idem_inflight:
+            try:
+                await asyncio.shield(_idem_inflight[key])
+            except Exception:
+                pass
+        hit = _idem_cache_get(key)
+        if hit is None:
+            fut = asyncio.get_running_loop().create_future()
+            _idem_inflight[key] = fut
+            try:
+                try:
+                    state, row = await run_in_threadpool(_idem_db_claim, key, fingerprint)
+                except Exception as e:
+                    # Durable store unavailable: still dedupe within this worker
+                    print(f"=== DEBUG: idempotency claim failed for {key}: {e} ===")
+                    state, row = "CLAIMED", None
+                if state == "IN_PROGRESS":
+                    return await self._send_json(send, 409, {"detail": "A request with this Idempotency-Key is in progress"})
+                if state == "COMPLETE":
+                    fp, status, headers, resp_body = row
+                    _idem_cache_put(key, fp, status, headers, resp_body)
+                    hit = _idem_cache_get(key)
+                else:
+                    return await self._execute(scope, body, send, key, row, fingerprint, client_key)
+            finally:
+                _idem_inflight.pop(key, None)
+                if not fut.done():
+                    fut.set_result(None)
+
+        _, fp, status, headers, resp_body = hit
+        if fp != fingerprint:
+            return await self._send_json(send, 422, {"detail": "Idempotency-Key reused with a different request body"})
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+                       + [(b"content-length", str(len(resp_body)).encode("ascii")),
+                          (b"idempotent-replayed", b"true")],
+        })
+        await send({"type": "http.response.body", "body": resp_body})
+
+    async def _execute(self, scope, body, send, key, token, fingerprint, client_key):
+        sent_body = False
+
+        async def replay_receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return {"type": "http.disconnect"}
+
+        captured = {"status": 500, "headers": [], "body": []}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                captured["status"] = message["status"]
+                captured["headers"] = [
+                    (k.decode("latin-1").lower(), v.decode("latin-1")) for k, v in message.get("headers") or []
+                    if k.decode("latin-1").lower() not in _IDEM_SKIP_HEADERS
+                ]
+            elif message["type"] == "http.response.body":
+                captured["body"].append(message.get("body", b""))
+            await send(message)
+
+        scope.setdefault("state", {})["idempotency_key"] = client_key
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except Exception:
+            await run_in_threadpool(self._release, key, token)
+            raise
+        resp_body = b"".join(captured["body"])
+        if captured["status"] >= 500 or captured["status"] in IDEMPOTENCY_TRANSIENT_STATUSES:
+            await run_in_threadpool(self._release, key, token)
+            return
+        _idem_cache_put(key, fingerprint, captured["status"], captured["headers"], resp_body)
+        if token is None:
+            return
+        try:
+            await run_in_threadpool(_idem_db_complete, key, token, captured["status"], captured["headers"], resp_body)
+        except Exception as e:
+            print(f"=== DEBUG: idempotency store failed for {key}: {e} ===")
+
+    @staticmethod
+    def _release(key, token):
+        if token is None:
+            return
+        try:
+            _idem_db_release(key, token)
+        except Exception as e:
+            print(f"=== DEBUG: idempotency release failed for {key}: {e} ===")
+
+    @staticmethod
+    async def _send_json(send, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(data)).encode("ascii"))],
+        })
+        await send({"type": "http.response.body", "body": data})
+
+app.add_middleware(IdempotencyMiddleware)
+
+# Longest matching prefix wins; anything unlisted is interactive
+WORKLOAD_ROUTES: Dict[str, str] = {
+    "/export/": "batch",
+    "/stats/": "batch",
+    "/webhook/": "background",
+    "/log-event": "background",
+}
+
+def _route_workload(path: str) -> str:
+    best = ""
+    for prefix in WORKLOAD_ROUTES:
+        if path.startswith(prefix) and len(prefix) > len(best):
+            best = prefix
+    return WORKLOAD_ROUTES[best] if best else "interactive"
+
+class WorkloadMiddleware:
+    """Tags each request's Snowflake work with its route's workload class and times it per class."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        cls = _route_workload(scope.get("path", ""))
+        token = _workload.set(cls)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _workload.reset(token)
+            metric_observe(f"workload.{cls}.request", time.perf_counter() - started)
+
+app.add_middleware(WorkloadMiddleware)
+
+
+# ---------- Repository (named statements, compact row records) ----------
+# Records are namedtuples: tuple-sized, field names resolved once per type instead
+# of rebuilding a column list from cur.description per row. Each statement's
+# SELECT list is generated from its record's fields, so the mapping can't drift.
+DonorRecord = namedtuple("DonorRecord", (
+    "DONOR_ID", "TITLE", "FIRST_NAME", "MIDDLE_NAME", "LAST_NAME", "DOB_DATE", "MOBILE_E164", "EMAIL",
+    "ADDRESS1", "ADDRESS2", "CITY", "REGION", "POSTAL_CODE", "COUNTRY",
+))
+SessionRecord = namedtuple("SessionRecord", (
+    "SESSION_ID", "FUNDRAISER_ID", "CHARITY_ID", "CAMPAIGN_ID", "STATE", "DEVICE_ID", "CREATED_AT",
+))
+FundraiserRecord = namedtuple("FundraiserRecord", (
+    "FUNDRAISER_ID", "DISPLAY_NAME", "EMAIL", "ACTIVE", "CHARITY_ID", "CAMPAIGN_ID",
+))
+CharityRecord = namedtuple("CharityRecord", (
+    "CHARITY_ID", "NAME", "BRAND_PRIMARY_HEX", "LOGO_URL", "BLURB", "TERMS_URL", "COUNTRY",
+))
+CampaignRecord = namedtuple("CampaignRecord", (
+    "CAMPAIGN_ID", "CHARITY_ID", "NAME", "START_DATE", "END_DATE", "MONTHLY_DEFAULT", "PRESET_AMOUNTS",
+    "MIN_AMOUNT", "CURRENCY",
+))
+ProductRecord = namedtuple("ProductRecord", (
+    "PRODUCT_ID", "CAMPAIGN_ID", "PRODUCT_TYPE", "AMOUNT_CENTS", "CURRENCY", "DISPLAY_NAME",
+    "STRIPE_PRICE_ID", "ACTIVE",
+))
+VerificationRecord = namedtuple("VerificationRecord", (
+    "VERIF_ID", "SESSION_ID", "DONOR_ID", "SENT_TS", "INBOUND_TS", "INBOUND_BODY", "RESULT",
+    "TWILIO_MSG_SID", "MOBILE_E164", "DELIVERY_STATUS", "DELIVERY_ERROR_CODE",
+))
+
+class Statement:
+    __slots__ = ("name", "sql", "record", "id_column")
+
+    def __init__(self, name: str, sql: str, record, id_column: Optional[str]):
+        self.name = name
+        self.sql = sql
+        self.record = record
+        self.id_column = id_column
+
+# name -> Statement; `{cols}` expands to the record's columns, `{ids}` to an IN-list (batch statements)
+STATEMENTS: Dict[str, Statement] = {}
+REPO_BATCH_MAX = 1000   # Snowflake caps IN-lists well above this; keeps statements small
+
+def statement(name: str, sql: str, record=None, id_column: Optional[str] = None):
+    if record is not None:
+        sql = sql.replace("{cols}", ", ".join(record._fields))
+    STATEMENTS[name] = Statement(name, sql, record, id_column)
+
+def _repo_exec(cur, stmt: Statement, params):
+    metric_inc(f"repo.{stmt.name}")
+    return cur.execute(stmt.sql, params)
+
+def repo_one(cur, name: str, params=()):
+    stmt = STATEMENTS[name]
+    row = _repo_exec(cur, stmt, params).fetchone()
+    if row is None:
+        return None
+    return stmt.record._make(row) if stmt.record else row
+
+def repo_all(cur, name: str, params=()) -> list:
+    stmt = STATEMENTS[name]
+    rows = _repo_exec(cur, stmt, params).fetchall()
+    return list(map(stmt.record._make, rows)) if stmt.record else rows
+
+def _in_list_size(n: int) -> int:
+    # Round up to a power of two so a handful of statement shapes cover every batch size
+    size = 1
+    while size < n:
+        size <<= 1
+    return min(size, REPO_BATCH_MAX)
+
+def repo_by_ids(cur, name: str, ids, params: tuple = ()) -> Dict[Any, Any]:
+    """Batch variant: id -> record for a `{ids}` statement, in chunks of REPO_BATCH_MAX; params follow the ids."""
+    stmt = STATEMENTS[name]
+    unique = list(dict.fromkeys(i for i in ids if i is not None))
+    id_pos = stmt.record._fields.index(stmt.id_column)
+    out: Dict[Any, Any] = {}
+    for start in range(0, len(unique), REPO_BATCH_MAX):
+        chunk = unique[start:start + REPO_BATCH_MAX]
+        size = _in_list_size(len(chunk))
+        padded = chunk + [chunk[-1]] * (size - len(chunk))
+        sql = stmt.sql.replace("{ids}", ", ".join(["%s"] * size))
+        metric_inc(f"repo.{stmt.name}")
+        for row in cur.execute(sql, tuple(padded) + tuple(params)).fetchall():
+            out[row[id_pos]] = stmt.record._make(row)
+    return out
+
+statement("donor.by_id", "SELECT {cols} FROM DONOR WHERE DONOR_ID = %s", DonorRecord)
+statement("donor.by_ids", "SELECT {cols} FROM DONOR WHERE DONOR_ID IN ({ids})", DonorRecord, "DONOR_ID")
+statement("donor.id_by_email", "SELECT DONOR_ID FROM DONOR WHERE EMAIL = %s")
+statement("session.by_id", "SELECT {cols} FROM SESSION WHERE SESSION_ID = %s", SessionRecord)
+statement("session.by_ids", "SELECT {cols} FROM SESSION WHERE SESSION_ID IN ({ids})", SessionRecord, "SESSION_ID")
+statement("session.fundraiser",
+          "SELECT F.DISPLAY_NAME, S.FUNDRAISER_ID FROM SESSION S JOIN FUNDRAISER F ON F.FUNDRAISER_ID = S.FUNDRAISER_ID "
+          "WHERE S.SESSION_ID = %s")
+statement("fundraiser.active_by_id",
+          "SELECT {cols} FROM FUNDRAISER WHERE FUNDRAISER_ID = %s AND COALESCE(ACTIVE, TRUE) = TRUE",
+          FundraiserRecord)
+statement("fundraiser.all_active", "SELECT {cols} FROM FUNDRAISER WHERE COALESCE(ACTIVE, TRUE) = TRUE",
+          FundraiserRecord)
+statement("charity.by_id", "SELECT {cols} FROM CHARITY WHERE CHARITY_ID = %s", CharityRecord)
+statement("charity.by_ids", "SELECT {cols} FROM CHARITY WHERE CHARITY_ID IN ({ids})", CharityRecord, "CHARITY_ID")
+statement("charity.all", "SELECT {cols} FROM CHARITY", CharityRecord)
+statement("campaign.by_id", "SELECT {cols} FROM CAMPAIGN WHERE CAMPAIGN_ID = %s", CampaignRecord)
+statement("campaign.by_ids", "SELECT {cols} FROM CAMPAIGN WHERE CAMPAIGN_ID IN ({ids})", CampaignRecord,
+          "CAMPAIGN_ID")
+statement("campaign.all", "SELECT {cols} FROM CAMPAIGN", CampaignRecord)
+statement("product.active_by_campaign",
+          "SELECT {cols} FROM PRODUCT WHERE CAMPAIGN_ID = %s AND ACTIVE = TRUE ORDER BY PRODUCT_TYPE, AMOUNT_CENTS",
+          ProductRecord)
+statement("product.all_active",
+          "SELECT {cols} FROM PRODUCT WHERE ACTIVE = TRUE ORDER BY CAMPAIGN_ID, PRODUCT_TYPE, AMOUNT_CENTS",
+          ProductRecord)
+statement("product.lookup",
+          "SELECT {cols} FROM PRODUCT WHERE CAMPAIGN_ID = %s AND AMOUNT_CENTS = %s AND UPPER(CURRENCY) = UPPER(%s) "
+          "AND UPPER(PRODUCT_TYPE) = UPPER(%s) AND ACTIVE = TRUE LIMIT 1",
+          ProductRecord)
+statement("verification.latest_for_session_donor",
+          "SELECT {cols} FROM VERIFICATION_SMS WHERE SESSION_ID = %s AND DONOR_ID = %s ORDER BY SENT_TS DESC LIMIT 1",
+          VerificationRecord)
+
+def product_out(p: ProductRecord) -> Dict[str, Any]:
+    """API/snapshot shape for a product (lower-case keys)."""
+    return {
+        "product_id": p.PRODUCT_ID,
+        "product_type": p.PRODUCT_TYPE,
+        "amount_cents": int(p.AMOUNT_CENTS) if p.AMOUNT_CENTS else 0,
+        "currency": p.CURRENCY,
+        "display_name": p.DISPLAY_NAME,
+        "stripe_price_id": p.STRIPE_PRICE_ID,
+        "active": bool(p.ACTIVE),
+    }
+
+# ---------- Reference snapshot (local SQLite file, mmap'd, shared by workers) ----------
+REF_SNAPSHOT_PATH = os.getenv("REF_SNAPSHOT_PATH", "ref_snapshot.sqlite")
+REF_SNAPSHOT_RECONCILE_SEC = int(os.getenv("REF_SNAPSHOT_RECONCILE_SEC", "60"))
+REF_SNAPSHOT_MMAP_BYTES = int(os.getenv("REF_SNAPSHOT_MMAP_BYTES", str(64 * 1024 * 1024)))
+REF_SNAPSHOT_TABLES = ("FUNDRAISER", "CHARITY", "CAMPAIGN", "PRODUCT")
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX: exporters just don't coordinate
+    fcntl = None
+
+def _ref_last_altered(cur) -> Dict[str, str]:
+    """Snowflake's own change timestamps for the reference tables."""
+    rows = cur.execute(
+        f"""
+        SELECT TABLE_NAME, LAST_ALTERED
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ({", ".join(["%s"] * len(REF_SNAPSHOT_TABLES))})
+        """,
+        (SNOW_SCHEMA, *REF_SNAPSHOT_TABLES),
+    ).fetchall()
+    return {name: (ts.isoformat() if hasattr(ts, "isoformat") else str(ts)) for name, ts in rows}
+
+def export_reference_snapshot(path: str = REF_SNAPSHOT_PATH) -> Dict[str, str]:
+    """
+    Writes FUNDRAISER/CHARITY/CAMPAIGN/PRODUCT into a fresh SQLite file and atomically
+    swaps it in. Readers holding the old file keep working until they notice the swap.
+    """
+    started = time.time()
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        last_altered = _ref_last_altered(cur)
+        fundraisers = [r._asdict() for r in repo_all(cur, "fundraiser.all_active")]
+        charities = [r._asdict() for r in repo_all(cur, "charity.all")]
+        campaigns = [r._asdict() for r in repo_all(cur, "campaign.all")]
+        products: Dict[str, list] = {}
+        for p in repo_all(cur, "product.all_active"):
+            products.setdefault(p.CAMPAIGN_ID, []).append(product_out(p))
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute("CREATE TABLE REF (KIND TEXT NOT NULL, KEY TEXT NOT NULL, DATA TEXT NOT NULL, PRIMARY KEY (KIND, KEY)) WITHOUT ROWID")
+        db.execute("CREATE TABLE META (KEY TEXT PRIMARY KEY, VALUE TEXT)")
+        dumps = lambda o: json.dumps(o, default=_json_default, separators=(",", ":"))
+        db.executemany("INSERT INTO REF VALUES ('FUNDRAISER', ?, ?)", [(r["FUNDRAISER_ID"], dumps(r)) for r in fundraisers])
+        db.executemany("INSERT INTO REF VALUES ('CHARITY', ?, ?)", [(r["CHARITY_ID"], dumps(r)) for r in charities])
+        db.executemany("INSERT INTO REF VALUES ('CAMPAIGN', ?, ?)", [(r["CAMPAIGN_ID"], dumps(r)) for r in campaigns])
+        db.executemany("INSERT INTO REF VALUES ('PRODUCTS', ?, ?)", [(k, dumps(v)) for k, v in products.items()])
+        db.executemany("INSERT INTO META VALUES (?, ?)", [
+            ("exported_at", datetime.now(timezone.utc).isoformat()),
+            ("last_altered", json.dumps(last_altered, sort_keys=True)),
+        ])
+        db.commit()
+    except Exception:
+        db.close()
+        os.unlink(tmp_path)
+        raise
+    db.close()
+    os.replace(tmp_path, path)
+    metric_observe("ref_snapshot.export", time.time() - started)
+    print(f"=== DEBUG: reference snapshot exported to {path} in {time.time() - started:.2f}s ===")
+    return last_altered
+
+class RefSnapshot:
+    """
+    Read-only view over the snapshot file. Each thread keeps its own SQLite
+    connection; the file is re-opened when an exporter swaps in a new one.
+    """
+
+    _CHECK_EVERY_SEC = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._ident = None
+        self._checked_at = 0.0
+
+    def _file_ident(self):
+        now = time.time()
+        if now - self._checked_at >= self._CHECK_EVERY_SEC:
+            self._checked_at = now
+            try:
+                st = os.stat(self.path)
+                self._ident = (st.st_ino, st.st_mtime_ns)
+            except FileNotFoundError:
+                self._ident = None
+        return self._ident
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        ident = self._file_ident()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.ident == ident:
+            return conn
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+        if ident is None:
+            return None
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={REF_SNAPSHOT_MMAP_BYTES}")
+        self._local.conn, self._local.ident = conn, ident
+        return conn
+
+    def get(self, kind: str, key: str):
+        try:
+            conn = self._conn()
+            if conn is None:
+                return None
+            row = conn.execute("SELECT DATA FROM REF WHERE KIND = ? AND KEY = ?", (kind, key)).fetchone()
+        except sqlite3.Error as e:
+            print(f"=== DEBUG: reference snapshot read failed: {e} ===")
+            return None
+        metric_inc("ref_snapshot.hit" if row else "ref_snapshot.miss")
+        return json.loads(row[0]) if row else None
+
+    def meta(self, key: str) -> Optional[str]:
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT VALUE FROM META WHERE KEY = ?", (key,)).fetchone() if conn else None
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+ref_snapshot = RefSnapshot(REF_SNAPSHOT_PATH)
+
+def _ref_snapshot_reconcile_once():
+    """Re-exports when Snowflake reports a newer change than the snapshot holds."""
+    lock_f = open(f"{REF_SNAPSHOT_PATH}.lock", "a")
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # another worker is exporting
+        current = json.loads(ref_snapshot.meta("last_altered") or "{}")
+        ctx = get_snowflake_ctx()
+        try:
+            cur = ctx.cursor()
+            latest = _ref_last_altered(cur)
+        finally:
+            try: cur.close()
+            except Exception: pass
+            ctx.close()
+        if latest != current:
+            export_reference_snapshot(REF_SNAPSHOT_PATH)
+    finally:
+        lock_f.close()
+
+def _ref_snapshot_loop():
+    while True:
+        try:
+            _ref_snapshot_reconcile_once()
+        except Exception as e:
+            metric_inc("ref_snapshot.reconcile_error")
+            print(f"=== DEBUG: reference snapshot reconcile failed: {e} ===")
+        time.sleep(REF_SNAPSHOT_RECONCILE_SEC)
+
+@app.on_event("startup")
+def _start_ref_snapshot():
+    exported_at = ref_snapshot.meta("exported_at")
+    print(f"=== DEBUG: reference snapshot {REF_SNAPSHOT_PATH} exported_at={exported_at} ===")
+    # The local backend is already an embedded file; nothing to snapshot
+    if REF_SNAPSHOT_RECONCILE_SEC > 0 and storage.name == "snowflake":
+        threading.Thread(target=run_as_workload("batch", _ref_snapshot_loop), name="ref-snapshot", daemon=True).start()
+
+class _LazyCursor:
+    """Cursor stand-in that only opens a Snowflake connection if a query actually runs."""
+
+    def __init__(self):
+        self._ctx = None
+        self._cur = None
+
+    def __getattr__(self, name):
+        if self._cur is None:
+            self._ctx = get_snowflake_ctx()
+            self._cur = self._ctx.cursor()
+        return getattr(self._cur, name)
+
+    def close(self):
+        if self._cur is not None:
+            try: self._cur.close()
+            except Exception: pass
+            self._ctx.close()
+
+# ---------- Reference reads (single-flight) ----------
+_sf_fundraiser = SingleFlight("fundraiser")
+_sf_charity = SingleFlight("charity")
+_sf_campaign = SingleFlight("campaign")
+_sf_products = SingleFlight("products")
+_sf_presign = SingleFlight("presign")
+
+def _read_fundraiser(cur, fundraiser_id: str) -> Optional[Dict[str, Any]]:
+    snap = ref_snapshot.get("FUNDRAISER", fundraiser_id)
+    if snap is not None:
+        return snap
+    row = _sf_fundraiser.do(fundraiser_id, lambda: repo_one(cur, "fundraiser.active_by_id", (fundraiser_id,)))
+    return row._asdict() if row else None
+
+def _read_presigned(cur, stage_uri: str, expires_sec: int = 3600) -> Optional[str]:
+    return _sf_presign.do((stage_uri, expires_sec), lambda: presign_stage_url(cur, stage_uri, expires_sec=expires_sec))
+
+def _read_charity_raw(cur, charity_id: str) -> Optional[Dict[str, Any]]:
+    snap = ref_snapshot.get("CHARITY", charity_id)
+    if snap is not None:
+        return snap
+    row = _sf_charity.do(charity_id, lambda: repo_one(cur, "charity.by_id", (charity_id,)))
+    return row._asdict() if row else None
+
+def _read_charity(cur, charity_id: str) -> Optional[Dict[str, Any]]:
+    """CHARITY row with a stage LOGO_URL replaced by a presigned URL when possible."""
+    charity = _read_charity_raw(cur, charity_id)
+    if charity and (charity.get("LOGO_URL") or "").startswith("@"):
+        try:
+            presigned = _read_presigned(cur, charity["LOGO_URL"], expires_sec=3600)
+            if presigned:
+                charity["LOGO_URL"] = presigned
+            else:
+                print(f"=== DEBUG: Presign returned None, keeping original: {charity['LOGO_URL']} ===")
+        except Exception as e:
+            # Don't crash login if presign fails; just leave the original value
+            print(f"=== DEBUG: Presign failed with error: {e} ===")
+    return charity
+
+def _read_campaign(cur, campaign_id: str) -> Optional[Dict[str, Any]]:
+    snap = ref_snapshot.get("CAMPAIGN", campaign_id)
+    if snap is not None:
+        return snap
+    row = _sf_campaign.do(campaign_id, lambda: repo_one(cur, "campaign.by_id", (campaign_id,)))
+    return row._asdict() if row else None
+
+def _read_campaign_products(cur, campaign_id: str) -> list:
+    snap = ref_snapshot.get("PRODUCTS", campaign_id)
+    if snap is not None:
+        return snap
+    # Records are immutable and shared by coalesced callers; callers get their own dicts
+    records = _sf_products.do(campaign_id, lambda: repo_all(cur, "product.active_by_campaign", (campaign_id,)))
+    return [product_out(p) for p in records]
+
+
+# ---------- Sync bundle (tablet reference data, ETag/304) ----------
+SYNC_BUNDLE_VERSION = 1
+SYNC_BUNDLE_TTL_SEC = int(os.getenv("SYNC_BUNDLE_TTL_SEC", "300"))
+SYNC_BUNDLE_MAX_ENTRIES = int(os.getenv("SYNC_BUNDLE_MAX_ENTRIES", "2000"))
+
+# (campaign_id, fundraiser_id) -> (expires_at, etag, body_bytes), least recently used first
+_sync_bundles: "OrderedDict[Tuple[str, Optional[str]], Tuple[float, str, bytes]]" = OrderedDict()
+_sync_bundles_lock = threading.Lock()
+_sf_bundle = SingleFlight("sync_bundle")
+
+def _compact(d: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if d is None:
+        return None
+    return {k.lower(): v for k, v in d.items() if v is not None}
+
+def _build_sync_bundle(campaign_id: str, fundraiser_id: Optional[str]) -> Tuple[str, bytes]:
+    cur = _LazyCursor()
+    try:
+        campaign = _read_campaign(cur, campaign_id)
+        if not campaign:
+            raise HTTPException(status_code=404, detail="Campaign not found")
+        charity = _read_charity_raw(cur, campaign["CHARITY_ID"]) if campaign.get("CHARITY_ID") else None
+        products = _read_campaign_products(cur, campaign_id)
+        fundraiser = _read_fundraiser(cur, fundraiser_id) if fundraiser_id else None
+        if fundraiser_id and not fundraiser:
+            raise HTTPException(status_code=404, detail="Fundraiser not found or inactive")
+    finally:
+        cur.close()
+
+    charity = _compact(charity)
+    # Presigned URLs expire, so they must not be part of the cached/ETagged document;
+    # the tablet follows /sync/logo/{charity_id} for a fresh one instead.
+    if charity and str(charity.get("logo_url", "")).startswith("@"):
+        charity["logo_url"] = f"/sync/logo/{charity['charity_id']}"
+    doc = {
+        "v": SYNC_BUNDLE_VERSION,
+        "campaign": _compact(campaign),
+        "charity": charity,
+        "products": [
+            {k: v for k, v in p.items() if v is not None and k != "active"} for p in products
+        ],
+    }
+    if fundraiser:
+        doc["fundraiser"] = _compact(fundraiser)
+    body = json.dumps(doc, default=_json_default, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return etag, body
+
+def _get_sync_bundle(campaign_id: str, fundraiser_id: Optional[str]) -> Tuple[str, bytes]:
+    key = (campaign_id, fundraiser_id)
+    with _sync_bundles_lock:
+        hit = _sync_bundles.get(key)
+        if hit:
+            _sync_bundles.move_to_end(key)
+    if hit and hit[0] > time.time():
+        metric_inc("sync_bundle.cache_hit")
+        return hit[1], hit[2]
+    metric_inc("sync_bundle.cache_miss")
+    etag, body = _sf_bundle.do(key, lambda: _build_sync_bundle(campaign_id, fundraiser_id))
+    with _sync_bundles_lock:
+        _sync_bundles[key] = (time.time() + SYNC_BUNDLE_TTL_SEC, etag, body)
+        _sync_bundles.move_to_end(key)
+        while len(_sync_bundles) > SYNC_BUNDLE_MAX_ENTRIES:
+            _sync_bundles.popitem(last=False)
+    return etag, body
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+@app.get("/local-blob/{stage}/{path:path}")
+def local_blob(stage: str, path: str, exp: int = 0, sig: str = ""):
+    """Serves presigned URLs minted by the local storage backend."""
+    if storage.name != "local":
+        raise HTTPException(status_code=404, detail="Not found")
+    data = storage.read_blob(stage, path, exp, sig)
+    if data is None:
+        raise HTTPException(status_code=403, detail="Invalid or expired blob URL")
+    media_type = "image/png" if path.endswith(".png") else "application/octet-stream"
+    return Response(content=data, media_type=media_type, headers={"Cache-Control": "private, max-age=300"})
+
+
+# ---------- Dependency probes (background, cached) ----------
+PROBE_INTERVAL_SEC = float(os.getenv("PROBE_INTERVAL_SEC", "30"))
+# A dependency counts as down once its last success is older than this
+PROBE_STALE_SEC = float(os.getenv("PROBE_STALE_SEC", str(3 * PROBE_INTERVAL_SEC)))
+READY_REQUIRED_PROBES = [p.strip() for p in os.getenv("READY_REQUIRED_PROBES", "snowflake").split(",") if p.strip()]
+
+class DependencyProbe:
+    """
+    Runs fn every interval_sec on its own thread and keeps the last outcome, so
+    /readyz never calls a dependency itself. fn returns a detail dict, or None
+    when the dependency is not configured.
+    """
+
+    def __init__(self, name: str, fn, interval_sec: float = PROBE_INTERVAL_SEC):
+        self.name = name
+        self.fn = fn
+        self.interval_sec = interval_sec
+        self._lock = threading.Lock()
+        self._state: Dict[str, Any] = {"status": "PENDING"}
+        self._last_success_mono: Optional[float] = None
+
+    def run_once(self):
+        started = time.monotonic()
+        try:
+            detail = self.fn()
+            status, error = ("NOT_CONFIGURED" if detail is None else "UP"), None
+        except Exception as e:
+            detail, status, error = None, "DOWN", str(e)
+        latency = time.monotonic() - started
+        metric_observe(f"probe.{self.name}", latency)
+        if status == "DOWN":
+            metric_inc(f"probe.{self.name}.failure")
+        now_iso = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._state.update({
+                "status": status,
+                "checked_at": now_iso,
+                "latency_ms": round(latency * 1000, 1),
+                "error": error,
+            })
+            if status == "UP":
+                self._state["last_success"] = now_iso
+                self._state["detail"] = detail
+                self._last_success_mono = time.monotonic()
+
+    def loop(self):
+        while True:
+            self.run_once()
+            time.sleep(self.interval_sec)
+
+    def healthy(self) -> bool:
+        with self._lock:
+            if self._state["status"] == "NOT_CONFIGURED":
+                return True
+            return (self._last_success_mono is not None
+                    and time.monotonic() - self._last_success_mono <= PROBE_STALE_SEC)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._state)
+
+def _probe_snowflake():
+    # Context functions run in cloud services, so this doesn't resume the warehouse
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        who = cur.execute(
+            "SELECT CURRENT_USER(), CURRENT_ROLE(), CURRENT_WAREHOUSE(), CURRENT_DATABASE(), CURRENT_SCHEMA()"
+        ).fetchone()
+        return {"user": who[0], "role": who[1], "wh": who[2], "db": who[3], "schema": who[4]}
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+def _probe_stripe():
+    if not stripe.api_key:
+        return None
+    bal = stripe.Balance.retrieve()
+    return {"livemode": bal.get("livemode")}
+
+def _probe_twilio():
+    twilio_client = get_twilio_client()
+    if not twilio_client:
+        return None
+    acct = twilio_client.api.accounts(TWILIO_ACCOUNT_SID).fetch()
+    return {"status": acct.status}
+
+dependency_probes: Dict[str, DependencyProbe] = {
+    "snowflake": DependencyProbe("snowflake", _probe_snowflake),
+    "stripe": DependencyProbe("stripe", _probe_stripe),
+    "twilio": DependencyProbe("twilio", _probe_twilio),
+}
+
+# ---------- Startup warm-up ----------
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+
+_startup_state: Dict[str, Any] = {"complete": False, "phases": {}}
+
+def _warmup_phase(name: str, fn):
+    started = time.perf_counter()
+    try:
+        fn()
+        error = None
+    except Exception as e:
+        error = str(e)
+        print(f"=== DEBUG: warm-up phase {name} failed: {e} ===")
+    elapsed = time.perf_counter() - started
+    metric_observe(f"startup.{name}", elapsed)
+    _startup_state["phases"][name] = {"ms": round(elapsed * 1000, 1), "error": error}
+
+def _warmup_imports():
+    for module in (stripe, sf, serialization, _twilio_rest, _twilio_request_validator):
+        module._load()
+
+def _warmup_snowflake():
+    if storage.name != "snowflake":
+        _warmup_phase("local_storage", lambda: storage.connect().cursor().execute("SELECT 1").fetchone())
+        return
+    _warmup_phase("snowflake_pool", lambda: snowflake_pool.prefill(SNOW_POOL_MIN))
+
+    def resume():
+        ctx = get_snowflake_ctx()
+        try:
+            cur = ctx.cursor()
+            cur.execute(f"ALTER WAREHOUSE IF EXISTS {SNOW_WAREHOUSE} RESUME IF SUSPENDED")
+        finally:
+            try: cur.close()
+            except Exception: pass
+            ctx.close()
+    _warmup_phase("warehouse_resume", resume)
+
+def _warmup_stripe():
+    # First real request opens the TLS session to api.stripe.com
+    if stripe.api_key:
+        stripe.Balance.retrieve()
+
+def _warmup_twilio():
+    client = get_twilio_client()
+    if client:
+        client.api.accounts(TWILIO_ACCOUNT_SID).fetch()
+
+def run_warmup():
+    """
+    Imports the SDKs, fills the Snowflake pool, resumes the warehouse and primes
+    the Stripe/Twilio HTTP sessions; /readyz stays 503 until this returns.
+    """
+    started = time.perf_counter()
+    _warmup_phase("imports", _warmup_imports)
+    threads = [
+        threading.Thread(target=_warmup_snowflake, name="warmup-snowflake"),
+        threading.Thread(target=lambda: _warmup_phase("stripe_session", _warmup_stripe), name="warmup-stripe"),
+        threading.Thread(target=lambda: _warmup_phase("twilio_session", _warmup_twilio), name="warmup-twilio"),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    _startup_state["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    _startup_state["process_to_ready_ms"] = round((time.perf_counter() - _PROCESS_STARTED) * 1000, 1)
+    _startup_state["complete"] = True
+    print(f"=== DEBUG: warm-up complete: {_startup_state} ===")
+
+@app.on_event("startup")
+def _start_warmup():
+    if WARMUP_ENABLED:
+        threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
+    else:
+        _startup_state["complete"] = True
+
+@app.on_event("startup")
+def _start_dependency_probes():
+    for probe in dependency_probes.values():
+        threading.Thread(target=probe.loop, name=f"probe-{probe.name}", daemon=True).start()
+
+
+# ---------- Routes ----------
+@app.get("/livez")
+def livez():
+    """Process is up and serving; touches no dependencies."""
+    return {"ok": True}
+
+@app.get("/readyz")
+def readyz():
+    probes = {name: p.snapshot() for name, p in dependency_probes.items()}
+    failing = [name for name in READY_REQUIRED_PROBES
+               if name in dependency_probes and not dependency_probes[name].healthy()]
+    if not _startup_state["complete"]:
+        failing.append("warmup")
+    body = {"ready": not failing, "failing": failing, "probes": probes, "startup": _startup_state}
+    return JSONResponse(body, status_code=200 if not failing else 503)
+
+@app.get("/healthz")
+def healthz():
+    probe = dependency_probes["snowflake"].snapshot()
+    ok = dependency_probes["snowflake"].healthy()
+    body = {
+        "ok": ok,
+        "snowflake": probe.get("detail"),
+        "checked_at": probe.get("checked_at"),
+    }
+    return JSONResponse(body, status_code=200 if ok else 503)
+
+@app.get("/metrics")
+def metrics():
+    snap = metrics_snapshot()
+    snap["singleflight"] = singleflight_stats()
+    snap["http_pools"] = http_pool_stats()
+    snap["sms_queue_depth"] = sms_queue.depth()
+    snap["pending_verifications"] = len(pending_verifications)
+    snap["write_journal"] = write_journal.stats()
+    snap["snowflake_pools"] = workload_pool_stats()
+    snap["rate_limits"] = rate_limiter.stats() if rate_limiter else None
+    snap["async_writes"] = async_writes.stats()
+    return snap
+
+@app.post("/log-event")
+def log_event(ev: LogEventIn, request: Request):
+    enforce_rate_limit("log_event", request, fundraiser=ev.fundraiser_id)
+    if is_server_event_type(ev.event_type):
+        raise HTTPException(status_code=400, detail=f"event_type {ev.event_type} is reserved for server events")
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        event_id = insert_event(cur, ev)
+        return {"ok": True, "event_id": event_id}
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+# ---------- SMS: outbound queue (per-sender rate limits, retries) ----------
+SMS_WORKERS = int(os.getenv("SMS_WORKERS", "4"))
+SMS_QUEUE_MAX = int(os.getenv("SMS_QUEUE_MAX", "500"))
+SMS_RATE_PER_SENDER = float(os.getenv("SMS_RATE_PER_SENDER", "1"))            # long code: ~1 msg/sec
+SMS_RATE_PER_SERVICE = float(os.getenv("SMS_RATE_PER_SERVICE", "10"))         # messaging service pool
+SMS_MAX_ATTEMPTS = int(os.getenv("SMS_MAX_ATTEMPTS", "5"))
+SMS_SEND_WAIT_SEC = float(os.getenv("SMS_SEND_WAIT_SEC", "10"))
+TWILIO_STATUS_CALLBACK_URL = os.getenv("TWILIO_STATUS_CALLBACK_URL", "")
+
+class QueueFull(Exception):
+    pass
+
+class SmsOutcomeUnknown(Exception):
+    """The send may have reached Twilio (e.g. read timeout): resending could text the donor twice."""
+
+def _sms_never_sent(e: Exception) -> bool:
+    """True when the request failed before reaching Twilio (connect error/timeout), so resending is safe."""
+    rexc = importlib.import_module("requests.exceptions")
+    if isinstance(e, rexc.ConnectTimeout):
+        return True
+    if isinstance(e, rexc.ConnectionError):
+        reason = e.args[0] if e.args else None
+        reason = getattr(reason, "reason", reason)   # MaxRetryError wraps the urllib3 error
+        return isinstance(reason, importlib.import_module("urllib3.exceptions").ConnectTimeoutError)
+    return False
+
+class _SmsJob:
+    __slots__ = ("msg_kwargs", "on_sent", "on_failed", "future", "attempts", "enqueued_at")
+
+    def __init__(self, msg_kwargs: Dict[str, Any], on_sent: Callable, on_failed: Optional[Callable] = None):
+        self.msg_kwargs = msg_kwargs
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.future: Future = Future()
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+class OutboundSmsQueue:
+    """
+    Bounded queue of Twilio sends drained by a small worker pool. Each sender
+    (messaging service or from-number) has its own TokenBucket; a job whose
+    sender is out of tokens, or that got a 429/5xx, goes back on the heap with a
+    not-before time instead of blocking a worker. Errors after the request may have
+    reached Twilio (read timeouts, dropped connections) are never resent.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._heap: List[Tuple[float, int, _SmsJob]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._started = False
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=run_as_workload("background", self._worker), name=f"sms-{i}", daemon=True).start()
+
+    def submit(self, msg_kwargs: Dict[str, Any], on_sent: Callable, on_failed: Optional[Callable] = None) -> Future:
+        job = _SmsJob(msg_kwargs, on_sent, on_failed)
+        with self._cond:
+            if len(self._heap) >= self.max_pending:
+                metric_inc("sms.queue_full")
+                raise QueueFull()
+            self._push(job, 0.0)
+            metric_set("sms.queue_depth", len(self._heap))
+        self.start()
+        return job.future
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def _push(self, job: _SmsJob, not_before: float):
+        heapq.heappush(self._heap, (not_before, next(self._seq), job))
+        self._cond.notify()
+
+    def _requeue(self, job: _SmsJob, delay: float):
+        with self._cond:
+            self._push(job, time.monotonic() + delay)
+
+    def _bucket(self, msg_kwargs: Dict[str, Any]) -> TokenBucket:
+        if msg_kwargs.get("messaging_service_sid"):
+            key, rate = f"ms:{msg_kwargs['messaging_service_sid']}", SMS_RATE_PER_SERVICE
+        else:
+            key, rate = f"from:{msg_kwargs.get('from_')}", SMS_RATE_PER_SENDER
+        with self._cond:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, capacity=max(rate, 1))
+            return bucket
+
+    def _next(self) -> _SmsJob:
+        with self._cond:
+            while True:
+                if self._heap:
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        job = heapq.heappop(self._heap)[2]
+                        metric_set("sms.queue_depth", len(self._heap))
+                        return job
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next()
+            wait = self._bucket(job.msg_kwargs).try_acquire()
+            if wait > 0:
+                self._requeue(job, wait)
+                continue
+            self._send(job)
+
+    def _send(self, job: _SmsJob):
+        job.attempts += 1
+        client = get_twilio_client()
+        try:
+            if not client:
+                raise RuntimeError("Twilio client not configured")
+            msg = client.messages.create(**job.msg_kwargs)
+        except Exception as e:
+            status = getattr(e, "status", None)
+            never_sent = _sms_never_sent(e)
+            retryable = (status == 429 or status >= 500) if isinstance(status, int) else never_sent
+            if retryable and job.attempts < SMS_MAX_ATTEMPTS:
+                metric_inc("sms.retries")
+                if status == 429:
+                    metric_inc("sms.throttled")
+                self._requeue(job, min(30.0, 2 ** job.attempts) * (0.5 + random.random()))
+                return
+            if status is None and client and not never_sent:
+                metric_inc("sms.outcome_unknown")
+                e = SmsOutcomeUnknown(f"Twilio outcome unknown: {e!r}")
+            else:
+                metric_inc("sms.failed")
+            if job.on_failed:
+                try:
+                    job.on_failed(e)
+                except Exception as cb_err:
+                    print(f"=== DEBUG: sms on_failed failed: {cb_err} ===")
+            job.future.set_exception(e)
+            return
+        metric_inc("sms.sent")
+        metric_observe("sms.queue_wait", time.monotonic() - job.enqueued_at)
+        try:
+            job.on_sent(msg)
+        except Exception as e:
+            print(f"=== DEBUG: sms on_sent failed for {msg.sid}: {e} ===")
+        job.future.set_result(msg)
+
+sms_queue = OutboundSmsQueue(SMS_WORKERS, SMS_QUEUE_MAX)
+
+# ---------- SMS: delivery receipts (Twilio StatusCallback) ----------
+SMS_RECEIPT_FLUSH_SEC = float(os.getenv("SMS_RECEIPT_FLUSH_SEC", "2"))
+SMS_RECEIPT_BATCH = int(os.getenv("SMS_RECEIPT_BATCH", "200"))
+SMS_RECEIPT_MAX_RETRIES = 5   # flushes to wait for the VERIFICATION_SMS row to appear
+SMS_DELIVERY_DDL = """
+ALTER TABLE VERIFICATION_SMS ADD COLUMN IF NOT EXISTS
+    DELIVERY_STATUS STRING,
+    DELIVERY_ERROR_CODE STRING,
+    DELIVERY_TS TIMESTAMP_NTZ
+"""
+# Later states win; receipts can arrive out of order
+SMS_STATUS_RANK = {"accepted": 0, "queued": 1, "sending": 2, "sent": 3,
+                   "delivered": 4, "undelivered": 4, "failed": 4, "read": 5}
+SMS_UNDELIVERED = ("undelivered", "failed")
+
+_sms_receipts_lock = threading.Lock()
+_sms_receipts: Dict[str, Tuple[str, Optional[str], int]] = {}   # sid -> (status, error_code, flush attempts)
+_sms_receipts_wake = threading.Event()
+_sms_receipt_flusher_started = False
+
+def _sms_receipt_put(sid: str, status: str, error_code: Optional[str], attempts: int = 0):
+    with _sms_receipts_lock:
+        prev = _sms_receipts.get(sid)
+        if prev and SMS_STATUS_RANK.get(prev[0], 0) > SMS_STATUS_RANK.get(status, 0):
+            return
+        _sms_receipts[sid] = (status, error_code, attempts)
+        if len(_sms_receipts) >= SMS_RECEIPT_BATCH:
+            _sms_receipts_wake.set()
+
+def _sms_receipts_flush_once():
+    with _sms_receipts_lock:
+        batch = dict(_sms_receipts)
+        _sms_receipts.clear()
+    if not batch:
+        return
+    rows = [(sid, status, code, SMS_STATUS_RANK.get(status, 0)) for sid, (status, code, _) in batch.items()]
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_table(cur, "VERIFICATION_SMS.delivery_columns", SMS_DELIVERY_DDL)
         cur.execute(
+            "CREATE OR REPLACE TEMPORARY TABLE SMS_RECEIPT_LOAD "
+            "(SID STRING, STATUS STRING, ERROR_CODE STRING, STATUS_RANK NUMBER)"
+        )
+        cur.executemany("INSERT INTO SMS_RECEIPT_LOAD VALUES (%s, %s, %s, %s)", rows)
+        cur.execute(
+            f"""
+            MERGE INTO VERIFICATION_SMS T USING SMS_RECEIPT_LOAD S ON T.TWILIO_MSG_SID = S.SID
+            WHEN MATCHED AND S.STATUS_RANK >= DECODE(T.DELIVERY_STATUS,
+                {", ".join(f"'{k}', {v}" for k, v in SMS_STATUS_RANK.items())}, -1)
+            THEN UPDATE SET DELIVERY_STATUS = S.STATUS, DELIVERY_ERROR_CODE = S.ERROR_CODE,
+                            DELIVERY_TS = CURRENT_TIMESTAMP()
             """
-            INSERT INTO VERIFICATION_SMS
-            (VERIF_ID, SESSION_ID, DONOR_ID, SENT_TS, MESSAGE_BODY,
-             INBOUND_TS, INBOUND_BODY, RESULT, TWILIO_MSG_SID, MOBILE_E164, TO_NUMBER)
-            SELECT %s, %s, %s, CURRENT_TIMESTAMP(), %s,
-                   NULL, NULL, NULL, %s, %s, %s
-            """,
-            (
-                f"tw-{msg.sid}",
-                payload.session_id,
-                payload.donor_id,
-                body,
-                msg.sid,
-                payload.to_e164,
-                getattr(msg, "from_", None),
-            ),
         )
+        # A callback can beat the worker's INSERT; hold those for the next flush
+        unmatched = cur.execute(
+            """
+            SELECT S.SID FROM SMS_RECEIPT_LOAD S
+            LEFT JOIN VERIFICATION_SMS V ON V.TWILIO_MSG_SID = S.SID
+            WHERE V.TWILIO_MSG_SID IS NULL
+            """
+        ).fetchall()
+    except Exception as e:
+        print(f"=== DEBUG: sms receipt flush failed ({len(batch)} held): {e} ===")
+        metric_inc("sms.receipt_flush_errors")
+        unmatched = [(sid,) for sid in batch]
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    metric_inc("sms.receipts_written", len(batch) - len(unmatched))
+    for (sid,) in unmatched:
+        status, code, attempts = batch[sid]
+        if attempts + 1 < SMS_RECEIPT_MAX_RETRIES:
+            _sms_receipt_put(sid, status, code, attempts + 1)
+        else:
+            metric_inc("sms.receipts_dropped")
+
+def _sms_receipts_loop():
+    while True:
+        _sms_receipts_wake.wait(SMS_RECEIPT_FLUSH_SEC)
+        _sms_receipts_wake.clear()
+        try:
+            _sms_receipts_flush_once()
+        except Exception as e:
+            print(f"=== DEBUG: sms receipt loop error: {e} ===")
+
+def _start_sms_receipt_flusher():
+    global _sms_receipt_flusher_started
+    with _sms_receipts_lock:
+        if _sms_receipt_flusher_started:
+            return
+        _sms_receipt_flusher_started = True
+    threading.Thread(target=run_as_workload("background", _sms_receipts_loop), name="sms-receipts", daemon=True).start()
+
+@app.on_event("startup")
+def _start_sms_workers():
+    sms_queue.start()
+    _start_sms_receipt_flusher()
+
+def _twilio_signature_ok(request: Request, form: Dict[str, Any]) -> bool:
+    twilio_validator = get_twilio_validator()
+    if not twilio_validator:
+        return True
+    signature = request.headers.get("X-Twilio-Signature")
+    return bool(signature) and twilio_validator.validate(str(request.url), form, signature)
+
+@app.post("/webhook/twilio/status")
+async def twilio_status(request: Request):
+    """Twilio StatusCallback: buffers the receipt; a background flusher MERGEs batches into VERIFICATION_SMS."""
+    form = dict((await request.form()).items())
+    if not _twilio_signature_ok(request, form):
+        raise HTTPException(status_code=403, detail="Invalid Twilio signature")
+    sid = form.get("MessageSid")
+    status = (form.get("MessageStatus") or form.get("SmsStatus") or "").lower()
+    if sid and status:
+        _sms_receipt_put(sid, status, form.get("ErrorCode") or None)
+        metric_inc(f"sms.status.{status}")
+    return PlainTextResponse("", status_code=204)
+
+# ---------- SMS: pending verifications (E.164 -> outstanding send) ----------
+VERIFICATION_PENDING_TTL_SEC = int(os.getenv("VERIFICATION_PENDING_TTL_SEC", "3600"))
+
+class PendingVerificationIndex:
+    """
+    The latest unanswered verification per mobile number, so an inbound reply is
+    matched with a dict lookup instead of scanning VERIFICATION_SMS. Entries
+    expire after VERIFICATION_PENDING_TTL_SEC; a reply after that is treated as
+    unsolicited, same as before when nothing matched.
+    """
+
+    def __init__(self, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self._entries: Dict[str, Tuple[float, str, Optional[str], Optional[str]]] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def put(self, e164: str, verif_id: str, session_id: Optional[str], donor_id: Optional[str],
+            sent_at: Optional[float] = None):
+        expires = (sent_at if sent_at is not None else time.time()) + self.ttl_sec
+        if expires <= time.time():
+            return
+        with self._lock:
+            prev = self._entries.get(e164)
+            if prev is None or prev[0] <= expires:
+                self._entries[e164] = (expires, verif_id, session_id, donor_id)
+            if len(self._entries) % 1024 == 0:
+                self._sweep_locked()
+
+    def pop(self, e164: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        with self._lock:
+            entry = self._entries.pop(e164, None)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1], entry[2], entry[3]
+
+    def _sweep_locked(self):
+        now = time.time()
+        for k in [k for k, v in self._entries.items() if v[0] <= now]:
+            del self._entries[k]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def rebuild(self):
+        """Reloads unanswered sends inside the TTL window (prunes on SENT_TS, not a history scan)."""
+        ctx = get_snowflake_ctx()
+        try:
+            cur = ctx.cursor()
+            rows = cur.execute(
+                """
+                SELECT MOBILE_E164, VERIF_ID, SESSION_ID, DONOR_ID, DATE_PART(EPOCH_SECOND, SENT_TS)
+                FROM VERIFICATION_SMS
+                WHERE INBOUND_TS IS NULL AND MOBILE_E164 IS NOT NULL
+                  AND SENT_TS >= DATEADD(second, %s, CURRENT_TIMESTAMP())
+                ORDER BY SENT_TS
+                """,
+                (-self.ttl_sec,),
+            ).fetchall()
+        finally:
+            try: cur.close()
+            except Exception: pass
+            ctx.close()
+        for e164, verif_id, session_id, donor_id, sent_epoch in rows:
+            self.put(e164, verif_id, session_id, donor_id, float(sent_epoch) if sent_epoch is not None else None)
+        self.loaded = True
+        print(f"=== DEBUG: pending verification index loaded {len(rows)} rows ===")
+
+pending_verifications = PendingVerificationIndex(VERIFICATION_PENDING_TTL_SEC)
+
+def _rebuild_pending_verifications():
+    try:
+        pending_verifications.rebuild()
+    except Exception as e:
+        print(f"=== DEBUG: pending verification rebuild failed: {e} ===")
+
+@app.on_event("startup")
+def _start_pending_verifications():
+    threading.Thread(target=run_as_workload("background", _rebuild_pending_verifications), name="pending-verifications", daemon=True).start()
+
+def _answer_verification(cur, verif_id: str, body: str, result: str, message_sid: Optional[str]) -> bool:
+    """Records the reply on verif_id unless that send was already answered; True if this reply took it."""
+    cur.execute(
+        """
+        UPDATE VERIFICATION_SMS
+        SET INBOUND_TS = CURRENT_TIMESTAMP(),
+            INBOUND_BODY = %s,
+            RESULT = %s,
+            TWILIO_MSG_SID = COALESCE(TWILIO_MSG_SID, %s)
+        WHERE VERIF_ID = %s AND INBOUND_TS IS NULL
+        """,
+        (body, result, message_sid, verif_id),
+    )
+    return (cur.rowcount or 0) > 0
+
+def _match_pending_verification(cur, from_num: str, body: str, result: str,
+                                message_sid: Optional[str]) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    Answers the sender's outstanding send and returns (verif_id, session_id, donor_id),
+    or None if there is none. The per-process index is only a hint: another worker may
+    have answered that row or sent a newer one, so a hint that updates nothing falls
+    back to the latest unanswered row in the DB.
+    """
+    hit = pending_verifications.pop(from_num)
+    if hit is not None:
+        if _answer_verification(cur, hit[0], body, result, message_sid):
+            metric_inc("sms.reply_match.index")
+            return hit
+        metric_inc("sms.reply_match.index_stale")
+    # Bounded lookup over the TTL window (SENT_TS prunes; no history scan); retried if
+    # a concurrent reply answers the row between the lookup and the update
+    for _ in range(3):
+        row = cur.execute(
+            """
+            SELECT VERIF_ID, SESSION_ID, DONOR_ID
+            FROM VERIFICATION_SMS
+            WHERE MOBILE_E164 = %s AND INBOUND_TS IS NULL
+              AND SENT_TS >= DATEADD(second, %s, CURRENT_TIMESTAMP())
+            ORDER BY SENT_TS DESC
+            LIMIT 1
+            """,
+            (from_num, -VERIFICATION_PENDING_TTL_SEC),
+        ).fetchone()
+        if not row:
+            return None
+        if _answer_verification(cur, row[0], body, result, message_sid):
+            metric_inc("sms.reply_match.db")
+            return tuple(row)
+    return None
+
+def _record_sms_reply(from_num, message_sid, body, body_raw, result, session_id, donor_id):
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        row = _match_pending_verification(cur, from_num, body, result, message_sid) if from_num else None
+
+        if row:
+            _, session_id_db, donor_id_db = row
+            session_id = session_id or session_id_db
+            donor_id = donor_id or donor_id_db
+        else:
+            # No match → insert standalone inbound
+            cur.execute(
+                """
+                INSERT INTO VERIFICATION_SMS
+                (VERIF_ID, SESSION_ID, DONOR_ID, SENT_TS, MESSAGE_BODY,
+                 INBOUND_TS, INBOUND_BODY, RESULT, TWILIO_MSG_SID, MOBILE_E164)
+                SELECT %s, %s, %s, NULL, NULL,
+                       CURRENT_TIMESTAMP(), %s, %s, %s, %s
+                """,
+                (
+                    f"tw-{message_sid}" if message_sid else new_id("tw"),
+                    session_id,
+                    donor_id,
+                    body,
+                    result,
+                    message_sid,
+                    from_num,
+                ),
+            )
+
         insert_event(
             cur,
             LogEventIn(
-                event_type="SMS_SENT",
-                session_id=payload.session_id,
-                donor_id=payload.donor_id,
-                attributes={
-                    "to": payload.to_e164,
-                    "sid": msg.sid,
-                    "body": body,
-                    "fundraiser_first": fundraiser_first,
-                    "donor_full_name": donor_full_name,
-                },
+                event_type=f"SMS_REPLY_{result}",
+                session_id=session_id,
+                donor_id=donor_id,
+                attributes={"from": from_num, "body": body_raw, "message_sid": message_sid},
             ),
+            rollups=True,
         )
-
     finally:
         try: cur.close()
         except Exception: pass
         ctx.close()
 
-    return {"ok": True, "sid": msg.sid}
+# ---------- SMS: outbound send (FINAL MESSAGE FORMAT) ----------
+@app.post("/verification/sms/send")
+def send_verification_sms(payload: SendSmsIn, request: Request):
+    if not get_twilio_client():
+        raise HTTPException(status_code=500, detail="Twilio client not configured")
+    enforce_rate_limit("sms_send", request, to=payload.to_e164, session=payload.session_id)
 
-# ---------- SMS VERIFICATION ROUTE ----------
-@app.get("/verification/sms/status")
-def verification_status(session_id: Optional[str] = None, donor_id: Optional[str] = None):
+    # Lazy: while degraded the donor/session can come entirely from the journal + reference cache
+    cur = _LazyCursor()
+    try:
+        # --- Donor fields for message (journal first: it may not be forwarded yet) ---
+        pending = write_journal.latest("donor_upsert", payload.donor_id)
+        if pending:
+            drow = tuple(pending.get(k) for k in ("title", "first_name", "middle_name", "last_name", "email",
+                                                  "address1", "address2", "city", "region", "postal_code",
+                                                  "country", "dob_iso"))
+        else:
+            donor = repo_one(cur, "donor.by_id", (write_journal.canonical_donor_id(payload.donor_id),))
+            drow = donor and (donor.TITLE, donor.FIRST_NAME, donor.MIDDLE_NAME, donor.LAST_NAME, donor.EMAIL,
+                              donor.ADDRESS1, donor.ADDRESS2, donor.CITY, donor.REGION, donor.POSTAL_CODE,
+                              donor.COUNTRY, donor.DOB_DATE)
+        if not drow:
+            raise HTTPException(status_code=404, detail="Donor not found")
+
+        (title, first, middle, last,
+         email, addr1, addr2, city, region, postal, country,
+         dob_date) = drow
+
+        # --- Fundraiser first name from session ---
+        pending_session = write_journal.latest("session_start", payload.session_id)
+        if pending_session:
+            fund = _read_fundraiser(cur, pending_session["fundraiser_id"]) or {}
+            frow = (fund.get("DISPLAY_NAME"), pending_session["fundraiser_id"])
+        else:
+            frow = repo_one(cur, "session.fundraiser", (payload.session_id,))
+        if frow and frow[1]:
+            enforce_rate_limit("sms_send", request, fundraiser=frow[1], device=None, ip=None)
+        fundraiser_display = (frow[0] if frow else "") or ""
+        fundraiser_first = (fundraiser_display.strip().split(" ")[0]) if fundraiser_display else "your fundraiser"
+
+        # Donor full name: Title + First + Middle + Last (non-blank)
+        name_parts = [_nz(title), _nz(first), _nz(middle), _nz(last)]
+        donor_full_name = " ".join([p for p in name_parts if p])
+
+        # Address line (skip address2 if blank)
+        addr_parts = [_nz(addr1)]
+        if _nz(addr2):
+            addr_parts.append(_nz(addr2))
+        addr_parts += [_nz(city), _nz(region), _nz(postal), _nz(country)]
+        address_line = ", ".join([p for p in addr_parts if p])
+
+        # DOB as ISO
+        dob_iso = dob_date.isoformat() if hasattr(dob_date, "isoformat") else _nz(dob_date)
+
+        # Amount + frequency + charity
+        amount_str = f"${payload.amount_cents/100:.2f} {payload.currency.upper()}"
+        freq_txt = "(monthly)" if (payload.gift_type or "").upper() == "MONTHLY" else "(one-time)"
+        charity_txt = _nz(payload.charity_name)
+
+        # FINAL BODY — EXACT WORDING
+        desired_body = (
+            f"Hi {donor_full_name}! It's {fundraiser_first}.  "
+            f"Thank you for committing to donate {amount_str} {freq_txt} to {charity_txt}.\n\n"
+            f"Your information is as follows:\n"
+            f"Email address: {email}\n"
+            f"Address: {address_line}\n"
+            f"Date of Birth: {dob_iso}\n\n"
+            f"Please confirm (yes/no) that everything above is correct."
+        )
+        body = payload.preview_message or desired_body
+
+        # --- Send SMS via Twilio ---
+        msg_kwargs = {"to": payload.to_e164, "body": body}
+        if TWILIO_MESSAGING_SERVICE_SID:
+            msg_kwargs["messaging_service_sid"] = TWILIO_MESSAGING_SERVICE_SID
+        elif TWILIO_FROM_NUMBER:
+            msg_kwargs["from_"] = TWILIO_FROM_NUMBER
+        else:
+            raise HTTPException(status_code=500, detail="Set TWILIO_MESSAGING_SERVICE_SID or TWILIO_FROM_NUMBER")
+
+        msg_kwargs["status_callback"] = TWILIO_STATUS_CALLBACK_URL or str(request.url_for("twilio_status"))
+        event_attrs = {"to": payload.to_e164, "body": body, "fundraiser_first": fundraiser_first,
+                       "donor_full_name": donor_full_name}
+    finally:
+        cur.close()
+
+    # The row exists from the start, so a send that is still queued (or later fails)
+    # has a status for the tablet to poll; the worker callbacks fill it in
+    verif_id = new_id("tw")
     ctx = get_snowflake_ctx()
     try:
         cur = ctx.cursor()
+        _ensure_table(cur, "VERIFICATION_SMS.delivery_columns", SMS_DELIVERY_DDL)
         cur.execute(
             """
-            SELECT RESULT, INBOUND_BODY, SENT_TS
-            FROM VERIFICATION_SMS
-            WHERE SESSION_ID = %s AND DONOR_ID = %s
-            ORDER BY SENT_TS DESC
-            LIMIT 1
+            INSERT INTO VERIFICATION_SMS
+            (VERIF_ID, SESSION_ID, DONOR_ID, SENT_TS, MESSAGE_BODY, MOBILE_E164, DELIVERY_STATUS)
+            SELECT %s, %s, %s, CURRENT_TIMESTAMP(), %s, %s, 'queued'
             """,
-            (session_id, donor_id),
+            (verif_id, payload.session_id, payload.donor_id, body, payload.to_e164),
         )
-        row = cur.fetchone()
-        if not row:
+    except Exception as e:
+        # on_sent still creates the row; only a failure before sending would go unrecorded
+        print(f"=== DEBUG: could not record queued SMS {verif_id}: {e} ===")
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+    def on_sent(msg):
+        # Runs on the SMS worker, so the row is updated even if the caller stopped waiting
+        ctx = get_snowflake_ctx()
+        try:
+            # Synchronous: the status poll and reply matching look this row up by its SID
+            cur = ctx.cursor()
+            _ensure_table(cur, "VERIFICATION_SMS.delivery_columns", SMS_DELIVERY_DDL)
+            cur.execute(
+                """
+                MERGE INTO VERIFICATION_SMS T
+                USING (SELECT %s AS VERIF_ID, %s AS SESSION_ID, %s AS DONOR_ID, %s AS MESSAGE_BODY,
+                              %s AS TWILIO_MSG_SID, %s AS MOBILE_E164, %s AS TO_NUMBER, %s AS DELIVERY_STATUS) S
+                ON T.VERIF_ID = S.VERIF_ID
+                WHEN MATCHED THEN UPDATE SET
+                    SENT_TS = CURRENT_TIMESTAMP(), TWILIO_MSG_SID = S.TWILIO_MSG_SID,
+                    TO_NUMBER = S.TO_NUMBER, DELIVERY_STATUS = S.DELIVERY_STATUS
+                WHEN NOT MATCHED THEN INSERT
+                    (VERIF_ID, SESSION_ID, DONOR_ID, SENT_TS, MESSAGE_BODY, TWILIO_MSG_SID, MOBILE_E164,
+                     TO_NUMBER, DELIVERY_STATUS)
+                VALUES (S.VERIF_ID, S.SESSION_ID, S.DONOR_ID, CURRENT_TIMESTAMP(), S.MESSAGE_BODY,
+                        S.TWILIO_MSG_SID, S.MOBILE_E164, S.TO_NUMBER, S.DELIVERY_STATUS)
+                """,
+                (
+                    verif_id,
+                    payload.session_id,
+                    payload.donor_id,
+                    body,
+                    msg.sid,
+                    payload.to_e164,
+                    getattr(msg, "from_", None),
+                    getattr(msg, "status", None),
+                ),
+            )
+            pending_verifications.put(payload.to_e164, verif_id, payload.session_id, payload.donor_id)
+            insert_event(
+                cur,
+                LogEventIn(
+                    event_type="SMS_SENT",
+                    session_id=payload.session_id,
+                    donor_id=payload.donor_id,
+                    attributes=event_attrs | {"sid": msg.sid},
+                ),
+            )
+        finally:
+            try: cur.close()
+            except Exception: pass
+            ctx.close()
+
+    def on_failed(error):
+        # Unknown outcome: Twilio may have accepted it, so the row stays open for a reply
+        status = "unknown" if isinstance(error, SmsOutcomeUnknown) else "failed"
+        code = getattr(error, "code", None) or type(error).__name__
+        ctx = get_snowflake_ctx()
+        try:
+            cur = ctx.cursor()
+            cur.execute(
+                """
+                UPDATE VERIFICATION_SMS
+                SET DELIVERY_STATUS = %s, DELIVERY_ERROR_CODE = %s, DELIVERY_TS = CURRENT_TIMESTAMP()
+                WHERE VERIF_ID = %s AND TWILIO_MSG_SID IS NULL
+                """,
+                (status, str(code), verif_id),
+            )
+        finally:
+            try: cur.close()
+            except Exception: pass
+            ctx.close()
+
+    try:
+        future = sms_queue.submit(msg_kwargs, on_sent, on_failed)
+    except QueueFull as e:
+        on_failed(e)
+        raise HTTPException(status_code=503, detail="SMS queue is full, retry shortly", headers={"Retry-After": "5"})
+    try:
+        msg = future.result(timeout=SMS_SEND_WAIT_SEC)
+    except FutureTimeout:
+        # Still queued (sender throttled); the tablet keeps polling /verification/sms/status
+        return {"ok": True, "sid": None, "queued": True}
+    except SmsOutcomeUnknown:
+        # Not resent: the donor may already have the text; a reply still matches this row
+        return {"ok": True, "sid": None, "unknown": True}
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"SMS send failed: {e}")
+
+    return {"ok": True, "sid": msg.sid}
+
+# ---------- SMS VERIFICATION ROUTE ----------
+@app.get("/verification/sms/status")
+def verification_status(session_id: Optional[str] = None, donor_id: Optional[str] = None):
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_table(cur, "VERIFICATION_SMS.delivery_columns", SMS_DELIVERY_DDL)
+        v = repo_one(cur, "verification.latest_for_session_donor", (session_id, donor_id))
+        if not v:
             return {"result": "PENDING", "inbound_body": None}
-        result, inbound_body, sent_ts = row
-        return {"result": result or "PENDING", "inbound_body": inbound_body, "sent_ts": sent_ts.isoformat() if sent_ts else None}
+        result, inbound_body, sent_ts = v.RESULT, v.INBOUND_BODY, v.SENT_TS
+        delivery_status, delivery_error = v.DELIVERY_STATUS, v.DELIVERY_ERROR_CODE
+        if not result and delivery_status in SMS_UNDELIVERED:
+            result = "UNDELIVERED"
+        return {"result": result or "PENDING", "inbound_body": inbound_body,
+                "sent_ts": sent_ts.isoformat() if sent_ts else None,
+                "delivery_status": delivery_status, "delivery_error_code": delivery_error}
     finally:
         try: cur.close()
         except Exception: pass
@@ -533,9 +3473,9 @@ def get_payment_method_from_intent(payment_intent_id: str):
         
 # ---------- Stripe: PaymentIntent (OTG) ----------
 @app.post("/payment_intent")
-def create_payment_intent(payload: PaymentIntentIn):
+def create_payment_intent(payload: PaymentIntentIn, request: Request):
     try:
-        idem = f"{payload.session_id}-pi-1" if payload.session_id else None
+        idem = _idem_key(request, "pi") or (f"{payload.session_id}-pi-1" if payload.session_id else None)
         kwargs = dict(
             amount=payload.amount,
             currency=payload.currency,
@@ -562,6 +3502,247 @@ def create_setup_intent(payload: SetupIntentIn):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# ---------- Payment / subscription state (materialized from webhooks) ----------
+SUBSCRIPTION_TABLE = "SUBSCRIPTION"
+SUBSCRIPTION_DDL = f"""
+CREATE TABLE IF NOT EXISTS {SUBSCRIPTION_TABLE} (
+    STRIPE_SUBSCRIPTION_ID STRING NOT NULL PRIMARY KEY,
+    SESSION_ID STRING,
+    DONOR_ID STRING,
+    STRIPE_CUSTOMER_ID STRING,
+    STATUS STRING,
+    AMOUNT NUMBER,
+    CURRENCY STRING,
+    LAST_INVOICE_ID STRING,
+    LAST_INVOICE_STATUS STRING,
+    LAST_PAID_AT TIMESTAMP_NTZ,
+    FAILURE_REASON STRING,
+    CURRENT_PERIOD_END TIMESTAMP_NTZ,
+    CANCEL_AT TIMESTAMP_NTZ,
+    LAST_EVENT_TS TIMESTAMP_NTZ,
+    UPDATED_AT TIMESTAMP_NTZ
+)
+"""
+PAYMENT_STATE_DDL = """
+ALTER TABLE PAYMENT ADD COLUMN IF NOT EXISTS
+    STRIPE_PAYMENT_INTENT_ID STRING,
+    LAST_INVOICE_ID STRING,
+    FAILURE_REASON STRING,
+    LAST_EVENT_TS TIMESTAMP_NTZ,
+    UPDATED_AT TIMESTAMP_NTZ
+"""
+
+# Stripe event type -> handler(cur, event, obj, session_id, donor_id)
+STRIPE_EVENT_HANDLERS: Dict[str, Callable] = {}
+
+def stripe_event_handler(*event_types: str):
+    def register(fn):
+        for et in event_types:
+            STRIPE_EVENT_HANDLERS[et] = fn
+        return fn
+    return register
+
+def _ensure_payment_state(cur):
+    _ensure_table(cur, SUBSCRIPTION_TABLE, SUBSCRIPTION_DDL)
+    _ensure_table(cur, "PAYMENT.state_columns", PAYMENT_STATE_DDL)
+
+def _invoice_subscription_id(inv) -> Optional[str]:
+    sub = inv.get("subscription")
+    if isinstance(sub, dict):
+        return sub.get("id")
+    if sub:
+        return sub
+    # Newer API versions moved it under parent.subscription_details
+    details = ((inv.get("parent") or {}).get("subscription_details") or {})
+    return details.get("subscription")
+
+def _upsert_payment_state(cur, payment_id: str, event_ts: int, *, type_: str, session_id=None, donor_id=None,
+                          customer_id=None, subscription_id=None, payment_intent_id=None, status=None,
+                          amount=None, currency=None, last_invoice_id=None, failure_reason=None):
+    """
+    MERGE one PAYMENT row. Events older than the row's LAST_EVENT_TS are ignored,
+    so out-of-order webhook delivery can't roll state back. NULL inputs keep the
+    existing value.
+    """
+    _ensure_payment_state(cur)
+    cur.execute(
+        """
+        MERGE INTO PAYMENT T
+        USING (SELECT %s AS PAYMENT_ID, %s AS SESSION_ID, %s AS DONOR_ID, %s AS TYPE, %s AS AMOUNT,
+                      %s AS CURRENCY, %s AS STRIPE_CUSTOMER_ID, %s AS STRIPE_SUBSCRIPTION_ID,
+                      %s AS STRIPE_PAYMENT_INTENT_ID, %s AS STATUS, %s AS LAST_INVOICE_ID,
+                      %s AS FAILURE_REASON, TO_TIMESTAMP_NTZ(%s) AS EVENT_TS) S
+        ON T.PAYMENT_ID = S.PAYMENT_ID
+        WHEN MATCHED AND (T.LAST_EVENT_TS IS NULL OR T.LAST_EVENT_TS <= S.EVENT_TS) THEN UPDATE SET
+            SESSION_ID = COALESCE(T.SESSION_ID, S.SESSION_ID),
+            DONOR_ID = COALESCE(T.DONOR_ID, S.DONOR_ID),
+            AMOUNT = COALESCE(S.AMOUNT, T.AMOUNT),
+            CURRENCY = COALESCE(S.CURRENCY, T.CURRENCY),
+            STRIPE_CUSTOMER_ID = COALESCE(T.STRIPE_CUSTOMER_ID, S.STRIPE_CUSTOMER_ID),
+            STRIPE_SUBSCRIPTION_ID = COALESCE(T.STRIPE_SUBSCRIPTION_ID, S.STRIPE_SUBSCRIPTION_ID),
+            STRIPE_PAYMENT_INTENT_ID = COALESCE(S.STRIPE_PAYMENT_INTENT_ID, T.STRIPE_PAYMENT_INTENT_ID),
+            STATUS = COALESCE(S.STATUS, T.STATUS),
+            LAST_INVOICE_ID = COALESCE(S.LAST_INVOICE_ID, T.LAST_INVOICE_ID),
+            FAILURE_REASON = S.FAILURE_REASON,
+            LAST_EVENT_TS = S.EVENT_TS,
+            UPDATED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT
+            (PAYMENT_ID, SESSION_ID, DONOR_ID, TYPE, AMOUNT, CURRENCY, STRIPE_CUSTOMER_ID,
+             STRIPE_SUBSCRIPTION_ID, STRIPE_PAYMENT_INTENT_ID, STATUS, LAST_INVOICE_ID,
+             FAILURE_REASON, LAST_EVENT_TS, CREATED_AT, UPDATED_AT)
+            VALUES (S.PAYMENT_ID, S.SESSION_ID, S.DONOR_ID, S.TYPE, S.AMOUNT, S.CURRENCY,
+                    S.STRIPE_CUSTOMER_ID, S.STRIPE_SUBSCRIPTION_ID, S.STRIPE_PAYMENT_INTENT_ID,
+                    S.STATUS, S.LAST_INVOICE_ID, S.FAILURE_REASON, S.EVENT_TS,
+                    CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
+        """,
+        (payment_id, session_id, donor_id, type_, amount, currency, customer_id, subscription_id,
+         payment_intent_id, status, last_invoice_id, failure_reason, event_ts),
+    )
+
+def _upsert_subscription_state(cur, subscription_id: str, event_ts: int, *, session_id=None, donor_id=None,
+                               customer_id=None, status=None, amount=None, currency=None,
+                               last_invoice_id=None, last_invoice_status=None, paid_at=None,
+                               failure_reason=None, current_period_end=None, cancel_at=None):
+    _ensure_payment_state(cur)
+    cur.execute(
+        f"""
+        MERGE INTO {SUBSCRIPTION_TABLE} T
+        USING (SELECT %s AS STRIPE_SUBSCRIPTION_ID, %s AS SESSION_ID, %s AS DONOR_ID,
+                      %s AS STRIPE_CUSTOMER_ID, %s AS STATUS, %s AS AMOUNT, %s AS CURRENCY,
+                      %s AS LAST_INVOICE_ID, %s AS LAST_INVOICE_STATUS, TO_TIMESTAMP_NTZ(%s) AS LAST_PAID_AT,
+                      %s AS FAILURE_REASON, TO_TIMESTAMP_NTZ(%s) AS CURRENT_PERIOD_END,
+                      TO_TIMESTAMP_NTZ(%s) AS CANCEL_AT, TO_TIMESTAMP_NTZ(%s) AS EVENT_TS) S
+        ON T.STRIPE_SUBSCRIPTION_ID = S.STRIPE_SUBSCRIPTION_ID
+        WHEN MATCHED AND (T.LAST_EVENT_TS IS NULL OR T.LAST_EVENT_TS <= S.EVENT_TS) THEN UPDATE SET
+            SESSION_ID = COALESCE(T.SESSION_ID, S.SESSION_ID),
+            DONOR_ID = COALESCE(T.DONOR_ID, S.DONOR_ID),
+            STRIPE_CUSTOMER_ID = COALESCE(T.STRIPE_CUSTOMER_ID, S.STRIPE_CUSTOMER_ID),
+            STATUS = COALESCE(S.STATUS, T.STATUS),
+            AMOUNT = COALESCE(S.AMOUNT, T.AMOUNT),
+            CURRENCY = COALESCE(S.CURRENCY, T.CURRENCY),
+            LAST_INVOICE_ID = COALESCE(S.LAST_INVOICE_ID, T.LAST_INVOICE_ID),
+            LAST_INVOICE_STATUS = COALESCE(S.LAST_INVOICE_STATUS, T.LAST_INVOICE_STATUS),
+            LAST_PAID_AT = COALESCE(S.LAST_PAID_AT, T.LAST_PAID_AT),
+            FAILURE_REASON = S.FAILURE_REASON,
+            CURRENT_PERIOD_END = COALESCE(S.CURRENT_PERIOD_END, T.CURRENT_PERIOD_END),
+            CANCEL_AT = COALESCE(S.CANCEL_AT, T.CANCEL_AT),
+            LAST_EVENT_TS = S.EVENT_TS,
+            UPDATED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT
+            (STRIPE_SUBSCRIPTION_ID, SESSION_ID, DONOR_ID, STRIPE_CUSTOMER_ID, STATUS, AMOUNT, CURRENCY,
+             LAST_INVOICE_ID, LAST_INVOICE_STATUS, LAST_PAID_AT, FAILURE_REASON, CURRENT_PERIOD_END,
+             CANCEL_AT, LAST_EVENT_TS, UPDATED_AT)
+            VALUES (S.STRIPE_SUBSCRIPTION_ID, S.SESSION_ID, S.DONOR_ID, S.STRIPE_CUSTOMER_ID, S.STATUS,
+                    S.AMOUNT, S.CURRENCY, S.LAST_INVOICE_ID, S.LAST_INVOICE_STATUS, S.LAST_PAID_AT,
+                    S.FAILURE_REASON, S.CURRENT_PERIOD_END, S.CANCEL_AT, S.EVENT_TS, CURRENT_TIMESTAMP())
+        """,
+        (subscription_id, session_id, donor_id, customer_id, status, amount, currency,
+         last_invoice_id, last_invoice_status, paid_at, failure_reason, current_period_end,
+         cancel_at, event_ts),
+    )
+
+def _stripe_id(x) -> Optional[str]:
+    return x.get("id") if isinstance(x, dict) else x
+
+@stripe_event_handler(
+    "customer.subscription.created", "customer.subscription.updated",
+    "customer.subscription.deleted", "customer.subscription.paused", "customer.subscription.resumed",
+)
+def _on_subscription_event(cur, event, sub, session_id, donor_id):
+    items = ((sub.get("items") or {}).get("data") or [])
+    price = (items[0].get("price") or {}) if items else {}
+    qty = (items[0].get("quantity") or 1) if items else 1
+    amount = price.get("unit_amount") * qty if price.get("unit_amount") is not None else None
+    period_end = sub.get("current_period_end") or (items[0].get("current_period_end") if items else None)
+    _upsert_subscription_state(
+        cur, sub["id"], event["created"],
+        session_id=session_id, donor_id=donor_id, customer_id=_stripe_id(sub.get("customer")),
+        status=sub.get("status"), amount=amount, currency=price.get("currency"),
+        last_invoice_id=_stripe_id(sub.get("latest_invoice")),
+        current_period_end=period_end, cancel_at=sub.get("cancel_at"),
+    )
+    _upsert_payment_state(
+        cur, f"sub-{sub['id']}", event["created"], type_="MONTHLY",
+        session_id=session_id, donor_id=donor_id, customer_id=_stripe_id(sub.get("customer")),
+        subscription_id=sub["id"], status=sub.get("status"), amount=amount, currency=price.get("currency"),
+        last_invoice_id=_stripe_id(sub.get("latest_invoice")),
+    )
+
+def _invoice_failure_reason(inv, event_type: str) -> str:
+    """
+    Why an invoice payment failed: the PaymentIntent's last_payment_error, else the
+    charge's failure_message. Webhook invoices carry the PaymentIntent as a bare id,
+    so it is fetched (with its latest charge) unless the payload already expanded it.
+    """
+    pi = inv.get("payment_intent")
+    if isinstance(pi, str):
+        pi_id, pi = pi, None
+        if stripe.api_key:
+            try:
+                pi = stripe.PaymentIntent.retrieve(pi_id, expand=["latest_charge"])
+            except Exception as e:
+                print(f"=== DEBUG: could not fetch {pi_id} for invoice {inv.get('id')}: {e} ===")
+    charge = inv.get("charge")
+    if isinstance(pi, dict):
+        err = pi.get("last_payment_error") or {}
+        reason = err.get("message") or err.get("decline_code") or err.get("code")
+        if reason:
+            return reason
+        if isinstance(pi.get("latest_charge"), dict):
+            charge = pi["latest_charge"]
+    if isinstance(charge, dict) and charge.get("failure_message"):
+        return charge["failure_message"]
+    return event_type.split(".", 1)[1]
+
+@stripe_event_handler("invoice.paid", "invoice.payment_succeeded", "invoice.payment_failed",
+                      "invoice.payment_action_required", "invoice.voided", "invoice.marked_uncollectible")
+def _on_invoice_event(cur, event, inv, session_id, donor_id):
+    sub_id = _invoice_subscription_id(inv)
+    if not sub_id:
+        return
+    failed = event["type"] in ("invoice.payment_failed", "invoice.payment_action_required")
+    failure = _invoice_failure_reason(inv, event["type"]) if failed else None
+    paid_at = ((inv.get("status_transitions") or {}).get("paid_at")) if inv.get("paid") or inv.get("status") == "paid" else None
+    amount = inv.get("amount_paid") if paid_at else inv.get("amount_due")
+    _upsert_subscription_state(
+        cur, sub_id, event["created"],
+        session_id=session_id, donor_id=donor_id, customer_id=_stripe_id(inv.get("customer")),
+        amount=amount, currency=inv.get("currency"),
+        last_invoice_id=inv["id"], last_invoice_status=inv.get("status"), paid_at=paid_at,
+        failure_reason=failure, status="past_due" if failed else None,
+    )
+    _upsert_payment_state(
+        cur, f"sub-{sub_id}", event["created"], type_="MONTHLY",
+        session_id=session_id, donor_id=donor_id, customer_id=_stripe_id(inv.get("customer")),
+        subscription_id=sub_id, amount=amount, currency=inv.get("currency"),
+        last_invoice_id=inv["id"], failure_reason=failure,
+        payment_intent_id=_stripe_id(inv.get("payment_intent")),
+    )
+
+@stripe_event_handler("payment_intent.succeeded", "payment_intent.payment_failed",
+                      "payment_intent.canceled", "payment_intent.processing",
+                      "payment_intent.requires_action")
+def _on_payment_intent_event(cur, event, pi, session_id, donor_id):
+    if pi.get("invoice"):
+        return  # subscription charges are tracked through invoice.* events
+    err = pi.get("last_payment_error") or {}
+    failure = (err.get("message") or err.get("code")) if event["type"] == "payment_intent.payment_failed" else None
+    _upsert_payment_state(
+        cur, f"pi-{pi['id']}", event["created"], type_="OTG",
+        session_id=session_id, donor_id=donor_id, customer_id=_stripe_id(pi.get("customer")),
+        payment_intent_id=pi["id"], status=pi.get("status"),
+        amount=pi.get("amount_received") or pi.get("amount"), currency=pi.get("currency"),
+        failure_reason=failure,
+    )
+
+def apply_stripe_event(cur, event, session_id, donor_id) -> bool:
+    handler = STRIPE_EVENT_HANDLERS.get(event["type"])
+    if handler is None:
+        return False
+    handler(cur, event, event["data"]["object"], session_id, donor_id)
+    metric_inc(f"stripe_webhook.applied.{event['type']}")
+    return True
+
 # ---------- Stripe webhook (with de-dupe + metadata enrichment) ----------
 def _enrich_session_donor_from_stripe(event: dict) -> Tuple[Optional[str], Optional[str]]:
     obj = event.get("data", {}).get("object", {}) or {}
@@ -654,6 +3835,11 @@ async def stripe_webhook(
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Webhook signature error: {str(e)}")
 
+    # Handlers run MERGEs and may call Stripe (enrichment, failure reasons): keep them off the event loop
+    await run_in_threadpool(_process_stripe_event, event)
+    return JSONResponse({"received": True})
+
+def _process_stripe_event(event):
     etype = event["type"]
     data = event["data"]["object"]
     event_id = event["id"]
@@ -667,6 +3853,8 @@ async def stripe_webhook(
             "SELECT 1 FROM EVENT_LOG WHERE EVENT_ID = %s LIMIT 1", (event_id,)
         ).fetchone()
         if not exists:
+            # State first: if this fails Stripe retries and the event is not yet de-duped
+            apply_stripe_event(cur, event, s_id, d_id)
             insert_event(
                 cur,
                 LogEventIn(
@@ -676,17 +3864,283 @@ async def stripe_webhook(
                     attributes=data,
                 ),
                 event_id=event_id,
+                rollups=True,
             )
+        if etype.startswith("customer.") and data.get("object") == "customer":
+            if etype == "customer.deleted":
+                _customer_index_remove(cur, data["id"])
+            elif data.get("email"):
+                _customer_index_put(cur, data["email"], data["id"], "WEBHOOK")
     finally:
         try: cur.close()
         except Exception: pass
         ctx.close()
 
-    return JSONResponse({"received": True})
+# ---------- Payment status (materialized) ----------
+@app.get("/payments/status")
+def payment_status(
+    session_id: Optional[str] = None,
+    donor_id: Optional[str] = None,
+    subscription_id: Optional[str] = None,
+):
+    """Current gift state from PAYMENT/SUBSCRIPTION, kept up to date by the Stripe webhook."""
+    filters = [(c, v) for c, v in (("P.SESSION_ID", session_id), ("P.DONOR_ID", donor_id),
+                                   ("P.STRIPE_SUBSCRIPTION_ID", subscription_id)) if v]
+    if not filters:
+        raise HTTPException(status_code=400, detail="Provide session_id, donor_id or subscription_id")
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_payment_state(cur)
+        cur.execute(
+            f"""
+            SELECT P.PAYMENT_ID, P.SESSION_ID, P.DONOR_ID, P.TYPE, P.STATUS, P.AMOUNT, P.CURRENCY,
+                   P.STRIPE_CUSTOMER_ID, P.STRIPE_SUBSCRIPTION_ID, P.STRIPE_PAYMENT_INTENT_ID,
+                   P.LAST_INVOICE_ID, P.FAILURE_REASON, P.UPDATED_AT,
+                   S.STATUS AS SUBSCRIPTION_STATUS, S.LAST_INVOICE_STATUS, S.LAST_PAID_AT,
+                   S.CURRENT_PERIOD_END, S.CANCEL_AT
+            FROM PAYMENT P
+            LEFT JOIN {SUBSCRIPTION_TABLE} S ON S.STRIPE_SUBSCRIPTION_ID = P.STRIPE_SUBSCRIPTION_ID
+            WHERE {" AND ".join(f"{c} = %s" for c, _ in filters)}
+            ORDER BY P.CREATED_AT DESC
+            LIMIT 50
+            """,
+            tuple(v for _, v in filters),
+        )
+        cols = [d[0].lower() for d in cur.description]
+        return {"payments": [row_to_dict(cur, r, cols) for r in cur.fetchall()]}
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+# ---------- Performance rollups (fundraiser / campaign / day) ----------
+ROLLUP_TABLE = "PERF_ROLLUP"
+ROLLUP_DDL = f"""
+CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+    DIM STRING NOT NULL,          -- FUNDRAISER | CAMPAIGN | CAMPAIGN_FUNDRAISER
+    PARENT_ID STRING NOT NULL,    -- campaign id for CAMPAIGN_FUNDRAISER, '' otherwise
+    DIM_ID STRING NOT NULL,
+    DAY DATE NOT NULL,
+    SESSIONS_STARTED NUMBER DEFAULT 0,
+    DONORS_CAPTURED NUMBER DEFAULT 0,
+    SMS_VERIFIED NUMBER DEFAULT 0,
+    MONTHLY_GIFTS NUMBER DEFAULT 0,
+    ONE_TIME_GIFTS NUMBER DEFAULT 0,
+    AMOUNT_CENTS NUMBER DEFAULT 0,
+    UPDATED_AT TIMESTAMP_NTZ,
+    PRIMARY KEY (DIM, PARENT_ID, DIM_ID, DAY)
+)
+"""
+ROLLUP_TZ = ZoneInfo(os.getenv("ROLLUP_TZ", "America/Toronto"))
+ROLLUP_COUNTERS = ("SESSIONS_STARTED", "DONORS_CAPTURED", "SMS_VERIFIED",
+                   "MONTHLY_GIFTS", "ONE_TIME_GIFTS", "AMOUNT_CENTS")
+STATS_SSE_REFRESH_SEC = float(os.getenv("STATS_SSE_REFRESH_SEC", "10"))
+
+_session_dims: "OrderedDict[str, Tuple[Optional[str], Optional[str]]]" = OrderedDict()
+_session_dims_lock = threading.Lock()
+_SESSION_DIMS_MAX = 20000
+# campaign_id -> bumped whenever this worker changes that campaign's rollups (drives SSE)
+_rollup_versions: Dict[str, int] = {}
+
+def _remember_session_dims(session_id: str, fundraiser_id: Optional[str], campaign_id: Optional[str]):
+    with _session_dims_lock:
+        _session_dims[session_id] = (fundraiser_id, campaign_id)
+        _session_dims.move_to_end(session_id)
+        while len(_session_dims) > _SESSION_DIMS_MAX:
+            _session_dims.popitem(last=False)
+
+def _session_dims_for(cur, session_id: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    if not session_id:
+        return None, None
+    with _session_dims_lock:
+        hit = _session_dims.get(session_id)
+    if hit is not None:
+        return hit
+    row = cur.execute(
+        "SELECT FUNDRAISER_ID, CAMPAIGN_ID FROM SESSION WHERE SESSION_ID = %s", (session_id,)
+    ).fetchone()
+    dims = (row[0], row[1]) if row else (None, None)
+    if row:
+        _remember_session_dims(session_id, *dims)
+    return dims
+
+def _subscription_amount(sub: Dict[str, Any]) -> int:
+    items = ((sub.get("items") or {}).get("data") or [])
+    if not items:
+        return 0
+    price = items[0].get("price") or {}
+    return int(price.get("unit_amount") or 0) * int(items[0].get("quantity") or 1)
+
+def _event_rollup_deltas(ev: LogEventIn) -> Optional[Dict[str, int]]:
+    """
+    Gift counters come from Stripe webhook events (attributes = the Stripe object),
+    never from client-supplied amounts: a succeeded PaymentIntent outside an invoice
+    is a one-time gift; a created subscription is a monthly gift.
+    """
+    et = ev.event_type
+    attrs = ev.attributes or {}
+    if et == "SESSION_STARTED":
+        return {"SESSIONS_STARTED": 1}
+    if et == "DONOR_INSERT":
+        return {"DONORS_CAPTURED": 1}
+    if et == "SMS_REPLY_YES":
+        return {"SMS_VERIFIED": 1}
+    if et == "STRIPE_PAYMENT_INTENT.SUCCEEDED" and not attrs.get("invoice"):
+        return {"ONE_TIME_GIFTS": 1, "AMOUNT_CENTS": int(attrs.get("amount_received") or attrs.get("amount") or 0)}
+    if et == "STRIPE_CUSTOMER.SUBSCRIPTION.CREATED":
+        if (attrs.get("metadata") or {}).get("first_payment_intent"):
+            # The first month was the terminal charge, already counted (with its amount) as a
+            # one-time gift when its PaymentIntent succeeded: reclassify it
+            return {"MONTHLY_GIFTS": 1, "ONE_TIME_GIFTS": -1}
+        return {"MONTHLY_GIFTS": 1, "AMOUNT_CENTS": _subscription_amount(attrs)}
+    return None
+
+def apply_event_rollups(cur, ev: LogEventIn):
+    """Adds one event's contribution to the fundraiser, campaign and campaign×fundraiser day rows."""
+    if ev.event_type == "SESSION_STARTED" and ev.session_id:
+        campaign = (ev.attributes or {}).get("campaign") or {}
+        _remember_session_dims(ev.session_id, ev.fundraiser_id, campaign.get("CAMPAIGN_ID"))
+    deltas = _event_rollup_deltas(ev)
+    if not deltas:
+        return
+    if isinstance(cur, AsyncWriteCursor):
+        # Counter increments aren't safe to resubmit, so they never go async
+        cur = cur._cur
+    fundraiser_id, campaign_id = _session_dims_for(cur, ev.session_id)
+    fundraiser_id = ev.fundraiser_id or fundraiser_id
+    keys = []
+    if fundraiser_id:
+        keys.append(("FUNDRAISER", "", fundraiser_id))
+    if campaign_id:
+        keys.append(("CAMPAIGN", "", campaign_id))
+    if fundraiser_id and campaign_id:
+        keys.append(("CAMPAIGN_FUNDRAISER", campaign_id, fundraiser_id))
+    if not keys:
+        metric_inc("rollups.unattributed")
+        return
+    day = datetime.now(ROLLUP_TZ).date().isoformat()
+    values = [deltas.get(c, 0) for c in ROLLUP_COUNTERS]
+    _ensure_table(cur, ROLLUP_TABLE, ROLLUP_DDL)
+    rows_sql = " UNION ALL ".join(
+        ["SELECT %s AS DIM, %s AS PARENT_ID, %s AS DIM_ID, %s::DATE AS DAY, "
+         + ", ".join(f"%s AS {c}" for c in ROLLUP_COUNTERS)] * len(keys)
+    )
+    params = []
+    for dim, parent, dim_id in keys:
+        params += [dim, parent, dim_id, day, *values]
+    cur.execute(
+        f"""
+        MERGE INTO {ROLLUP_TABLE} T
+        USING ({rows_sql}) S
+        ON T.DIM = S.DIM AND T.PARENT_ID = S.PARENT_ID AND T.DIM_ID = S.DIM_ID AND T.DAY = S.DAY
+        WHEN MATCHED THEN UPDATE SET
+            {", ".join(f"{c} = T.{c} + S.{c}" for c in ROLLUP_COUNTERS)},
+            UPDATED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT (DIM, PARENT_ID, DIM_ID, DAY, {", ".join(ROLLUP_COUNTERS)}, UPDATED_AT)
+            VALUES (S.DIM, S.PARENT_ID, S.DIM_ID, S.DAY, {", ".join(f"S.{c}" for c in ROLLUP_COUNTERS)},
+                    CURRENT_TIMESTAMP())
+        """,
+        tuple(params),
+    )
+    metric_inc("rollups.applied")
+    if campaign_id:
+        _rollup_versions[campaign_id] = _rollup_versions.get(campaign_id, 0) + 1
+
+def _rollup_stats(dim: str, dim_id: str, day: Optional[str], days: int) -> Dict[str, Any]:
+    end = date.fromisoformat(day) if day else datetime.now(ROLLUP_TZ).date()
+    start = end - timedelta(days=max(days, 1) - 1)
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_table(cur, ROLLUP_TABLE, ROLLUP_DDL)
+        cur.execute(
+            f"""
+            SELECT DAY, {", ".join(ROLLUP_COUNTERS)}
+            FROM {ROLLUP_TABLE}
+            WHERE DIM = %s AND PARENT_ID = '' AND DIM_ID = %s AND DAY BETWEEN %s AND %s
+            ORDER BY DAY
+            """,
+            (dim, dim_id, start.isoformat(), end.isoformat()),
+        )
+        rows = cur.fetchall()
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    by_day = [{"day": r[0].isoformat() if hasattr(r[0], "isoformat") else r[0],
+               **{c.lower(): int(v or 0) for c, v in zip(ROLLUP_COUNTERS, r[1:])}} for r in rows]
+    totals = {c.lower(): sum(d[c.lower()] for d in by_day) for c in ROLLUP_COUNTERS}
+    return {"id": dim_id, "from": start.isoformat(), "to": end.isoformat(), "totals": totals, "days": by_day}
+
+def _campaign_leaderboard(campaign_id: str, day: Optional[str], limit: int) -> Dict[str, Any]:
+    day = day or datetime.now(ROLLUP_TZ).date().isoformat()
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_table(cur, ROLLUP_TABLE, ROLLUP_DDL)
+        cur.execute(
+            f"""
+            SELECT R.DIM_ID, F.DISPLAY_NAME, {", ".join(f"R.{c}" for c in ROLLUP_COUNTERS)}
+            FROM {ROLLUP_TABLE} R
+            LEFT JOIN FUNDRAISER F ON F.FUNDRAISER_ID = R.DIM_ID
+            WHERE R.DIM = 'CAMPAIGN_FUNDRAISER' AND R.PARENT_ID = %s AND R.DAY = %s
+            ORDER BY R.AMOUNT_CENTS DESC, R.MONTHLY_GIFTS DESC
+            LIMIT %s
+            """,
+            (campaign_id, day, limit),
+        )
+        rows = cur.fetchall()
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    return {
+        "campaign_id": campaign_id,
+        "day": day,
+        "leaders": [{"fundraiser_id": r[0], "display_name": r[1],
+                     **{c.lower(): int(v or 0) for c, v in zip(ROLLUP_COUNTERS, r[2:])}} for r in rows],
+    }
+
+@app.get("/stats/fundraiser/{fundraiser_id}")
+def stats_fundraiser(fundraiser_id: str, day: Optional[str] = None, days: int = 1):
+    return _rollup_stats("FUNDRAISER", fundraiser_id, day, days)
+
+@app.get("/stats/campaign/{campaign_id}")
+def stats_campaign(campaign_id: str, day: Optional[str] = None, days: int = 1):
+    return _rollup_stats("CAMPAIGN", campaign_id, day, days)
+
+@app.get("/stats/campaign/{campaign_id}/leaderboard")
+def stats_campaign_leaderboard(campaign_id: str, day: Optional[str] = None, limit: int = 20):
+    return _campaign_leaderboard(campaign_id, day, limit)
+
+@app.get("/stats/campaign/{campaign_id}/leaderboard/stream")
+async def stats_campaign_leaderboard_stream(campaign_id: str, request: Request, limit: int = 20):
+    """
+    Server-Sent Events: pushes the leaderboard when this worker records a change,
+    and at least every STATS_SSE_REFRESH_SEC to pick up other workers' writes.
+    """
+    async def events():
+        last_version, last_payload, last_sent = None, None, 0.0
+        while not await request.is_disconnected():
+            version = _rollup_versions.get(campaign_id, 0)
+            if version != last_version or time.monotonic() - last_sent >= STATS_SSE_REFRESH_SEC:
+                board = await run_in_threadpool(_campaign_leaderboard, campaign_id, None, limit)
+                payload = json.dumps(board, default=_json_default)
+                if payload != last_payload:
+                    yield f"event: leaderboard\ndata: {payload}\n\n"
+                    last_payload = payload
+                else:
+                    yield ": keep-alive\n\n"
+                last_version, last_sent = version, time.monotonic()
+            await asyncio.sleep(1)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ---------- Stripe: Subscription (charge automatically; 50y end) ----------
 @app.post("/subscriptions/create")
-def create_subscription(payload: SubscriptionCreateIn):
+def create_subscription(payload: SubscriptionCreateIn, request: Request):
     try:
         cancel_at_ts = years_from_now_utc(payload.cancel_after_years)
         
@@ -701,6 +4155,10 @@ def create_subscription(payload: SubscriptionCreateIn):
         # Terminal payment counts as first month
         next_billing = datetime.now(timezone.utc) + timedelta(days=30)
         
+        sub_kwargs = {}
+        idem = _idem_key(request, "sub")
+        if idem:
+            sub_kwargs["idempotency_key"] = idem
         sub = stripe.Subscription.create(
             customer=payload.customer_id,
             items=[{"price": payload.price_id}],
@@ -715,6 +4173,7 @@ def create_subscription(payload: SubscriptionCreateIn):
                 "first_payment_intent": initial_payment_intent_id,
                 "payment_source": "terminal_generated_card"
             },
+            **sub_kwargs,
         )
         
         print(f"=== DEBUG: Subscription {sub.id} created, next billing: {next_billing.isoformat()} ===")
@@ -724,7 +4183,8 @@ def create_subscription(payload: SubscriptionCreateIn):
 
     ctx = get_snowflake_ctx()
     try:
-        cur = ctx.cursor()
+        # The customer.subscription.created webhook re-materializes PAYMENT if this write is lost
+        cur = AsyncWriteCursor(ctx.cursor(), "subscription_created")
         insert_event(
             cur,
             LogEventIn(
@@ -736,24 +4196,17 @@ def create_subscription(payload: SubscriptionCreateIn):
                     "cancel_at": sub.cancel_at, 
                     "price_id": payload.price_id,
                     "billing_cycle_anchor": int(next_billing.timestamp()),
-                    "first_payment_via_terminal": True
+                    "first_payment_via_terminal": True,
+                    "amount_cents": payload.metadata.get("amount_cents"),
+                    "currency": payload.metadata.get("currency"),
                 },
             ),
         )
-        cur.execute(
-            """
-            INSERT INTO PAYMENT (PAYMENT_ID, SESSION_ID, DONOR_ID, TYPE, AMOUNT, CURRENCY,
-                                 STRIPE_CUSTOMER_ID, STRIPE_SUBSCRIPTION_ID, STATUS, CREATED_AT)
-            SELECT %s, %s, %s, 'MONTHLY', NULL, NULL, %s, %s, %s, CURRENT_TIMESTAMP()
-            """,
-            (
-                f"sub-{sub.id}",
-                payload.session_id,
-                payload.donor_id,
-                payload.customer_id,
-                sub.id,
-                sub.status,
-            ),
+        # MERGE: a customer.subscription.created webhook may already have written the row
+        _upsert_payment_state(
+            cur, f"sub-{sub.id}", sub.created, type_="MONTHLY",
+            session_id=payload.session_id, donor_id=payload.donor_id,
+            customer_id=payload.customer_id, subscription_id=sub.id, status=sub.status,
         )
     finally:
         try: cur.close()
@@ -771,29 +4224,48 @@ def create_subscription(payload: SubscriptionCreateIn):
 # ---------- Stripe: Customer upsert ----------
 @app.post("/customer/upsert")
 def upsert_customer(payload: CustomerUpsertIn):
-    try:
-        existing = stripe.Customer.search(query=f"email:'{payload.email}'")
-        if existing.data:
-            cust = existing.data[0]
-        else:
-            cust = stripe.Customer.create(
-                email=payload.email,
-                name=payload.name,
-                phone=payload.phone,
-                metadata=payload.metadata,
-            )
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Stripe customer error: {e}")
-
+    """
+    Resolves the Stripe customer for an email via the local index (memory, then
+    STRIPE_CUSTOMER_INDEX). Stripe's Customer.search is only used on a miss, and
+    creation is serialized per email so back-to-back donors don't duplicate.
+    """
+    email_norm = _norm_email(payload.email)
     ctx = get_snowflake_ctx()
     try:
         cur = ctx.cursor()
+        _customer_index_load(cur)
+
+        customer_id = _customer_index_get(email_norm)
+        source = "INDEX"
+        if not customer_id:
+            with _customer_email_lock(email_norm):
+                customer_id = _customer_index_get(email_norm) or _customer_index_lookup_db(cur, email_norm)
+                try:
+                    if not customer_id:
+                        q = payload.email.replace("'", "\\'")
+                        existing = stripe.Customer.search(query=f"email:'{q}'")
+                        if existing.data:
+                            customer_id = existing.data[0].id
+                            source = "SEARCH"
+                        else:
+                            cust = stripe.Customer.create(
+                                email=payload.email,
+                                name=payload.name,
+                                phone=payload.phone,
+                                metadata=payload.metadata,
+                            )
+                            customer_id = cust.id
+                            source = "CREATE"
+                except Exception as e:
+                    raise HTTPException(status_code=400, detail=f"Stripe customer error: {e}")
+                _customer_index_put(cur, email_norm, customer_id, source)
+
         insert_event(
             cur,
             LogEventIn(
                 event_type="CUSTOMER_UPSERT",
                 donor_id=payload.metadata.get("donor_id"),
-                attributes={"customer_id": cust.id, "email": payload.email},
+                attributes={"customer_id": customer_id, "email": payload.email, "source": source},
             ),
         )
     finally:
@@ -801,7 +4273,7 @@ def upsert_customer(payload: CustomerUpsertIn):
         except Exception: pass
         ctx.close()
 
-    return {"customer_id": cust.id}
+    return {"customer_id": customer_id}
 
 # ---------- Stripe: Attach PM & set default ----------
 @app.get("/payment_intent/{payment_intent_id}/payment_method")
@@ -909,226 +4381,875 @@ def attach_payment_method(payload: PaymentMethodAttachIn):
         print(f"=== BACKEND DEBUG: Error type: {type(e)} ===")
         raise HTTPException(status_code=400, detail=f"Stripe attach PM error: {e}")
 
-    # ... rest of your logging code ...
+    # ... rest of your logging code ...
+
+    return {
+        "ok": True,
+        "customer_id": payload.customer_id,
+        "payment_method_id": payload.payment_method_id,
+        "default_payment_method": (
+            cust.invoice_settings.default_payment_method if hasattr(cust, "invoice_settings") else None
+        ),
+    }
+    
+# ---------- Twilio inbound SMS (YES/NO) ----------
+@app.post("/webhook/twilio")
+async def twilio_inbound(request: Request):
+    """
+    Expects Twilio form-encoded webhook (application/x-www-form-urlencoded).
+    Validates X-Twilio-Signature if TWILIO_AUTH_TOKEN is set.
+    Updates the sender's pending VERIFICATION_SMS row (from the in-memory index), else inserts a new row.
+    """
+    form = dict((await request.form()).items())
+    message_sid = form.get("MessageSid")
+    from_num = form.get("From")
+    body_raw = form.get("Body") or ""
+    body = body_raw.strip().lower()
+    session_id = form.get("SessionId") or None
+    donor_id = form.get("DonorId") or None
+
+    # Signature validation
+    if not _twilio_signature_ok(request, form):
+        raise HTTPException(status_code=403, detail="Invalid Twilio signature")
+
+    # Normalize YES/NO
+    result = "INVALID"
+    if body in {"y", "yes", "oui"}:
+        result = "YES"
+    elif body in {"n", "no", "non"}:
+        result = "NO"
+
+    await run_in_threadpool(_record_sms_reply, from_num, message_sid, body, body_raw, result, session_id, donor_id)
+
+    # TwiML response
+    text = "Thanks! Please proceed on the tablet." if result != "INVALID" else "Sorry, please reply YES or NO."
+    return PlainTextResponse(
+        f"""<?xml version="1.0" encoding="UTF-8"?><Response><Message>{text}</Message></Response>""",
+        media_type="application/xml",
+    )
+
+# ---------- Store-and-forward (write journal for core tablet writes) ----------
+# login / donor upsert / consent / signature are written through idempotent
+# "appliers". Normally they run against Snowflake inline; when Snowflake is down,
+# slow, or the journal still has a backlog (to keep order), the write is journaled
+# to a local SQLite WAL and a forwarder replays it in sequence.
+WRITE_JOURNAL_PATH = os.getenv("WRITE_JOURNAL_PATH", "write_journal.sqlite")
+DEGRADED_MODE = os.getenv("DEGRADED_MODE", "auto").lower()   # auto | always | off
+DIRECT_WRITE_TIMEOUT_SEC = float(os.getenv("DIRECT_WRITE_TIMEOUT_SEC", "5"))
+JOURNAL_FORWARD_BATCH = int(os.getenv("JOURNAL_FORWARD_BATCH", "50"))
+JOURNAL_FORWARD_IDLE_SEC = float(os.getenv("JOURNAL_FORWARD_IDLE_SEC", "1"))
+# Data errors (not connectivity) are set aside with backoff and dead-lettered after this many tries
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "5"))
+# A FORWARDING claim older than this belongs to a dead worker
+JOURNAL_CLAIM_STALE_SEC = int(os.getenv("JOURNAL_CLAIM_STALE_SEC", "300"))
+JOURNAL_RETAIN_SEC = int(os.getenv("JOURNAL_RETAIN_SEC", str(7 * 86400)))
+
+class JournalDependencyMissing(Exception):
+    """The row a journaled write updates isn't there (yet): retried later, never marked DONE."""
+
+def _journal_streams(payload: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """(session_id, donor_id) an entry belongs to; entries sharing either must apply in order."""
+    return payload.get("session_id"), payload.get("donor_id")
+
+class WriteJournal:
+    """
+    Append-only SQLite journal (synchronous=FULL: an acknowledged write survives a crash).
+    Every worker on the host shares the file: counts are re-read whenever another
+    connection has committed (PRAGMA data_version), and the forwarder claims rows
+    (PENDING -> FORWARDING) so each entry has exactly one owner.
+
+    Entries replay in order per stream (session / donor). An entry that failed on bad
+    data is parked (backoff, then DEAD) and holds back the later entries of its
+    streams until it is resolved; other streams keep flowing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending = 0        # entries the forwarder can take now
+        self._unforwarded = 0    # also counts parked entries and the ones waiting behind them
+        self._data_version = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS JOURNAL (
+                    SEQ INTEGER PRIMARY KEY AUTOINCREMENT, KIND TEXT NOT NULL, KEY TEXT, PAYLOAD TEXT NOT NULL,
+                    CREATED_AT REAL NOT NULL, STATE TEXT NOT NULL DEFAULT 'PENDING', FORWARDED_AT REAL,
+                    ATTEMPTS INTEGER NOT NULL DEFAULT 0, LAST_ERROR TEXT, OWNER TEXT, CLAIMED_AT REAL,
+                    NEXT_TRY_AT REAL, SESSION_ID TEXT, DONOR_ID TEXT)
+                """
+            )
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(JOURNAL)")}
+            for col in ("OWNER TEXT", "CLAIMED_AT REAL", "NEXT_TRY_AT REAL", "SESSION_ID TEXT", "DONOR_ID TEXT"):
+                if col.split()[0] not in cols:
+                    conn.execute(f"ALTER TABLE JOURNAL ADD COLUMN {col}")
+            if "SESSION_ID" not in cols:
+                conn.execute(
+                    "UPDATE JOURNAL SET SESSION_ID = json_extract(PAYLOAD, '$.session_id'), "
+                    "DONOR_ID = json_extract(PAYLOAD, '$.donor_id') WHERE STATE != 'DONE'"
+                )
+            conn.execute("CREATE INDEX IF NOT EXISTS JOURNAL_PENDING ON JOURNAL (STATE, SEQ)")
+            conn.execute("CREATE INDEX IF NOT EXISTS JOURNAL_KEY ON JOURNAL (KIND, KEY)")
+            conn.execute("CREATE INDEX IF NOT EXISTS JOURNAL_SESSION ON JOURNAL (SESSION_ID, STATE)")
+            conn.execute("CREATE INDEX IF NOT EXISTS JOURNAL_DONOR ON JOURNAL (DONOR_ID, STATE)")
+            conn.execute("CREATE TABLE IF NOT EXISTS DONOR_ALIAS (JOURNAL_ID TEXT PRIMARY KEY, DONOR_ID TEXT NOT NULL)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _owner() -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _refresh(self):
+        """Recounts unforwarded rows if any connection (this one included) has committed since the last count."""
+        conn = self._db()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._unforwarded = conn.execute(
+                "SELECT COUNT(*) FROM JOURNAL WHERE STATE IN ('PENDING', 'FORWARDING', 'DEAD')"
+            ).fetchone()[0]
+            # Parked entries (failed before, or DEAD) and whatever shares a stream with one don't count
+            self._pending = conn.execute(
+                """
+                SELECT COUNT(*) FROM JOURNAL J
+                WHERE J.STATE IN ('PENDING', 'FORWARDING') AND J.ATTEMPTS = 0
+                  AND NOT EXISTS (
+                      SELECT 1 FROM JOURNAL P
+                      WHERE P.SEQ < J.SEQ AND (P.STATE = 'DEAD' OR (P.STATE IN ('PENDING', 'FORWARDING') AND P.ATTEMPTS > 0))
+                        AND (P.SESSION_ID = J.SESSION_ID OR P.DONOR_ID = J.DONOR_ID))
+                """
+            ).fetchone()[0] if self._unforwarded else 0
+            self._data_version = version
+
+    def _changed(self):
+        # data_version only moves for other connections' commits; force a recount after our own
+        self._data_version = None
+
+    def append(self, kind: str, key: Optional[str], payload: Dict[str, Any]) -> int:
+        body = json.dumps(payload, default=_json_default)
+        with self._lock:
+            seq = self._db().execute(
+                "INSERT INTO JOURNAL (KIND, KEY, PAYLOAD, CREATED_AT, SESSION_ID, DONOR_ID) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, body, time.time(), *_journal_streams(payload)),
+            ).lastrowid
+            self._changed()
+        metric_inc(f"write_journal.appended.{kind}")
+        return seq
+
+    def pending_count(self) -> int:
+        """Entries waiting to be forwarded (parked ones and those held behind them excluded)."""
+        with self._lock:
+            self._refresh()
+            return self._pending
+
+    def stream_blocked(self, payload: Dict[str, Any]) -> bool:
+        """True if an unforwarded entry shares this write's session/donor, so it must queue behind it."""
+        session_id, donor_id = _journal_streams(payload)
+        if not session_id and not donor_id:
+            return False
+        with self._lock:
+            self._refresh()
+            if self._unforwarded == 0:
+                return False
+            row = self._conn.execute(
+                """
+                SELECT 1 FROM JOURNAL WHERE STATE IN ('PENDING', 'FORWARDING', 'DEAD')
+                  AND (SESSION_ID = ? OR DONOR_ID = ?) LIMIT 1
+                """,
+                (session_id, donor_id),
+            ).fetchone()
+        return row is not None
+
+    def claim(self, limit: int) -> List[Tuple[int, str, Dict[str, Any], int]]:
+        """
+        Takes ownership of up to `limit` entries, oldest first. Only one process
+        forwards at a time (order matters: a consent must follow its donor); a claim
+        older than JOURNAL_CLAIM_STALE_SEC belongs to a dead worker and is taken over.
+        Parked entries (backing off, or DEAD) are skipped along with every later entry
+        that shares a session/donor with them.
+        """
+        owner = self._owner()
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                busy = conn.execute(
+                    "SELECT 1 FROM JOURNAL WHERE STATE = 'FORWARDING' AND OWNER != ? AND CLAIMED_AT >= ? LIMIT 1",
+                    (owner, now - JOURNAL_CLAIM_STALE_SEC),
+                ).fetchone()
+                if busy:
+                    conn.execute("COMMIT")
+                    return []
+                conn.execute("UPDATE JOURNAL SET STATE = 'PENDING', OWNER = NULL WHERE STATE = 'FORWARDING'")
+                rows = conn.execute(
+                    """
+                    SELECT SEQ, KIND, ATTEMPTS, STATE, NEXT_TRY_AT, SESSION_ID, DONOR_ID FROM JOURNAL
+                    WHERE STATE IN ('PENDING', 'DEAD') ORDER BY SEQ
+                    """
+                ).fetchall()
+                claimed, blocked = [], set()
+                for seq, kind, attempts, state, next_try_at, session_id, donor_id in rows:
+                    if len(claimed) >= limit:
+                        break
+                    streams = {k for k in zip("SD", (session_id, donor_id)) if k[1]}
+                    if state == "DEAD" or (next_try_at or 0) > now or streams & blocked:
+                        blocked |= streams
+                        continue
+                    cur = conn.execute(
+                        "UPDATE JOURNAL SET STATE = 'FORWARDING', OWNER = ?, CLAIMED_AT = ? "
+                        "WHERE SEQ = ? AND STATE = 'PENDING'",
+                        (owner, now, seq),
+                    )
+                    if cur.rowcount == 1:
+                        body = conn.execute("SELECT PAYLOAD FROM JOURNAL WHERE SEQ = ?", (seq,)).fetchone()[0]
+                        claimed.append((seq, kind, json.loads(body), attempts))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._changed()
+        return claimed
+
+    def release(self, seqs: List[int]):
+        """Hands claimed-but-unapplied entries back (e.g. Snowflake went away mid-batch)."""
+        if not seqs:
+            return
+        with self._lock:
+            self._db().executemany(
+                "UPDATE JOURNAL SET STATE = 'PENDING', OWNER = NULL WHERE SEQ = ? AND STATE = 'FORWARDING' AND OWNER = ?",
+                [(seq, self._owner()) for seq in seqs],
+            )
+            self._changed()
+
+    def lag_sec(self) -> float:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT MIN(CREATED_AT) FROM JOURNAL WHERE STATE IN ('PENDING', 'FORWARDING')"
+            ).fetchone()
+        return max(0.0, time.time() - row[0]) if row and row[0] else 0.0
+
+    def mark_done(self, seq: int):
+        with self._lock:
+            self._db().execute(
+                "UPDATE JOURNAL SET STATE = 'DONE', FORWARDED_AT = ? WHERE SEQ = ? AND STATE = 'FORWARDING' AND OWNER = ?",
+                (time.time(), seq, self._owner()),
+            )
+            self._changed()
+
+    def mark_failed(self, seq: int, error: str, dead: bool, retry_in: float = 0.0):
+        """Sets a data error aside: DEAD, or back to PENDING but not retried for `retry_in` seconds."""
+        with self._lock:
+            self._db().execute(
+                """
+                UPDATE JOURNAL SET ATTEMPTS = ATTEMPTS + 1, LAST_ERROR = ?, STATE = ?, OWNER = NULL, NEXT_TRY_AT = ?
+                WHERE SEQ = ? AND STATE = 'FORWARDING' AND OWNER = ?
+                """,
+                (error[:2000], "DEAD" if dead else "PENDING", time.time() + retry_in, seq, self._owner()),
+            )
+            self._changed()
+
+    def latest(self, kind: str, key: str) -> Optional[Dict[str, Any]]:
+        """Newest not-yet-forwarded payload for (kind, key); reads use it until the forwarder catches up."""
+        with self._lock:
+            self._refresh()
+            if self._unforwarded == 0:
+                return None
+            row = self._conn.execute(
+                """
+                SELECT PAYLOAD FROM JOURNAL WHERE KIND = ? AND KEY = ? AND STATE IN ('PENDING', 'FORWARDING')
+                ORDER BY SEQ DESC LIMIT 1
+                """,
+                (kind, key),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pending_donor_for_email(self, email: str) -> Optional[str]:
+        with self._lock:
+            self._refresh()
+            if self._unforwarded == 0:
+                return None
+            row = self._conn.execute(
+                """
+                SELECT KEY FROM JOURNAL WHERE KIND = 'donor_upsert' AND STATE IN ('PENDING', 'FORWARDING')
+                  AND json_extract(PAYLOAD, '$.email') = ? ORDER BY SEQ DESC LIMIT 1
+                """,
+                (email,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_alias(self, journal_id: str, donor_id: str):
+        with self._lock:
+            self._db().execute("INSERT OR REPLACE INTO DONOR_ALIAS VALUES (?, ?)", (journal_id, donor_id))
+
+    def canonical_donor_id(self, donor_id: Optional[str]) -> Optional[str]:
+        """A donor_id handed out while degraded may have merged into an existing donor on replay."""
+        if not donor_id:
+            return donor_id
+        with self._lock:
+            row = self._db().execute("SELECT DONOR_ID FROM DONOR_ALIAS WHERE JOURNAL_ID = ?", (donor_id,)).fetchone()
+        return row[0] if row else donor_id
+
+    def prune(self):
+        with self._lock:
+            self._db().execute("DELETE FROM JOURNAL WHERE STATE = 'DONE' AND FORWARDED_AT < ?",
+                               (time.time() - JOURNAL_RETAIN_SEC,))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self._db().execute("SELECT STATE, COUNT(*) FROM JOURNAL GROUP BY STATE").fetchall())
+            self._refresh()
+            ready = self._pending
+        unforwarded = counts.get("PENDING", 0) + counts.get("FORWARDING", 0)
+        return {"mode": DEGRADED_MODE, "pending": ready, "held": unforwarded - ready,
+                "dead": counts.get("DEAD", 0), "lag_sec": round(self.lag_sec(), 1)}
+
+write_journal = WriteJournal(WRITE_JOURNAL_PATH)
+
+# kind -> applier(cur, payload); must be idempotent, the forwarder may replay after a partial apply
+JOURNAL_APPLIERS: Dict[str, Callable] = {}
+
+def journal_applier(kind: str):
+    def register(fn):
+        JOURNAL_APPLIERS[kind] = fn
+        return fn
+    return register
+
+def _is_unavailable(e: Exception) -> bool:
+    """Connectivity-type failures (worth journaling) as opposed to bad data."""
+    if isinstance(e, (TimeoutError, ConnectionError, FutureTimeout)):
+        return True
+    return type(e).__name__ in ("OperationalError", "InterfaceError")
+
+def _snowflake_down() -> bool:
+    probe = dependency_probes.get("snowflake")
+    if probe is None:
+        return False
+    snap = probe.snapshot()
+    return snap["status"] == "DOWN" or (snap.get("last_success") is not None and not probe.healthy())
+
+def _should_journal(payload: Dict[str, Any]) -> bool:
+    if DEGRADED_MODE == "off":
+        return False
+    if DEGRADED_MODE == "always":
+        return True
+    # A backlog keeps order; a parked entry only holds back writes for its own session/donor
+    return write_journal.pending_count() > 0 or _snowflake_down() or write_journal.stream_blocked(payload)
+
+_direct_write_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="direct-write")
+
+def _apply_now(kind: str, payload: Dict[str, Any]):
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        return JOURNAL_APPLIERS[kind](cur, payload)
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+def journaled_write(kind: str, key: Optional[str], payload: Dict[str, Any]) -> Tuple[Any, bool]:
+    """
+    Applies the write inline, or journals it; returns (applier result, journaled).
+    A direct write that is still running after DIRECT_WRITE_TIMEOUT_SEC is also
+    journaled; whichever lands second is a no-op.
+    """
+    if _should_journal(payload):
+        write_journal.append(kind, key, payload)
+        return None, True
+    if DEGRADED_MODE == "off":
+        return _apply_now(kind, payload), False
+    future = _direct_write_pool.submit(in_current_workload(_apply_now), kind, payload)
+    try:
+        return future.result(timeout=DIRECT_WRITE_TIMEOUT_SEC), False
+    except Exception as e:
+        if not _is_unavailable(e):
+            raise
+        metric_inc(f"write_journal.fallback.{kind}")
+        print(f"=== DEBUG: journaling {kind} {key} after direct write failed: {e!r} ===")
+        write_journal.append(kind, key, payload)
+        return None, True
+
+def _insert_event_once(cur, ev: LogEventIn, event_id: str):
+    """Journal appliers are server-side writes, so these events feed the rollups."""
+    exists = cur.execute("SELECT 1 FROM EVENT_LOG WHERE EVENT_ID = %s LIMIT 1", (event_id,)).fetchone()
+    if not exists:
+        insert_event(cur, ev, event_id=event_id, rollups=True)
+
+def _journal_forward_once() -> int:
+    """Forwards one claimed batch in order; returns how many entries were handled (applied or set aside)."""
+    entries = write_journal.claim(JOURNAL_FORWARD_BATCH)
+    metric_set("write_journal.pending", write_journal.pending_count())
+    metric_set("write_journal.lag_sec", write_journal.lag_sec())
+    if not entries:
+        return 0
+    handled = 0
+    try:
+        ctx = get_snowflake_ctx()
+    except Exception:
+        write_journal.release([seq for seq, _, _, _ in entries])
+        raise
+    blocked, held = set(), []
+    try:
+        cur = ctx.cursor()
+        for i, (seq, kind, payload, attempts) in enumerate(entries):
+            streams = {k for k in zip("SD", _journal_streams(payload)) if k[1]}
+            if streams & blocked:
+                # Depends on an entry that just failed: wait behind it (claim() skips it from now on)
+                blocked |= streams
+                held.append(seq)
+                continue
+            try:
+                JOURNAL_APPLIERS[kind](cur, payload)
+            except Exception as e:
+                if _is_unavailable(e):
+                    # Snowflake went away: hand the rest back and let the loop back off
+                    write_journal.release(held + [s for s, _, _, _ in entries[i:]])
+                    raise
+                # Bad data parks this entry and its session/donor; other streams keep flowing
+                blocked |= streams
+                dead = attempts + 1 >= JOURNAL_MAX_ATTEMPTS
+                write_journal.mark_failed(seq, str(e), dead, retry_in=min(600.0, 30.0 * 2 ** attempts))
+                metric_inc("write_journal.dead" if dead else "write_journal.apply_errors")
+                print(f"=== DEBUG: journal entry {seq} ({kind}) failed{' (dead)' if dead else ''}: {e} ===")
+                handled += 1
+                continue
+            write_journal.mark_done(seq)
+            metric_inc(f"write_journal.forwarded.{kind}")
+            handled += 1
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    write_journal.release(held)
+    return handled
+
+def _journal_forward_loop():
+    failures = 0
+    last_prune = 0.0
+    while True:
+        try:
+            n = _journal_forward_once()
+            failures = 0
+        except Exception as e:
+            # Snowflake unavailable: entries stay in order, back off and retry the same head entry
+            failures += 1
+            print(f"=== DEBUG: journal forward failed ({failures}): {e} ===")
+            time.sleep(min(60.0, 2 ** min(failures, 6)) * (0.5 + random.random()))
+            continue
+        if time.time() - last_prune > 3600:
+            write_journal.prune()
+            last_prune = time.time()
+        if n == 0:
+            time.sleep(JOURNAL_FORWARD_IDLE_SEC)
+
+@app.on_event("startup")
+def _start_journal_forwarder():
+    if DEGRADED_MODE != "off":
+        threading.Thread(target=run_as_workload("background", _journal_forward_loop), name="journal-forwarder", daemon=True).start()
+
+@journal_applier("session_start")
+def _apply_session_start(cur, p: Dict[str, Any]):
+    cur.execute(
+        """
+        MERGE INTO SESSION T
+        USING (SELECT %s AS SESSION_ID, %s AS FUNDRAISER_ID, %s AS CHARITY_ID, %s AS CAMPAIGN_ID,
+                      %s AS DEVICE_ID, TO_TIMESTAMP_NTZ(%s) AS CREATED_AT) S
+        ON T.SESSION_ID = S.SESSION_ID
+        WHEN NOT MATCHED THEN INSERT (SESSION_ID, FUNDRAISER_ID, CHARITY_ID, CAMPAIGN_ID, STATE, DEVICE_ID, CREATED_AT)
+            VALUES (S.SESSION_ID, S.FUNDRAISER_ID, S.CHARITY_ID, S.CAMPAIGN_ID, 'STARTED', S.DEVICE_ID, S.CREATED_AT)
+        """,
+        (p["session_id"], p["fundraiser_id"], p.get("charity_id"), p.get("campaign_id"), p.get("device_id"),
+         int(p["ts"])),
+    )
+    _insert_event_once(cur, LogEventIn(
+        event_type="SESSION_STARTED",
+        session_id=p["session_id"],
+        fundraiser_id=p["fundraiser_id"],
+        attributes=p["attributes"],
+    ), p["event_id"])
+
+@journal_applier("donor_upsert")
+def _apply_donor_upsert(cur, p: Dict[str, Any]) -> str:
+    fields = (p.get("title"), p["first_name"], p.get("middle_name"), p["last_name"], p["dob_iso"],
+              p["mobile_e164"], p["email"], p["address1"], p.get("address2"), p["city"],
+              p["region"], p["postal_code"], p["country"])
+    # Look up by email (canonical)
+    row = repo_one(cur, "donor.id_by_email", (p["email"],))
+    if row:
+        donor_id = row[0]
+        cur.execute(
+            """
+            UPDATE DONOR SET
+              TITLE=%s, FIRST_NAME=%s, MIDDLE_NAME=%s, LAST_NAME=%s, DOB_DATE=%s,
+              MOBILE_E164=%s, EMAIL=%s, ADDRESS1=%s, ADDRESS2=%s, CITY=%s,
+              REGION=%s, POSTAL_CODE=%s, COUNTRY=%s, UPDATED_AT=CURRENT_TIMESTAMP()
+            WHERE DONOR_ID=%s
+            """,
+            (*fields, donor_id),
+        )
+        action = "UPDATE"
+    else:
+        donor_id = p["donor_id"]
+        cur.execute(
+            """
+            INSERT INTO DONOR (DONOR_ID, TITLE, FIRST_NAME, MIDDLE_NAME, LAST_NAME, DOB_DATE,
+                               MOBILE_E164, EMAIL, ADDRESS1, ADDRESS2, CITY, REGION, POSTAL_CODE, COUNTRY, CREATED_AT)
+            SELECT %s,%s,%s,%s,%s,%s,
+                   %s,%s,%s,%s,%s,%s,%s,%s, TO_TIMESTAMP_NTZ(%s)
+            """,
+            (donor_id, *fields, int(p["ts"])),
+        )
+        action = "INSERT"
+    if donor_id != p["donor_id"]:
+        write_journal.set_alias(p["donor_id"], donor_id)
+
+    # Pull session’s campaign/charity snapshot
+    sess = repo_one(cur, "session.by_id", (p["session_id"],))
+    charity_id = sess.CHARITY_ID if sess else None
+    campaign_id = sess.CAMPAIGN_ID if sess else None
+
+    # Record donor-session (with campaign/charity)
+    cur.execute(
+        """
+        MERGE INTO DONOR_SESSION T
+        USING (SELECT %s AS SESSION_ID, %s AS DONOR_ID, %s AS FUNDRAISER_ID, %s AS CHARITY_ID,
+                      %s AS CAMPAIGN_ID, TO_TIMESTAMP_NTZ(%s) AS CREATED_AT) S
+        ON T.SESSION_ID = S.SESSION_ID AND T.DONOR_ID = S.DONOR_ID
+        WHEN NOT MATCHED THEN INSERT (SESSION_ID, DONOR_ID, FUNDRAISER_ID, CHARITY_ID, CAMPAIGN_ID, CREATED_AT)
+            VALUES (S.SESSION_ID, S.DONOR_ID, S.FUNDRAISER_ID, S.CHARITY_ID, S.CAMPAIGN_ID, S.CREATED_AT)
+        """,
+        (p["session_id"], donor_id, p["fundraiser_id"], charity_id, campaign_id, int(p["ts"])),
+    )
+
+    _insert_event_once(cur, LogEventIn(
+        event_type=f"DONOR_{action}",
+        session_id=p["session_id"],
+        donor_id=donor_id,
+        fundraiser_id=p["fundraiser_id"],
+        attributes={"email": p["email"], "mobile": p["mobile_e164"]},
+    ), p["event_id"])
+    return donor_id
 
-    return {
-        "ok": True,
-        "customer_id": payload.customer_id,
-        "payment_method_id": payload.payment_method_id,
-        "default_payment_method": (
-            cust.invoice_settings.default_payment_method if hasattr(cust, "invoice_settings") else None
-        ),
-    }
-    
-# ---------- Twilio inbound SMS (YES/NO) ----------
-@app.post("/webhook/twilio")
-async def twilio_inbound(request: Request):
+@journal_applier("donor_consent")
+def _apply_donor_consent(cur, p: Dict[str, Any]):
+    donor_id = write_journal.canonical_donor_id(p["donor_id"])
+    cur.execute(
+        """
+        UPDATE DONOR
+        SET CONSENT_SMS = %s,
+            CONSENT_EMAIL = %s,
+            CONSENT_MAIL = %s,
+            UPDATED_AT = CURRENT_TIMESTAMP()
+        WHERE DONOR_ID = %s
+        """,
+        (p["consent_sms"], p["consent_email"], p["consent_mail"], donor_id),
+    )
+    if cur.rowcount == 0:
+        # Its donor_upsert hasn't landed: don't let the forwarder mark this DONE and lose the consent
+        raise JournalDependencyMissing(f"donor {donor_id} not found for consent")
+    _insert_event_once(cur, LogEventIn(
+        event_type="DONOR_CONSENT_UPDATE",
+        session_id=p["session_id"],
+        donor_id=donor_id,
+        attributes={
+            "consent_sms": p["consent_sms"],
+            "consent_email": p["consent_email"],
+            "consent_mail": p["consent_mail"],
+        },
+    ), p["event_id"])
+
+@journal_applier("signature")
+def _apply_signature(cur, p: Dict[str, Any]) -> Optional[str]:
+    donor_id = write_journal.canonical_donor_id(p["donor_id"])
+    # PUT works ONLY on INTERNAL stages — which ASSETS_INT is; OVERWRITE makes a replay harmless
+    storage.put_blob(cur, p["stage_uri"], base64.b64decode(p["png_b64"]))
+
+    # Store metadata
+    cur.execute(
+        """
+        MERGE INTO SIGNATURE T
+        USING (SELECT %s AS SIGNATURE_ID, %s AS DONOR_ID, %s AS SESSION_ID, %s AS SIGNATURE_IMAGE,
+                      %s AS HASH_SHA256, TO_TIMESTAMP_NTZ(%s) AS CAPTURED_AT) S
+        ON T.SIGNATURE_ID = S.SIGNATURE_ID
+        WHEN NOT MATCHED THEN INSERT (SIGNATURE_ID, DONOR_ID, SESSION_ID, SIGNATURE_IMAGE, HASH_SHA256, CAPTURED_AT)
+            VALUES (S.SIGNATURE_ID, S.DONOR_ID, S.SESSION_ID, S.SIGNATURE_IMAGE, S.HASH_SHA256, S.CAPTURED_AT)
+        """,
+        (p["signature_id"], donor_id, p["session_id"], p["stage_uri"], p["hash_sha256"], int(p["ts"])),
+    )
+    _insert_event_once(cur, LogEventIn(
+        event_type="SIGNATURE_CAPTURED",
+        session_id=p["session_id"],
+        donor_id=donor_id,
+        attributes={
+            "signature_id": p["signature_id"],
+            "hash_sha256": p["hash_sha256"],
+            "file_size": p["file_size"],
+            "stage_path": p["rel_path"],
+            "stage": SIGNATURE_STAGE_NAME,
+        },
+    ), p["event_id"])
+    # Presign the uploaded file (works fine for internal stages)
+    return presign_stage_url(cur, p["stage_uri"], expires_sec=3600)
+
+# ---------- Async statement submission (fire-and-forget writes) ----------
+# Writes nothing reads back right away are submitted with execute_async. The
+# request returns once Snowflake has accepted the statement, and the statement
+# keeps running server-side even if this process goes away. A tracker polls the
+# query ids, retries statements that failed, and journals ("statement" kind) any
+# retry it can't submit because Snowflake is unreachable. Only keyed MERGE
+# upserts go this way, so a resubmitted or replayed statement lands once.
+ASYNC_WRITES = os.getenv("ASYNC_WRITES", "1") == "1"
+ASYNC_WRITE_POLL_SEC = float(os.getenv("ASYNC_WRITE_POLL_SEC", "0.5"))
+ASYNC_WRITE_MAX_ATTEMPTS = int(os.getenv("ASYNC_WRITE_MAX_ATTEMPTS", "3"))
+ASYNC_WRITE_MAX_INFLIGHT = int(os.getenv("ASYNC_WRITE_MAX_INFLIGHT", "2000"))
+ASYNC_WRITE_TIMEOUT_SEC = int(os.getenv("ASYNC_WRITE_TIMEOUT_SEC", "600"))
+_ASYNC_DML_RE = re.compile(r"^\s*MERGE\b", re.IGNORECASE)
+
+class _AsyncWrite:
+    __slots__ = ("label", "sql", "params", "attempts", "submitted_at")
+
+    def __init__(self, label: str, sql: str, params):
+        self.label = label
+        self.sql = sql
+        self.params = params
+        self.attempts = 0
+        self.submitted_at = 0.0
+
+class AsyncWriteTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _AsyncWrite] = {}   # query id -> write
+        self._retry: List[Tuple[float, int, _AsyncWrite]] = []   # heap of (due, seq, write)
+        self._seq = itertools.count()
+
+    def accepting(self) -> bool:
+        """False when disabled or too far behind; callers then execute inline (backpressure)."""
+        if not ASYNC_WRITES:
+            return False
+        with self._lock:
+            return len(self._inflight) + len(self._retry) < ASYNC_WRITE_MAX_INFLIGHT
+
+    def submit(self, cur, label: str, sql: str, params=None) -> str:
+        return self._submit(cur, _AsyncWrite(label, sql, params))
+
+    def _submit(self, cur, w: _AsyncWrite) -> str:
+        w.attempts += 1
+        w.submitted_at = time.time()
+        cur.execute_async(w.sql, w.params)
+        qid = cur.sfqid
+        with self._lock:
+            self._inflight[qid] = w
+        metric_inc(f"async_writes.submitted.{w.label}")
+        return qid
+
+    def _failed(self, w: _AsyncWrite, error):
+        if w.attempts < ASYNC_WRITE_MAX_ATTEMPTS:
+            metric_inc(f"async_writes.retried.{w.label}")
+            due = time.time() + min(30.0, 2 ** w.attempts) * (0.5 + random.random())
+            with self._lock:
+                heapq.heappush(self._retry, (due, next(self._seq), w))
+            print(f"=== DEBUG: async write {w.label} failed (attempt {w.attempts}), retrying: {error} ===")
+        else:
+            metric_inc(f"async_writes.dead.{w.label}")
+            print(f"=== DEBUG: async write {w.label} dropped after {w.attempts} attempts: {error} | {w.sql.strip()[:200]} ===")
+
+    def _journal(self, w: _AsyncWrite, error):
+        if DEGRADED_MODE == "off":
+            return self._failed(w, error)
+        write_journal.append("statement", w.label, {"label": w.label, "sql": w.sql, "params": list(w.params or ())})
+        metric_inc(f"async_writes.journaled.{w.label}")
+
+    def poll_once(self) -> int:
+        now = time.time()
+        with self._lock:
+            due = []
+            while self._retry and self._retry[0][0] <= now:
+                due.append(heapq.heappop(self._retry)[2])
+            inflight = list(self._inflight.items())
+        metric_set("async_writes.inflight", len(inflight))
+        if not due and not inflight:
+            return 0
+        try:
+            ctx = get_snowflake_ctx()
+        except Exception as e:
+            for w in due:
+                self._journal(w, e)
+            raise
+        try:
+            # Retries first, so a failed poll below can't strand them
+            for i, w in enumerate(due):
+                try:
+                    self._submit(ctx.cursor(), w)
+                except Exception as e:
+                    if _is_unavailable(e):
+                        for rest in due[i:]:
+                            self._journal(rest, e)
+                        raise
+                    self._failed(w, e)
+            for qid, w in inflight:
+                try:
+                    status = ctx.get_query_status(qid)
+                except Exception as e:
+                    if _is_unavailable(e):
+                        raise
+                    status, error = None, e
+                if status is not None and ctx.is_still_running(status):
+                    if now - w.submitted_at > ASYNC_WRITE_TIMEOUT_SEC:
+                        with self._lock:
+                            self._inflight.pop(qid, None)
+                        metric_inc(f"async_writes.abandoned.{w.label}")
+                        print(f"=== DEBUG: async write {w.label} still running after {ASYNC_WRITE_TIMEOUT_SEC}s, untracking {qid} ===")
+                    continue
+                with self._lock:
+                    self._inflight.pop(qid, None)
+                if status is not None and ctx.is_an_error(status):
+                    try:
+                        ctx.get_query_status_throw_if_error(qid)
+                        error = status.name
+                    except Exception as e:
+                        error = e
+                if status is None or ctx.is_an_error(status):
+                    self._failed(w, error)
+                    continue
+                metric_inc(f"async_writes.succeeded.{w.label}")
+                metric_observe(f"async_writes.{w.label}", now - w.submitted_at)
+        finally:
+            ctx.close()
+        return len(due) + len(inflight)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"enabled": ASYNC_WRITES, "inflight": len(self._inflight), "retrying": len(self._retry)}
+
+async_writes = AsyncWriteTracker()
+
+class AsyncWriteCursor:
     """
-    Expects Twilio form-encoded webhook (application/x-www-form-urlencoded).
-    Validates X-Twilio-Signature if TWILIO_AUTH_TOKEN is set.
-    Updates the most recent pending VERIFICATION_SMS row for the sender, else inserts a new row.
+    Cursor wrapper: keyed MERGE upserts go through async_writes; everything else
+    (plain INSERT/UPDATE/DELETE, reads, DDL) runs inline on the wrapped cursor.
     """
-    form = dict((await request.form()).items())
-    message_sid = form.get("MessageSid")
-    from_num = form.get("From")
-    body_raw = form.get("Body") or ""
-    body = body_raw.strip().lower()
-    session_id = form.get("SessionId") or None
-    donor_id = form.get("DonorId") or None
 
-    # Signature validation
-    if twilio_validator:
-        url = str(request.url)
-        signature = request.headers.get("X-Twilio-Signature")
-        if not signature or not twilio_validator.validate(url, form, signature):
-            raise HTTPException(status_code=403, detail="Invalid Twilio signature")
+    def __init__(self, cur, label: str):
+        self._cur = cur
+        self.label = label
 
-    # Normalize YES/NO
-    result = "INVALID"
-    if body in {"y", "yes", "oui"}:
-        result = "YES"
-    elif body in {"n", "no", "non"}:
-        result = "NO"
+    def execute(self, sql: str, params=None):
+        if _ASYNC_DML_RE.match(sql) and hasattr(self._cur, "execute_async") and async_writes.accepting():
+            async_writes.submit(self._cur, self.label, sql, params)
+        elif params is None:
+            self._cur.execute(sql)
+        else:
+            self._cur.execute(sql, params)
+        return self
 
-    ctx = get_snowflake_ctx()
-    try:
-        cur = ctx.cursor()
-        # Match most recent outbound row for this sender with no inbound yet
-        row = cur.execute(
-            """
-            SELECT VERIF_ID, SESSION_ID, DONOR_ID
-            FROM VERIFICATION_SMS
-            WHERE MOBILE_E164 = %s AND INBOUND_TS IS NULL
-            ORDER BY SENT_TS DESC
-            LIMIT 1
-            """,
-            (from_num,),
-        ).fetchone()
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
 
-        if row:
-            verif_id, session_id_db, donor_id_db = row
-            cur.execute(
-                """
-                UPDATE VERIFICATION_SMS
-                SET INBOUND_TS = CURRENT_TIMESTAMP(),
-                    INBOUND_BODY = %s,
-                    RESULT = %s,
-                    TWILIO_MSG_SID = COALESCE(TWILIO_MSG_SID, %s)
-                WHERE VERIF_ID = %s
-                """,
-                (body, result, message_sid, verif_id),
-            )
-            session_id = session_id or session_id_db
-            donor_id = donor_id or donor_id_db
-        else:
-            # No match → insert standalone inbound
-            cur.execute(
-                """
-                INSERT INTO VERIFICATION_SMS
-                (VERIF_ID, SESSION_ID, DONOR_ID, SENT_TS, MESSAGE_BODY,
-                 INBOUND_TS, INBOUND_BODY, RESULT, TWILIO_MSG_SID, MOBILE_E164)
-                SELECT %s, %s, %s, NULL, NULL,
-                       CURRENT_TIMESTAMP(), %s, %s, %s, %s
-                """,
-                (
-                    f"tw-{message_sid or datetime.now(timezone.utc).timestamp()}",
-                    session_id,
-                    donor_id,
-                    body,
-                    result,
-                    message_sid,
-                    from_num,
-                ),
-            )
+@journal_applier("statement")
+def _apply_statement(cur, p: Dict[str, Any]):
+    # An async write whose retry couldn't be submitted; only keyed MERGE upserts are sent async, so a replay lands once
+    cur.execute(p["sql"], tuple(p["params"]) if p["params"] else None)
 
-        insert_event(
-            cur,
-            LogEventIn(
-                event_type=f"SMS_REPLY_{result}",
-                session_id=session_id,
-                donor_id=donor_id,
-                attributes={"from": from_num, "body": body_raw, "message_sid": message_sid},
-            ),
-        )
-    finally:
-        try: cur.close()
-        except Exception: pass
-        ctx.close()
+def _async_write_loop():
+    failures = 0
+    while True:
+        try:
+            async_writes.poll_once()
+            failures = 0
+        except Exception as e:
+            failures += 1
+            print(f"=== DEBUG: async write poll failed ({failures}): {e} ===")
+            time.sleep(min(30.0, 2 ** min(failures, 5)))
+            continue
+        time.sleep(ASYNC_WRITE_POLL_SEC)
 
-    # TwiML response
-    text = "Thanks! Please proceed on the tablet." if result != "INVALID" else "Sorry, please reply YES or NO."
-    return PlainTextResponse(
-        f"""<?xml version="1.0" encoding="UTF-8"?><Response><Message>{text}</Message></Response>""",
-        media_type="application/xml",
-    )
+@app.on_event("startup")
+def _start_async_write_tracker():
+    if ASYNC_WRITES and STORAGE_BACKEND == "snowflake":
+        threading.Thread(target=run_as_workload("background", _async_write_loop), name="async-writes", daemon=True).start()
 
 # ---------- UI Routing ----------
 @app.post("/fundraiser/login", response_model=FundraiserLoginOut)
-def fundraiser_login(payload: FundraiserLoginIn):
+def fundraiser_login(payload: FundraiserLoginIn, request: Request):
     """
     Look up fundraiser, join charity/campaign, start a session, log it, return branding payload.
     """
-    session_id = f"sess-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}"
-    ctx = get_snowflake_ctx()
+    enforce_rate_limit("login", request, fundraiser=payload.fundraiser_id)
+    session_id = new_id("sess")
+    # Reference reads come from the snapshot/caches; only a miss opens a connection
+    cur = _LazyCursor()
     try:
-        cur = ctx.cursor()
-        cur.execute(
-            """
-            SELECT FUNDRAISER_ID, DISPLAY_NAME, EMAIL, ACTIVE, CHARITY_ID, CAMPAIGN_ID
-            FROM FUNDRAISER
-            WHERE FUNDRAISER_ID = %s AND COALESCE(ACTIVE, TRUE) = TRUE
-            """,
-            (payload.fundraiser_id,),
-        )
-        fund = row_to_dict(cur, cur.fetchone())
+        fund = _read_fundraiser(cur, payload.fundraiser_id)
         if not fund:
             raise HTTPException(status_code=404, detail="Fundraiser not found or inactive")
-        
-        charity = None
-        if fund.get("CHARITY_ID"):
-            cur.execute(
-                """
-                SELECT CHARITY_ID, NAME, BRAND_PRIMARY_HEX, LOGO_URL, BLURB, TERMS_URL, COUNTRY
-                FROM CHARITY WHERE CHARITY_ID = %s
-                """,
-                (fund["CHARITY_ID"],),
-            )
-            charity = row_to_dict(cur, cur.fetchone())
-            print(f"=== DEBUG: Raw charity data: {charity} ===")
-            
-        # Handle logo URL presigning with debugging
-        if charity and (charity.get("LOGO_URL") or "").startswith("@"):
-            try:
-                original_url = charity["LOGO_URL"]
-                print(f"=== DEBUG: Original logo URL: {original_url} ===")
-                
-                presigned = presign_stage_url(cur, charity["LOGO_URL"], expires_sec=3600)
-                print(f"=== DEBUG: Presigned URL result: {presigned} ===")
-                
-                if presigned:
-                    charity["LOGO_URL"] = presigned
-                    print(f"=== DEBUG: Updated charity LOGO_URL to: {charity['LOGO_URL']} ===")
-                else:
-                    print(f"=== DEBUG: Presign returned None, keeping original: {original_url} ===")
-            except Exception as e:
-                print(f"=== DEBUG: Presign failed with error: {e} ===")
-                # Don't crash login if presign fails; just leave the original value
-                pass
-        elif charity:
-            print(f"=== DEBUG: Logo URL doesn't start with @: {charity.get('LOGO_URL')} ===")
-        else:
+
+        charity = _read_charity(cur, fund["CHARITY_ID"]) if fund.get("CHARITY_ID") else None
+        if not charity:
             print("=== DEBUG: No charity found ===")
 
-        # Rest of your existing code...
-        campaign = None
-        if fund.get("CAMPAIGN_ID"):
-            cur.execute(
-                """
-                SELECT CAMPAIGN_ID, CHARITY_ID, NAME, START_DATE, END_DATE, MONTHLY_DEFAULT,
-                       PRESET_AMOUNTS, MIN_AMOUNT, CURRENCY
-                FROM CAMPAIGN WHERE CAMPAIGN_ID = %s
-                """,
-                (fund["CAMPAIGN_ID"],),
-            )
-            campaign = row_to_dict(cur, cur.fetchone())
-            
-        cur.execute(
-            """
-            INSERT INTO SESSION (SESSION_ID, FUNDRAISER_ID, CHARITY_ID, CAMPAIGN_ID, STATE, DEVICE_ID, CREATED_AT)
-            SELECT %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP()
-            """,
-            (
-                session_id,
-                fund["FUNDRAISER_ID"],
-                fund.get("CHARITY_ID"),
-                fund.get("CAMPAIGN_ID"),
-                "STARTED",
-                os.getenv("APP_DEVICE_ID", None),
-            ),
-        )
-        
-        insert_event(
-            cur,
-            LogEventIn(
-                event_type="SESSION_STARTED",
-                session_id=session_id,
-                fundraiser_id=fund["FUNDRAISER_ID"],
-                attributes={"fundraiser": fund, "charity": charity, "campaign": campaign},
-            ),
-        )
-        
-        print(f"=== DEBUG: Final charity object being returned: {charity} ===")
-        
-        return FundraiserLoginOut(
-            session_id=session_id,
-            fundraiser=fund,
-            charity=charity,
-            campaign=campaign,
-        )
+        campaign = _read_campaign(cur, fund["CAMPAIGN_ID"]) if fund.get("CAMPAIGN_ID") else None
+    finally:
+        cur.close()
+
+    journaled_write("session_start", session_id, {
+        "session_id": session_id,
+        "fundraiser_id": fund["FUNDRAISER_ID"],
+        "charity_id": fund.get("CHARITY_ID"),
+        "campaign_id": fund.get("CAMPAIGN_ID"),
+        "device_id": os.getenv("APP_DEVICE_ID", None),
+        "event_id": new_id("evt"),
+        "ts": time.time(),
+        "attributes": json.loads(json.dumps({"fundraiser": fund, "charity": charity, "campaign": campaign},
+                                            default=_json_default)),
+    })
+
+    print(f"=== DEBUG: Final charity object being returned: {charity} ===")
+
+    return FundraiserLoginOut(
+        session_id=session_id,
+        fundraiser=fund,
+        charity=charity,
+        campaign=campaign,
+    )
+
+# ---------- Sync bundle ----------
+@app.get("/sync/bundle")
+def sync_bundle(
+    campaign_id: str,
+    fundraiser_id: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+):
+    """
+    Compact, versioned reference data for a campaign (charity branding, presets,
+    active products). Served from memory; an unchanged tablet gets a 304.
+    """
+    etag, body = _get_sync_bundle(campaign_id, fundraiser_id)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(if_none_match, etag):
+        metric_inc("sync_bundle.not_modified")
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/sync/logo/{charity_id}")
+def sync_logo(charity_id: str):
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        charity = _read_charity(cur, charity_id)
     finally:
         try: cur.close()
         except Exception: pass
         ctx.close()
+    if not charity or not charity.get("LOGO_URL") or charity["LOGO_URL"].startswith("@"):
+        raise HTTPException(status_code=404, detail="Logo not available")
+    return RedirectResponse(charity["LOGO_URL"], status_code=307)
 
 # ---------- Testing endpoint for images ---------- 
 @app.get("/test/presign")
@@ -1188,108 +5309,37 @@ def donor_upsert(d: DonorUpsertIn):
     if age < 25:
         raise HTTPException(status_code=403, detail="Donor must be at least 25 years old")
 
-    ctx = get_snowflake_ctx()
-    try:
-        cur = ctx.cursor()
-
-        # Look up by email (canonical)
-        cur.execute("SELECT DONOR_ID FROM DONOR WHERE EMAIL = %s", (d.email,))
-        row = cur.fetchone()
-
-        if row:
-            donor_id = row[0]
-            cur.execute(
-                """
-                UPDATE DONOR SET
-                  TITLE=%s, FIRST_NAME=%s, MIDDLE_NAME=%s, LAST_NAME=%s, DOB_DATE=%s,
-                  MOBILE_E164=%s, EMAIL=%s, ADDRESS1=%s, ADDRESS2=%s, CITY=%s,
-                  REGION=%s, POSTAL_CODE=%s, COUNTRY=%s, UPDATED_AT=CURRENT_TIMESTAMP()
-                WHERE DONOR_ID=%s
-                """,
-                (
-                    d.title, d.first_name, d.middle_name, d.last_name, d.dob_iso,
-                    d.mobile_e164, d.email, d.address1, d.address2, d.city,
-                    d.region, d.postal_code, d.country, donor_id
-                ),
-            )
-            action = "UPDATE"
-        else:
-            donor_id = f"donor-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}"
-            cur.execute(
-                """
-                INSERT INTO DONOR (DONOR_ID, TITLE, FIRST_NAME, MIDDLE_NAME, LAST_NAME, DOB_DATE,
-                                   MOBILE_E164, EMAIL, ADDRESS1, ADDRESS2, CITY, REGION, POSTAL_CODE, COUNTRY, CREATED_AT)
-                SELECT %s,%s,%s,%s,%s,%s,
-                       %s,%s,%s,%s,%s,%s,%s,%s, CURRENT_TIMESTAMP()
-                """,
-                (
-                    donor_id, d.title, d.first_name, d.middle_name, d.last_name, d.dob_iso,
-                    d.mobile_e164, d.email, d.address1, d.address2, d.city,
-                    d.region, d.postal_code, d.country
-                ),
-            )
-            action = "INSERT"
-
-        # Pull session’s campaign/charity snapshot
-        cur.execute(
-            """
-            SELECT CHARITY_ID, CAMPAIGN_ID
-            FROM SESSION
-            WHERE SESSION_ID = %s
-            """,
-            (d.session_id,),
-        )
-        sess_meta = cur.fetchone()
-        charity_id = sess_meta[0] if sess_meta else None
-        campaign_id = sess_meta[1] if sess_meta else None
-
-        # Record donor-session (with campaign/charity)
-        cur.execute(
-            """
-            INSERT INTO DONOR_SESSION (SESSION_ID, DONOR_ID, FUNDRAISER_ID, CHARITY_ID, CAMPAIGN_ID, CREATED_AT)
-            SELECT %s, %s, %s, %s, %s, CURRENT_TIMESTAMP()
-            """,
-            (d.session_id, donor_id, d.fundraiser_id, charity_id, campaign_id)
-        )
-
-        insert_event(
-            cur,
-            LogEventIn(
-                event_type=f"DONOR_{action}",
-                session_id=d.session_id,
-                donor_id=donor_id,
-                fundraiser_id=d.fundraiser_id,
-                attributes={"email": d.email, "mobile": d.mobile_e164},
-            ),
-        )
-        return {"donor_id": donor_id}
-    finally:
-        try: cur.close()
-        except Exception: pass
-        ctx.close()
+    # Only used if the email is new; while degraded it is what the tablet carries forward
+    candidate_id = write_journal.pending_donor_for_email(d.email) or new_id("donor")
+    write = {
+        "donor_id": candidate_id, "title": d.title, "first_name": d.first_name, "middle_name": d.middle_name,
+        "last_name": d.last_name, "dob_iso": d.dob_iso, "mobile_e164": d.mobile_e164, "email": d.email,
+        "address1": d.address1, "address2": d.address2, "city": d.city, "region": d.region,
+        "postal_code": d.postal_code, "country": d.country, "fundraiser_id": d.fundraiser_id,
+        "session_id": d.session_id, "event_id": new_id("evt"), "ts": time.time(),
+    }
+    donor_id, _ = journaled_write("donor_upsert", candidate_id, write)
+    return {"donor_id": donor_id or candidate_id}
 
 # ---------- Donor Details ----------  
 @app.get("/donor/{donor_id}")
 def get_donor(donor_id: str):
+    pending = write_journal.latest("donor_upsert", donor_id)
+    if pending:
+        # Not forwarded yet: the journal is the freshest copy
+        full_name = " ".join(filter(None, [pending.get("title"), pending["first_name"],
+                                           pending.get("middle_name"), pending["last_name"]]))
+        return {"email": pending["email"], "name": full_name, "phone": pending["mobile_e164"]}
     ctx = get_snowflake_ctx()
     try:
         cur = ctx.cursor()
-        cur.execute(
-            """
-            SELECT TITLE, FIRST_NAME, MIDDLE_NAME, LAST_NAME, EMAIL, MOBILE_E164
-            FROM DONOR 
-            WHERE DONOR_ID = %s
-            """,
-            (donor_id,)
-        )
-        row = cur.fetchone()
-        if row:
-            title, first, middle, last, email, phone = row
-            full_name = " ".join(filter(None, [title, first, middle, last]))
+        donor = repo_one(cur, "donor.by_id", (write_journal.canonical_donor_id(donor_id),))
+        if donor:
+            full_name = " ".join(filter(None, [donor.TITLE, donor.FIRST_NAME, donor.MIDDLE_NAME, donor.LAST_NAME]))
             return {
-                "email": email,
+                "email": donor.EMAIL,
                 "name": full_name,
-                "phone": phone
+                "phone": donor.MOBILE_E164
             }
         else:
             raise HTTPException(status_code=404, detail="Donor not found")
@@ -1300,75 +5350,27 @@ def get_donor(donor_id: str):
 
 # ---------- Products By Campaign ----------
 @app.get("/products/campaign/{campaign_id}")
-def get_campaign_products(campaign_id: str):
-    ctx = get_snowflake_ctx()
-    try:
-        cur = ctx.cursor()
-        cur.execute(
-            """
-            SELECT PRODUCT_ID, PRODUCT_TYPE, AMOUNT_CENTS, CURRENCY, 
-                   DISPLAY_NAME, STRIPE_PRICE_ID, ACTIVE
-            FROM PRODUCT 
-            WHERE CAMPAIGN_ID = %s AND ACTIVE = TRUE
-            ORDER BY PRODUCT_TYPE, AMOUNT_CENTS
-            """,
-            (campaign_id,)
-        )
-        rows = cur.fetchall()
-        products = []
-        for row in rows:
-            products.append({
-                "product_id": row[0],
-                "product_type": row[1], 
-                "amount_cents": int(row[2]) if row[2] else 0,
-                "currency": row[3],
-                "display_name": row[4],
-                "stripe_price_id": row[5],
-                "active": bool(row[6])
-            })
-        return {"products": products}
-    finally:
-        try: cur.close()
-        except Exception: pass
-        ctx.close()
-        
-# ---------- Communication Preferences ----------
-@app.post("/donor/consent")
-def donor_consent_update(body: DonorConsentIn):
-    ctx = get_snowflake_ctx()
-    try:
-        cur = ctx.cursor()
-        # Update donor consents
-        cur.execute(
-            """
-            UPDATE DONOR
-            SET CONSENT_SMS = %s,
-                CONSENT_EMAIL = %s,
-                CONSENT_MAIL = %s,
-                UPDATED_AT = CURRENT_TIMESTAMP()
-            WHERE DONOR_ID = %s
-            """,
-            (body.consent_sms, body.consent_email, body.consent_mail, body.donor_id),
-        )
-
-        insert_event(
-            cur,
-            LogEventIn(
-                event_type="DONOR_CONSENT_UPDATE",
-                session_id=body.session_id,
-                donor_id=body.donor_id,
-                attributes={
-                    "consent_sms": body.consent_sms,
-                    "consent_email": body.consent_email,
-                    "consent_mail": body.consent_mail,
-                },
-            ),
-        )
-        return {"ok": True}
+def get_campaign_products(campaign_id: str):
+    cur = _LazyCursor()
+    try:
+        products = _read_campaign_products(cur, campaign_id)
+        return {"products": products}
     finally:
-        try: cur.close()
-        except Exception: pass
-        ctx.close()
+        cur.close()
+        
+# ---------- Communication Preferences ----------
+@app.post("/donor/consent")
+def donor_consent_update(body: DonorConsentIn):
+    journaled_write("donor_consent", body.donor_id, {
+        "donor_id": body.donor_id,
+        "session_id": body.session_id,
+        "consent_sms": body.consent_sms,
+        "consent_email": body.consent_email,
+        "consent_mail": body.consent_mail,
+        "event_id": new_id("evt"),
+        "ts": time.time(),
+    })
+    return {"ok": True}
 
 # ---------- Products & price ids ----------
 @app.get("/products/lookup")
@@ -1381,25 +5383,12 @@ def lookup_product(
     ctx = get_snowflake_ctx()
     try:
         cur = ctx.cursor()
-        cur.execute(
-            """
-            SELECT STRIPE_PRICE_ID, PRODUCT_ID, DISPLAY_NAME
-            FROM PRODUCT 
-            WHERE CAMPAIGN_ID = %s 
-              AND AMOUNT_CENTS = %s 
-              AND UPPER(CURRENCY) = UPPER(%s)
-              AND UPPER(PRODUCT_TYPE) = UPPER(%s)
-              AND ACTIVE = TRUE
-            LIMIT 1
-            """,
-            (campaign_id, amount_cents, currency, product_type)
-        )
-        row = cur.fetchone()
-        if row:
+        p = repo_one(cur, "product.lookup", (campaign_id, amount_cents, currency, product_type))
+        if p:
             return {
-                "stripe_price_id": row[0],
-                "product_id": row[1], 
-                "display_name": row[2]
+                "stripe_price_id": p.STRIPE_PRICE_ID,
+                "product_id": p.PRODUCT_ID,
+                "display_name": p.DISPLAY_NAME
             }
         else:
             raise HTTPException(status_code=404, detail="No matching product found")
@@ -1436,8 +5425,7 @@ def register_device():
 @app.post("/signature/upload", response_model=SignatureUploadOut)
 def upload_signature(payload: SignatureUploadIn):
     try:
-        timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
-        signature_id = f"sig-{timestamp}-{payload.donor_id}"
+        signature_id = f"{new_id('sig')}-{payload.donor_id}"
 
         # Decode and hash
         # If Android ever sends a data URI, strip it; this is safe either way
@@ -1449,72 +5437,1124 @@ def upload_signature(payload: SignatureUploadIn):
         rel_path = f"signatures/{signature_id}.png"
         full_stage_uri = f"{SIGNATURE_STAGE_URI_PREFIX}/{rel_path}"  # @PHOENIX_APP_DEV.CORE.ASSETS_INT/signatures/...
 
-        ctx = get_snowflake_ctx()
+        signature_url, _ = journaled_write("signature", signature_id, {
+            "signature_id": signature_id,
+            "donor_id": payload.donor_id,
+            "session_id": payload.session_id,
+            "stage_uri": full_stage_uri,
+            "rel_path": rel_path,
+            "png_b64": base64.b64encode(png_data).decode("ascii"),
+            "hash_sha256": hash_sha256,
+            "file_size": len(png_data),
+            "event_id": new_id("evt"),
+            "ts": time.time(),
+        })
+
+        return SignatureUploadOut(
+            signature_id=signature_id,
+            signature_url=signature_url or "",
+            success=True,
+        )
+
+    except Exception as e:
+        print(f"=== DEBUG: Signature upload failed: {e} ===")
+        raise HTTPException(status_code=500, detail=f"Signature upload failed: {str(e)}")
+
+# ---------- Export (streaming NDJSON / CSV) ----------
+EXPORT_API_TOKEN = os.getenv("EXPORT_API_TOKEN", "")
+EXPORT_FETCH_BATCH = int(os.getenv("EXPORT_FETCH_BATCH", "5000"))
+EVENT_LOG_TS_COLUMN = os.getenv("EVENT_LOG_TS_COLUMN", "CREATED_AT")
+
+# id/ts define the keyset order used for resumable exports (after_ts + after_id)
+EXPORT_DATASETS: Dict[str, Dict[str, Any]] = {
+    "events": {
+        "from": "EVENT_LOG X",
+        "id": "X.EVENT_ID",
+        "ts": f"X.{EVENT_LOG_TS_COLUMN}",
+        "columns": ["EVENT_ID", "SESSION_ID", "DONOR_ID", "FUNDRAISER_ID", "EVENT_TYPE",
+                    EVENT_LOG_TS_COLUMN, "ATTRIBUTES"],
+        "json_columns": {"ATTRIBUTES"},
+        "event_type": "X.EVENT_TYPE",
+        "campaign": "EXISTS (SELECT 1 FROM SESSION S WHERE S.SESSION_ID = X.SESSION_ID AND S.CAMPAIGN_ID = %s)",
+    },
+    "donors": {
+        "from": "DONOR X",
+        "id": "X.DONOR_ID",
+        "ts": "X.CREATED_AT",
+        "columns": ["DONOR_ID", "TITLE", "FIRST_NAME", "MIDDLE_NAME", "LAST_NAME", "DOB_DATE",
+                    "MOBILE_E164", "EMAIL", "ADDRESS1", "ADDRESS2", "CITY", "REGION", "POSTAL_CODE",
+                    "COUNTRY", "CONSENT_SMS", "CONSENT_EMAIL", "CONSENT_MAIL", "CREATED_AT", "UPDATED_AT"],
+        "campaign": "EXISTS (SELECT 1 FROM DONOR_SESSION DS WHERE DS.DONOR_ID = X.DONOR_ID AND DS.CAMPAIGN_ID = %s)",
+    },
+    "payments": {
+        "from": "PAYMENT X",
+        "id": "X.PAYMENT_ID",
+        "ts": "X.CREATED_AT",
+        "columns": ["PAYMENT_ID", "SESSION_ID", "DONOR_ID", "TYPE", "AMOUNT", "CURRENCY",
+                    "STRIPE_CUSTOMER_ID", "STRIPE_SUBSCRIPTION_ID", "STATUS", "CREATED_AT"],
+        "campaign": "EXISTS (SELECT 1 FROM SESSION S WHERE S.SESSION_ID = X.SESSION_ID AND S.CAMPAIGN_ID = %s)",
+    },
+}
+
+def _require_export_auth(authorization: Optional[str]):
+    if not EXPORT_API_TOKEN:
+        raise HTTPException(status_code=503, detail="Export is disabled (EXPORT_API_TOKEN not set)")
+    token = (authorization or "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode("utf-8"), EXPORT_API_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid export token")
+
+def _export_query(ds: Dict[str, Any], since, until, event_type, campaign_id, after_ts, after_id, limit):
+    where, params = [], []
+    if since:
+        where.append(f"{ds['ts']} >= %s"); params.append(since)
+    if until:
+        where.append(f"{ds['ts']} < %s"); params.append(until)
+    if event_type:
+        if "event_type" not in ds:
+            raise HTTPException(status_code=400, detail="event_type filter only applies to events")
+        where.append(f"{ds['event_type']} = %s"); params.append(event_type)
+    if campaign_id:
+        where.append(ds["campaign"]); params.append(campaign_id)
+    if after_ts is not None and after_id is not None:
+        where.append(f"({ds['ts']} > %s OR ({ds['ts']} = %s AND {ds['id']} > %s))")
+        params += [after_ts, after_ts, after_id]
+    sql = (
+        f"SELECT {', '.join('X.' + c for c in ds['columns'])} FROM {ds['from']}"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + f" ORDER BY {ds['ts']}, {ds['id']}"
+        + (" LIMIT %s" if limit else "")
+    )
+    if limit:
+        params.append(limit)
+    return sql, tuple(params)
+
+def _export_rows(sql: str, params: tuple):
+    """Yields rows batch by batch; the connector streams result chunks, so memory stays flat."""
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        cur.arraysize = EXPORT_FETCH_BATCH
+        cur.execute(sql, params)
+        while True:
+            batch = cur.fetchmany(EXPORT_FETCH_BATCH)
+            if not batch:
+                break
+            metric_inc("export.rows", len(batch))
+            yield batch
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+def _export_encode(ds: Dict[str, Any], batches, fmt: str):
+    cols = ds["columns"]
+    json_cols = ds.get("json_columns", set())
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow([c.lower() for c in cols])
+        for batch in batches:
+            for row in batch:
+                writer.writerow([_json_default(v) if isinstance(v, (date, datetime)) else v for v in row])
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0); buf.truncate()
+        yield buf.getvalue().encode("utf-8")
+        return
+    for batch in batches:
+        lines = []
+        for row in batch:
+            rec = {}
+            for c, v in zip(cols, row):
+                if c in json_cols and isinstance(v, str):
+                    try: v = json.loads(v)
+                    except ValueError: pass
+                rec[c.lower()] = v
+            lines.append(json.dumps(rec, default=_json_default, separators=(",", ":")))
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+def _gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+@app.get("/export/{dataset}")
+def export_dataset(
+    dataset: str,
+    request: Request,
+    format: str = "ndjson",
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    event_type: Optional[str] = None,
+    campaign_id: Optional[str] = None,
+    after_ts: Optional[str] = None,
+    after_id: Optional[str] = None,
+    limit: Optional[int] = None,
+    authorization: Optional[str] = Header(None),
+):
+    """
+    Streams EVENT_LOG / DONOR / PAYMENT as NDJSON or CSV (chunked, gzip on request).
+    Rows are ordered by (timestamp, id); to resume, pass the last row's values as
+    after_ts / after_id.
+    """
+    _require_export_auth(authorization)
+    ds = EXPORT_DATASETS.get(dataset)
+    if ds is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset; choose one of {sorted(EXPORT_DATASETS)}")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    if (after_ts is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="after_ts and after_id go together")
+    sql, params = _export_query(ds, since, until, event_type, campaign_id, after_ts, after_id, limit)
+
+    body = _export_encode(ds, _export_rows(sql, params), format)
+    headers = {"Cache-Control": "no-store", "X-Export-Order": f"{ds['ts']},{ds['id']}".replace("X.", "")}
+    if "gzip" in (request.headers.get("accept-encoding") or ""):
+        body = _gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    metric_inc(f"export.requests.{dataset}")
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+# ---------- Batched client events (/log-events) ----------
+LOG_EVENTS_MAX_ITEMS = int(os.getenv("LOG_EVENTS_MAX_ITEMS", "500"))
+LOG_EVENTS_MAX_BYTES = int(os.getenv("LOG_EVENTS_MAX_BYTES", str(2 * 1024 * 1024)))   # after gunzip
+# A retried batch older than this isn't de-duplicated (bounds the EVENT_LOG lookup)
+LOG_EVENTS_DEDUPE_DAYS = int(os.getenv("LOG_EVENTS_DEDUPE_DAYS", "7"))
+CLIENT_EVENT_ID_RE = re.compile(r"^[A-Za-z0-9_.:-]{1,64}$")
+
+EventIdRecord = namedtuple("EventIdRecord", ("EVENT_ID",))
+statement("event_log.batch_ids",
+          f"SELECT {{cols}} FROM EVENT_LOG WHERE EVENT_ID IN ({{ids}}) AND {EVENT_LOG_TS_COLUMN} = %s",
+          EventIdRecord, "EVENT_ID")
+
+def _decode_event_batch(body: bytes, content_encoding: Optional[str]) -> list:
+    encoding = (content_encoding or "").strip().lower()
+    if encoding == "gzip":
+        z = zlib.decompressobj(31)
         try:
-            cur = ctx.cursor()
+            body = z.decompress(body, LOG_EVENTS_MAX_BYTES + 1)
+        except zlib.error:
+            raise HTTPException(status_code=400, detail="Invalid gzip body")
+        if z.unconsumed_tail:
+            raise HTTPException(status_code=413, detail=f"Batch exceeds {LOG_EVENTS_MAX_BYTES} bytes uncompressed")
+    elif encoding not in ("", "identity"):
+        raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {encoding}")
+    if len(body) > LOG_EVENTS_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {LOG_EVENTS_MAX_BYTES} bytes uncompressed")
+    try:
+        data = orjson.loads(body) if orjson is not None else json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body is not valid JSON")
+    if isinstance(data, dict):
+        data = data.get("events")
+    if not isinstance(data, list):
+        raise HTTPException(status_code=400, detail='Expected a JSON array of events (or {"events": [...]})')
+    if len(data) > LOG_EVENTS_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {LOG_EVENTS_MAX_ITEMS} events per batch")
+    return data
 
-            # Write temp file with final name so PUT lands exactly where we want
-            import tempfile, os
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-                tmp.write(png_data)
-                temp_file_path = tmp.name
+def _validate_event_batch(items: list) -> Tuple[list, List[Tuple[int, str, "ClientEventIn"]]]:
+    """Returns (per-item results with failures filled in, [(index, event_id, event)] to write)."""
+    results: list = [None] * len(items)
+    valid = []
+    seen = set()
+    for i, item in enumerate(items):
+        try:
+            ev = ClientEventIn.model_validate(item)
+        except ValidationError as e:
+            error = "; ".join(f"{'.'.join(map(str, err['loc'])) or 'event'}: {err['msg']}" for err in e.errors())
+            results[i] = {"index": i, "ok": False, "error": error}
+            continue
+        if ev.event_id is not None and not CLIENT_EVENT_ID_RE.match(ev.event_id):
+            results[i] = {"index": i, "ok": False, "error": "event_id: expected 1-64 chars of [A-Za-z0-9_.:-]"}
+            continue
+        # Namespaced so a client id can never collide with a server-minted one
+        event_id = f"cli-{ev.event_id}" if ev.event_id else new_id("evt")
+        if event_id in seen:
+            results[i] = {"index": i, "ok": True, "event_id": event_id, "status": "duplicate"}
+            continue
+        seen.add(event_id)
+        valid.append((i, event_id, ev))
+    metric_inc("log_events.rejected", sum(1 for r in results if r and not r["ok"]))
+    return results, valid
 
-            try:
-                # PUT works ONLY on INTERNAL stages — which ASSETS_INT is
-                cur.execute(
-                    f"PUT file://{temp_file_path} {SIGNATURE_STAGE_URI_PREFIX}/signatures/ "
-                    "AUTO_COMPRESS=FALSE OVERWRITE=TRUE"
-                )
-            finally:
-                try:
-                    os.unlink(temp_file_path)
-                except Exception:
-                    pass
+def _write_event_batch(valid: List[Tuple[int, str, "ClientEventIn"]]) -> set:
+    """
+    One MERGE that inserts the events not already logged; returns the ids it skipped.
+    Every row of the batch carries the same timestamp, so when the MERGE reports fewer
+    inserts than rows, the ids stamped with it are the ones this batch wrote.
+    """
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        stamp = cur.execute("SELECT CURRENT_TIMESTAMP()::TIMESTAMP_NTZ").fetchone()[0]
+        params = []
+        for _, eid, ev in valid:
+            params += [eid, ev.session_id, ev.donor_id, ev.fundraiser_id, ev.event_type,
+                       serialize_event_attributes(cur, eid, ev.event_type, ev.attributes), stamp]
+        started = time.perf_counter()
+        cur.execute(
+            f"""
+            MERGE INTO EVENT_LOG T
+            USING (
+                SELECT COLUMN1 AS EVENT_ID, COLUMN2 AS SESSION_ID, COLUMN3 AS DONOR_ID, COLUMN4 AS FUNDRAISER_ID,
+                       COLUMN5 AS EVENT_TYPE, PARSE_JSON(COLUMN6) AS ATTRIBUTES, COLUMN7 AS TS
+                FROM (VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(valid))})
+            ) S
+            ON T.EVENT_ID = S.EVENT_ID AND T.{EVENT_LOG_TS_COLUMN} >= DATEADD(day, %s, CURRENT_TIMESTAMP())
+            WHEN NOT MATCHED THEN INSERT
+                (EVENT_ID, SESSION_ID, DONOR_ID, FUNDRAISER_ID, EVENT_TYPE, ATTRIBUTES, {EVENT_LOG_TS_COLUMN})
+                VALUES (S.EVENT_ID, S.SESSION_ID, S.DONOR_ID, S.FUNDRAISER_ID, S.EVENT_TYPE, S.ATTRIBUTES, S.TS)
+            """,
+            tuple(params) + (-LOG_EVENTS_DEDUPE_DAYS,),
+        )
+        metric_observe("log_events.insert", time.perf_counter() - started)
+        inserted = cur.rowcount or 0
+        ids = [eid for _, eid, _ in valid]
+        if inserted >= len(valid):
+            written = set(ids)
+        elif inserted == 0:
+            written = set()
+        else:
+            written = set(repo_by_ids(cur, "event_log.batch_ids", ids, (stamp,)))
+        existing = set(ids) - written
+        metric_inc("log_events.inserted", len(written))
+        metric_inc("log_events.duplicates", len(existing))
+        return existing
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+
+@app.post("/log-events")
+async def log_events(request: Request):
+    """
+    Batch of events: a JSON array of LogEventIn (or {"events": [...]}), optionally
+    Content-Encoding: gzip. Items are validated individually and the valid ones are
+    written with one MERGE; results[i] reports item i. An item whose client
+    event_id is already logged comes back as "duplicate", so retrying a batch is safe.
+    A batch containing server-only event types (STRIPE_*, SESSION_STARTED, ...) is rejected.
+    """
+    enforce_rate_limit("log_events", request)
+    items = _decode_event_batch(await request.body(), request.headers.get("content-encoding"))
+    results, valid = _validate_event_batch(items)
+    reserved = [i for i, _, ev in valid if is_server_event_type(ev.event_type)]
+    if reserved:
+        raise HTTPException(status_code=400, detail=f"Items {reserved} use event types reserved for server events")
+    existing = set()
+    if valid:
+        try:
+            existing = await run_in_threadpool(_write_event_batch, valid)
+        except Exception as e:
+            if not _is_unavailable(e):
+                raise
+            raise HTTPException(status_code=503, detail="Event store unavailable, retry the batch",
+                                headers={"Retry-After": "10"})
+    for i, eid, _ in valid:
+        results[i] = {"index": i, "ok": True, "event_id": eid, "status": "duplicate" if eid in existing else "inserted"}
+    accepted = sum(1 for r in results if r["ok"])
+    return {"ok": accepted == len(results), "accepted": accepted, "rejected": len(results) - accepted,
+            "results": results}
+
+# ---------- Stripe Location ID ----------
+@app.get("/terminal/location")
+def get_terminal_location():
+    return {"location_id": os.getenv("STRIPE_TERMINAL_LOCATION_ID", "")}
+
+
+# ---------- Reconciliation (Stripe <-> Snowflake) ----------
+STRIPE_RECON_RPS = float(os.getenv("STRIPE_RECON_RPS", "20"))  # stay well under Stripe's read limit
+
+def _stripe_list_slice(resource, bucket: TokenBucket, gte: int, lt: int, **params) -> list:
+    """Pages through one created-time slice; each page waits on the shared rate bucket."""
+    out, starting_after = [], None
+    while True:
+        bucket.acquire()
+        kwargs = dict(limit=100, created={"gte": gte, "lt": lt}, **params)
+        if starting_after:
+            kwargs["starting_after"] = starting_after
+        page = resource.list(**kwargs)
+        metric_inc("reconcile.stripe_pages")
+        out.extend(page.data)
+        if not page.has_more or not page.data:
+            return out
+        starting_after = page.data[-1].id
+
+def _stripe_list_parallel(resource, since: datetime, until: datetime, workers: int, bucket: TokenBucket, **params) -> list:
+    """
+    Cursor pagination is sequential, so the range is cut into created-time slices
+    that are paged concurrently.
+    """
+    start, end = int(since.timestamp()), int(until.timestamp())
+    n = max(1, workers * 4)
+    step = max(1, (end - start + n - 1) // n)
+    slices = [(a, min(a + step, end)) for a in range(start, end, step)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(in_current_workload(lambda sl: _stripe_list_slice(resource, bucket, sl[0], sl[1], **params)), slices)
+        return [obj for chunk in results for obj in chunk]
+
+def _recon_load_tables(since: datetime, until: datetime, ids: Dict[str, List[str]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Builds the hash-join sides: our rows keyed by Stripe id. Only rows for the
+    Stripe objects listed in the window are read (ids: kind -> Stripe ids, kinds
+    "sub", "pi" and "pm"), via a temp table rather than whole-table scans.
+    """
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_payment_state(cur)
+        cur.execute("CREATE OR REPLACE TEMPORARY TABLE RECON_IDS (KIND STRING, STRIPE_ID STRING)")
+        rows = [(kind, x) for kind, xs in ids.items() for x in set(xs) if x]
+        if rows:
+            cur.executemany("INSERT INTO RECON_IDS VALUES (%s, %s)", rows)
+        payments_by_sub, payments_by_pi = {}, {}
+        cur.execute(
+            """
+            SELECT PAYMENT_ID, STRIPE_SUBSCRIPTION_ID, STRIPE_PAYMENT_INTENT_ID, STATUS, SESSION_ID, DONOR_ID
+            FROM PAYMENT
+            WHERE STRIPE_SUBSCRIPTION_ID IN (SELECT STRIPE_ID FROM RECON_IDS WHERE KIND = 'sub')
+            UNION ALL
+            SELECT PAYMENT_ID, NULL, STRIPE_PAYMENT_INTENT_ID, STATUS, SESSION_ID, DONOR_ID
+            FROM PAYMENT
+            WHERE STRIPE_PAYMENT_INTENT_ID IN (SELECT STRIPE_ID FROM RECON_IDS WHERE KIND = 'pi')
+              AND PAYMENT_ID LIKE 'pi-%'
+            """
+        )
+        for row in cur.fetchall():
+            rec = {"payment_id": row[0], "status": row[3], "session_id": row[4], "donor_id": row[5]}
+            if row[1]:
+                payments_by_sub[row[1]] = rec
+            else:
+                payments_by_pi[row[2]] = rec
+        cur.execute(
+            f"""
+            SELECT STRIPE_SUBSCRIPTION_ID, STATUS, LAST_INVOICE_ID FROM {SUBSCRIPTION_TABLE}
+            WHERE STRIPE_SUBSCRIPTION_ID IN (SELECT STRIPE_ID FROM RECON_IDS WHERE KIND = 'sub')
+            """
+        )
+        subscriptions = {r[0]: {"status": r[1], "last_invoice_id": r[2]} for r in cur.fetchall()}
+        cur.execute(
+            """
+            SELECT STRIPE_PAYMENT_METHOD_ID FROM PAYMENT_METHOD
+            WHERE STRIPE_PAYMENT_METHOD_ID IN (SELECT STRIPE_ID FROM RECON_IDS WHERE KIND = 'pm')
+            """
+        )
+        payment_methods = {r[0] for r in cur.fetchall()}
+        cur.execute(
+            """
+            SELECT DISTINCT ATTRIBUTES:id::STRING
+            FROM EVENT_LOG
+            WHERE EVENT_TYPE LIKE 'STRIPE_INVOICE.%%' AND ATTRIBUTES:created::NUMBER BETWEEN %s AND %s
+            """,
+            (int(since.timestamp()) - 86400, int(until.timestamp()) + 86400 * 35),
+        )
+        invoice_events = {r[0] for r in cur.fetchall() if r[0]}
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    return {"payments_by_sub": payments_by_sub, "payments_by_pi": payments_by_pi,
+            "subscriptions": subscriptions, "payment_methods": payment_methods,
+            "invoice_events": invoice_events}
+
+def _md_get(obj, key):
+    return (obj.get("metadata") or {}).get(key) or None
 
-            # Store metadata
+def reconcile_stripe(since: datetime, until: datetime, workers: int = 8, repair: bool = False,
+                     report_path: Optional[str] = None) -> Dict[str, int]:
+    """
+    Lists PaymentIntents, Subscriptions and Invoices created in [since, until),
+    diffs them against PAYMENT / SUBSCRIPTION / PAYMENT_METHOD / EVENT_LOG and
+    writes one JSON line per discrepancy. With repair=True the fixable rows are
+    bulk-loaded into temp tables and MERGEd in one statement per table.
+    """
+    started = time.time()
+    bucket = TokenBucket(STRIPE_RECON_RPS, capacity=STRIPE_RECON_RPS)
+    list_parallel = in_current_workload(_stripe_list_parallel)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        f_pis = pool.submit(list_parallel, stripe.PaymentIntent, since, until, workers, bucket)
+        f_subs = pool.submit(list_parallel, stripe.Subscription, since, until, workers, bucket, status="all")
+        f_invs = pool.submit(list_parallel, stripe.Invoice, since, until, workers, bucket)
+        pis, subs, invs = f_pis.result(), f_subs.result(), f_invs.result()
+    print(f"=== DEBUG: reconcile fetched {len(pis)} PIs, {len(subs)} subs, {len(invs)} invoices "
+          f"in {time.time() - started:.1f}s ===")
+    ours = _recon_load_tables(since, until, {
+        "sub": [sub.id for sub in subs],
+        "pi": [pi.id for pi in pis if not pi.get("invoice")],
+        "pm": [_stripe_id(sub.get("default_payment_method")) for sub in subs],
+    })
+
+    issues: List[Dict[str, Any]] = []
+    payment_fixes: List[tuple] = []
+    subscription_fixes: List[tuple] = []
+    pm_fixes: Dict[str, tuple] = {}
+
+    for sub in subs:
+        customer = _stripe_id(sub.get("customer"))
+        pay = ours["payments_by_sub"].get(sub.id)
+        session_id, donor_id = _md_get(sub, "session_id"), _md_get(sub, "donor_id")
+        if pay is None:
+            issues.append({"kind": "subscription_missing_payment_row", "stripe_id": sub.id, "stripe_status": sub.status})
+        elif pay["status"] != sub.status:
+            issues.append({"kind": "subscription_status_mismatch", "stripe_id": sub.id,
+                           "stripe_status": sub.status, "our_status": pay["status"]})
+        if pay is None or pay["status"] != sub.status:
+            payment_fixes.append((f"sub-{sub.id}", session_id, donor_id, "MONTHLY", customer, sub.id, None,
+                                  sub.status, _stripe_id(sub.get("latest_invoice"))))
+        state = ours["subscriptions"].get(sub.id)
+        if state is None or state["status"] != sub.status:
+            issues.append({"kind": "subscription_state_stale", "stripe_id": sub.id,
+                           "stripe_status": sub.status, "our_status": state and state["status"]})
+            subscription_fixes.append((sub.id, session_id, donor_id, customer, sub.status,
+                                       _stripe_id(sub.get("latest_invoice")), sub.get("cancel_at")))
+        pm = _stripe_id(sub.get("default_payment_method"))
+        if pm and pm not in ours["payment_methods"]:
+            issues.append({"kind": "payment_method_missing", "stripe_id": pm, "subscription_id": sub.id})
+            pm_fixes[pm] = (f"pm-{pm}", donor_id, customer, pm, "OFF_SESSION")
+
+    for pi in pis:
+        if pi.get("invoice"):
+            continue  # subscription charge, covered by invoices
+        if pi.status not in ("succeeded", "processing", "requires_capture"):
+            continue
+        pay = ours["payments_by_pi"].get(pi.id)
+        if pay is None or pay["status"] != pi.status:
+            issues.append({"kind": "payment_intent_missing" if pay is None else "payment_intent_status_mismatch",
+                           "stripe_id": pi.id, "stripe_status": pi.status, "our_status": pay and pay["status"]})
+            payment_fixes.append((f"pi-{pi.id}", _md_get(pi, "session_id"), _md_get(pi, "donor_id"), "OTG",
+                                  _stripe_id(pi.get("customer")), None, pi.id, pi.status, None))
+
+    for inv in invs:
+        if inv.get("status") in ("draft",):
+            continue
+        if inv.id not in ours["invoice_events"]:
+            issues.append({"kind": "invoice_webhook_missing", "stripe_id": inv.id, "stripe_status": inv.get("status"),
+                           "subscription_id": _invoice_subscription_id(inv)})
+
+    counts: Dict[str, int] = {}
+    for issue in issues:
+        counts[issue["kind"]] = counts.get(issue["kind"], 0) + 1
+    if report_path:
+        with open(report_path, "w") as f:
+            for issue in issues:
+                f.write(json.dumps(issue, default=_json_default) + "\n")
+    if repair:
+        _bulk_merge_payments(payment_fixes, subscription_fixes, list(pm_fixes.values()))
+        counts["repaired_payments"] = len(payment_fixes)
+        counts["repaired_subscriptions"] = len(subscription_fixes)
+        counts["repaired_payment_methods"] = len(pm_fixes)
+    metric_observe("reconcile.run", time.time() - started)
+    print(f"=== DEBUG: reconcile done in {time.time() - started:.1f}s: {counts} ===")
+    return counts
+
+def _bulk_merge_payments(payment_fixes: List[tuple], subscription_fixes: List[tuple], pm_fixes: List[tuple]):
+    """
+    Bulk-upserts PAYMENT, SUBSCRIPTION and PAYMENT_METHOD rows: executemany into a
+    temp table (the connector turns that into a multi-row insert), then one MERGE.
+    """
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _ensure_payment_state(cur)
+        if payment_fixes:
             cur.execute(
                 """
-                INSERT INTO SIGNATURE (SIGNATURE_ID, DONOR_ID, SESSION_ID, SIGNATURE_IMAGE, HASH_SHA256, CAPTURED_AT)
-                VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP())
-                """,
-                (signature_id, payload.donor_id, payload.session_id, full_stage_uri, hash_sha256)
+                CREATE OR REPLACE TEMPORARY TABLE RECON_PAYMENT_FIX (
+                    PAYMENT_ID STRING, SESSION_ID STRING, DONOR_ID STRING, TYPE STRING,
+                    STRIPE_CUSTOMER_ID STRING, STRIPE_SUBSCRIPTION_ID STRING,
+                    STRIPE_PAYMENT_INTENT_ID STRING, STATUS STRING, LAST_INVOICE_ID STRING)
+                """
+            )
+            cur.executemany("INSERT INTO RECON_PAYMENT_FIX VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", payment_fixes)
+            cur.execute(
+                """
+                MERGE INTO PAYMENT T USING RECON_PAYMENT_FIX S ON T.PAYMENT_ID = S.PAYMENT_ID
+                WHEN MATCHED THEN UPDATE SET
+                    STATUS = S.STATUS,
+                    SESSION_ID = COALESCE(T.SESSION_ID, S.SESSION_ID),
+                    DONOR_ID = COALESCE(T.DONOR_ID, S.DONOR_ID),
+                    STRIPE_PAYMENT_INTENT_ID = COALESCE(T.STRIPE_PAYMENT_INTENT_ID, S.STRIPE_PAYMENT_INTENT_ID),
+                    LAST_INVOICE_ID = COALESCE(S.LAST_INVOICE_ID, T.LAST_INVOICE_ID),
+                    UPDATED_AT = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN INSERT
+                    (PAYMENT_ID, SESSION_ID, DONOR_ID, TYPE, STRIPE_CUSTOMER_ID, STRIPE_SUBSCRIPTION_ID,
+                     STRIPE_PAYMENT_INTENT_ID, STATUS, LAST_INVOICE_ID, CREATED_AT, UPDATED_AT)
+                    VALUES (S.PAYMENT_ID, S.SESSION_ID, S.DONOR_ID, S.TYPE, S.STRIPE_CUSTOMER_ID,
+                            S.STRIPE_SUBSCRIPTION_ID, S.STRIPE_PAYMENT_INTENT_ID, S.STATUS, S.LAST_INVOICE_ID,
+                            CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
+                """
+            )
+        if subscription_fixes:
+            cur.execute(
+                """
+                CREATE OR REPLACE TEMPORARY TABLE RECON_SUBSCRIPTION_FIX (
+                    STRIPE_SUBSCRIPTION_ID STRING, SESSION_ID STRING, DONOR_ID STRING,
+                    STRIPE_CUSTOMER_ID STRING, STATUS STRING, LAST_INVOICE_ID STRING, CANCEL_AT NUMBER)
+                """
+            )
+            cur.executemany("INSERT INTO RECON_SUBSCRIPTION_FIX VALUES (%s, %s, %s, %s, %s, %s, %s)", subscription_fixes)
+            cur.execute(
+                f"""
+                MERGE INTO {SUBSCRIPTION_TABLE} T USING RECON_SUBSCRIPTION_FIX S
+                ON T.STRIPE_SUBSCRIPTION_ID = S.STRIPE_SUBSCRIPTION_ID
+                WHEN MATCHED THEN UPDATE SET
+                    STATUS = S.STATUS,
+                    LAST_INVOICE_ID = COALESCE(S.LAST_INVOICE_ID, T.LAST_INVOICE_ID),
+                    CANCEL_AT = COALESCE(TO_TIMESTAMP_NTZ(S.CANCEL_AT), T.CANCEL_AT),
+                    UPDATED_AT = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN INSERT
+                    (STRIPE_SUBSCRIPTION_ID, SESSION_ID, DONOR_ID, STRIPE_CUSTOMER_ID, STATUS,
+                     LAST_INVOICE_ID, CANCEL_AT, UPDATED_AT)
+                    VALUES (S.STRIPE_SUBSCRIPTION_ID, S.SESSION_ID, S.DONOR_ID, S.STRIPE_CUSTOMER_ID, S.STATUS,
+                            S.LAST_INVOICE_ID, TO_TIMESTAMP_NTZ(S.CANCEL_AT), CURRENT_TIMESTAMP())
+                """
+            )
+        if pm_fixes:
+            cur.execute(
+                """
+                CREATE OR REPLACE TEMPORARY TABLE RECON_PM_FIX (
+                    PM_ID STRING, DONOR_ID STRING, STRIPE_CUSTOMER_ID STRING,
+                    STRIPE_PAYMENT_METHOD_ID STRING, USAGE STRING)
+                """
+            )
+            cur.executemany("INSERT INTO RECON_PM_FIX VALUES (%s, %s, %s, %s, %s)", pm_fixes)
+            cur.execute(
+                """
+                MERGE INTO PAYMENT_METHOD T USING RECON_PM_FIX S ON T.PM_ID = S.PM_ID
+                WHEN NOT MATCHED THEN INSERT (PM_ID, DONOR_ID, STRIPE_CUSTOMER_ID, STRIPE_PAYMENT_METHOD_ID, USAGE)
+                    VALUES (S.PM_ID, S.DONOR_ID, S.STRIPE_CUSTOMER_ID, S.STRIPE_PAYMENT_METHOD_ID, S.USAGE)
+                """
             )
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
 
-            # Presign the uploaded file (works fine for internal stages)
-            signature_url = presign_stage_url(cur, full_stage_uri, expires_sec=3600) or ""
 
-            insert_event(
-                cur,
-                LogEventIn(
-                    event_type="SIGNATURE_CAPTURED",
-                    session_id=payload.session_id,
-                    donor_id=payload.donor_id,
-                    attributes={
-                        "signature_id": signature_id,
-                        "hash_sha256": hash_sha256,
-                        "file_size": len(png_data),
-                        "stage_path": rel_path,
-                        "stage": SIGNATURE_STAGE_NAME,
-                    },
-                ),
-            )
+# ---------- Backfill: EVENT_LOG session/donor ids from Stripe metadata ----------
+BACKFILL_STRIPE_RPS = float(os.getenv("BACKFILL_STRIPE_RPS", "20"))
+BACKFILL_MAX_RETRIES = int(os.getenv("BACKFILL_MAX_RETRIES", "5"))
+
+class _StripeMetadataResolver:
+    """
+    Resolves (session_id, donor_id) for a Stripe object, following
+    PI -> invoice -> subscription links. Every object is retrieved at most once
+    per run, and retrievals share a rate bucket.
+    """
 
-            return SignatureUploadOut(
-                signature_id=signature_id,
-                signature_url=signature_url,
-                success=True,
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self._memo: Dict[Tuple[str, str], Tuple[Optional[str], Optional[str], Dict[str, Optional[str]]]] = {}
+        self._lock = threading.Lock()
+        self._flight = SingleFlight("backfill_stripe")
+
+    def _fetch(self, kind: str, obj_id: str):
+        with self._lock:
+            hit = self._memo.get((kind, obj_id))
+        if hit is not None:
+            return hit
+        # Linked objects (e.g. one subscription behind many invoices) may be wanted by several workers at once
+        return self._flight.do((kind, obj_id), lambda: self._retrieve(kind, obj_id))
+
+    def _retrieve(self, kind: str, obj_id: str):
+        resource = {"payment_intent": stripe.PaymentIntent, "invoice": stripe.Invoice,
+                    "subscription": stripe.Subscription}[kind]
+        self.bucket.acquire()
+        metric_inc("backfill.stripe_fetch")
+        obj = resource.retrieve(obj_id)
+        links = {
+            "invoice": _stripe_id(obj.get("invoice")),
+            "subscription": _invoice_subscription_id(obj) if kind == "invoice" else _stripe_id(obj.get("subscription")),
+            "payment_intent": _stripe_id(obj.get("payment_intent")),
+        }
+        result = (_md_get(obj, "session_id"), _md_get(obj, "donor_id"), links)
+        with self._lock:
+            self._memo[(kind, obj_id)] = result
+        return result
+
+    def resolve(self, kind: str, obj_id: str, _depth: int = 0) -> Tuple[Optional[str], Optional[str]]:
+        session_id, donor_id, links = self._fetch(kind, obj_id)
+        if (session_id and donor_id) or _depth >= 2:
+            return session_id, donor_id
+        for next_kind in ("invoice", "subscription", "payment_intent"):
+            next_id = links.get(next_kind)
+            if next_id and next_kind != kind:
+                s2, d2 = self.resolve(next_kind, next_id, _depth + 1)
+                session_id, donor_id = session_id or s2, donor_id or d2
+                if session_id and donor_id:
+                    break
+        return session_id, donor_id
+
+def _backfill_key(obj_type, obj_id, pi_id, inv_id, sub_id) -> Optional[Tuple[str, str]]:
+    if obj_type in ("payment_intent", "invoice", "subscription") and obj_id:
+        return obj_type, obj_id
+    for kind, x in (("payment_intent", pi_id), ("invoice", inv_id), ("subscription", sub_id)):
+        if x:
+            return kind, x
+    return None
+
+def _stripe_transient(e: Exception) -> bool:
+    """Rate limits, network errors and Stripe 5xx: the lookup may succeed if retried."""
+    if isinstance(e, (stripe.error.RateLimitError, stripe.error.APIConnectionError)):
+        return True
+    status = getattr(e, "http_status", None)
+    return isinstance(e, stripe.error.StripeError) and isinstance(status, int) and status >= 500
+
+def _load_checkpoint(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"last_event_id": "", "scanned": 0, "updated": 0, "unresolved": 0}
+
+def _save_checkpoint(path: str, state: Dict[str, Any]):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+def backfill_event_ids(checkpoint_path: str, batch_size: int = 2000, workers: int = 8,
+                       max_batches: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Fills NULL SESSION_ID / DONOR_ID on STRIPE_* events. Rows are read in EVENT_ID
+    order, grouped by their PaymentIntent / Invoice / Subscription so each Stripe
+    object is fetched once, and updated with one MERGE per batch. The last
+    EVENT_ID is checkpointed after each batch commits, so a rerun resumes there.
+    A transient Stripe error holds the checkpoint just before the first affected
+    row; the batch is retried with backoff and the run stops after
+    BACKFILL_MAX_RETRIES failed attempts in a row.
+    """
+    state = _load_checkpoint(checkpoint_path)
+    resolver = _StripeMetadataResolver(TokenBucket(BACKFILL_STRIPE_RPS, capacity=BACKFILL_STRIPE_RPS))
+    batches = 0
+    retries = 0
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        while max_batches is None or batches < max_batches:
+            cur.execute(
+                """
+                SELECT EVENT_ID, ATTRIBUTES:object::STRING, ATTRIBUTES:id::STRING,
+                       ATTRIBUTES:payment_intent::STRING, ATTRIBUTES:invoice::STRING,
+                       ATTRIBUTES:subscription::STRING, SESSION_ID, DONOR_ID
+                FROM EVENT_LOG
+                WHERE EVENT_TYPE LIKE 'STRIPE_%%'
+                  AND (SESSION_ID IS NULL OR DONOR_ID IS NULL)
+                  AND EVENT_ID > %s
+                ORDER BY EVENT_ID
+                LIMIT %s
+                """,
+                (state["last_event_id"], batch_size),
             )
+            rows = cur.fetchall()
+            if not rows:
+                break
+            groups: Dict[Tuple[str, str], list] = {}
+            unresolved = []
+            for event_id, obj_type, obj_id, pi_id, inv_id, sub_id, s_id, d_id in rows:
+                key = _backfill_key(obj_type, obj_id, pi_id, inv_id, sub_id)
+                if key:
+                    groups.setdefault(key, []).append((event_id, s_id, d_id))
+                else:
+                    unresolved.append(event_id)
 
-        finally:
-            try: cur.close()
-            except Exception: pass
-            ctx.close()
+            def resolve(key):
+                try:
+                    return key, resolver.resolve(*key)
+                except Exception as e:
+                    metric_inc("backfill.stripe_error")
+                    print(f"=== DEBUG: backfill could not resolve {key}: {e} ===")
+                    return key, None if _stripe_transient(e) else (None, None)
 
-    except Exception as e:
-        print(f"=== DEBUG: Signature upload failed: {e} ===")
-        raise HTTPException(status_code=500, detail=f"Signature upload failed: {str(e)}")
+            fixes, failed = [], []
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for key, resolved in pool.map(in_current_workload(resolve), list(groups)):
+                    if resolved is None:
+                        failed += [event_id for event_id, _, _ in groups[key]]
+                        continue
+                    session_id, donor_id = resolved
+                    for event_id, s_id, d_id in groups[key]:
+                        new_s, new_d = s_id or session_id, d_id or donor_id
+                        if (new_s, new_d) != (s_id, d_id):
+                            fixes.append((event_id, new_s, new_d))
+                        else:
+                            unresolved.append(event_id)
 
-# ---------- Stripe Location ID ----------
-@app.get("/terminal/location")
-def get_terminal_location():
-    return {"location_id": os.getenv("STRIPE_TERMINAL_LOCATION_ID", "")}
+            if fixes:
+                cur.execute(
+                    "CREATE OR REPLACE TEMPORARY TABLE BACKFILL_EVENT_FIX (EVENT_ID STRING, SESSION_ID STRING, DONOR_ID STRING)"
+                )
+                cur.executemany("INSERT INTO BACKFILL_EVENT_FIX VALUES (%s, %s, %s)", fixes)
+                cur.execute(
+                    """
+                    MERGE INTO EVENT_LOG T USING BACKFILL_EVENT_FIX S ON T.EVENT_ID = S.EVENT_ID
+                    WHEN MATCHED THEN UPDATE SET
+                        SESSION_ID = COALESCE(T.SESSION_ID, S.SESSION_ID),
+                        DONOR_ID = COALESCE(T.DONOR_ID, S.DONOR_ID)
+                    """
+                )
+            # Rows past a failed lookup are rescanned next time; fixed ones no longer match the scan
+            first_failed = min(failed) if failed else None
+            done = [r[0] for r in rows if first_failed is None or r[0] < first_failed]
+            if done:
+                state["last_event_id"] = done[-1]
+            state["scanned"] += len(done) + sum(1 for f in fixes if first_failed is not None and f[0] > first_failed)
+            state["updated"] += len(fixes)
+            state["unresolved"] += sum(1 for event_id in unresolved if first_failed is None or event_id < first_failed)
+            _save_checkpoint(checkpoint_path, state)
+            batches += 1
+            print(f"=== DEBUG: backfill batch {batches}: {len(rows)} rows, {len(groups)} Stripe objects, "
+                  f"{len(fixes)} fixed, {len(failed)} failed; checkpoint {state['last_event_id']} ===")
+            if not failed:
+                retries = 0
+                continue
+            retries += 1
+            if retries >= BACKFILL_MAX_RETRIES:
+                print(f"=== DEBUG: backfill stopping after {retries} failed attempts; rerun resumes after "
+                      f"{state['last_event_id'] or 'the start'} ===")
+                break
+            time.sleep(min(60.0, 2 ** retries) * (0.5 + random.random()))
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    return state
+
+
+# ---------- Bulk pledge import ----------
+STRIPE_IMPORT_RPS = float(os.getenv("STRIPE_IMPORT_RPS", "25"))
+PLEDGE_IMPORT_COLUMNS = ("EXTERNAL_REF", "DONOR_ID", "TITLE", "FIRST_NAME", "MIDDLE_NAME", "LAST_NAME",
+                         "DOB_DATE", "MOBILE_E164", "EMAIL", "ADDRESS1", "ADDRESS2", "CITY", "REGION",
+                         "POSTAL_CODE", "COUNTRY")
+PLEDGE_REQUIRED_FIELDS = ("external_ref", "first_name", "last_name", "email", "address1", "city",
+                          "region", "postal_code", "campaign_id")
+
+def _read_pledges(path: str, fmt: Optional[str] = None):
+    """Streams pledge dicts (lower-case keys) from CSV or NDJSON without loading the file."""
+    fmt = fmt or ("ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv")
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            for row in csv.DictReader(f):
+                yield {k.strip().lower(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+        else:
+            for line in f:
+                if line.strip():
+                    yield {k.lower(): v for k, v in json.loads(line).items()}
+
+def _chunks(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _pledge_age_ok(dob_iso: str) -> bool:
+    # same rule as donor_upsert
+    try:
+        dob = datetime.fromisoformat(dob_iso).date()
+    except Exception:
+        return False
+    return (datetime.now(timezone.utc).date() - dob).days // 365 >= 25
+
+def _stripe_write(bucket: TokenBucket, fn, **kwargs):
+    """Stripe write behind the import's rate bucket, backing off with jitter on 429s."""
+    for attempt in range(6):
+        bucket.acquire()
+        try:
+            return fn(**kwargs)
+        except stripe.error.RateLimitError:
+            metric_inc("pledge_import.stripe_429")
+            if attempt == 5:
+                raise
+            time.sleep(min(8.0, 0.5 * 2 ** attempt) * (0.5 + random.random()))
+
+def _pledge_price_id(cur, p: Dict[str, Any], products_by_campaign: Dict[str, list]) -> str:
+    if p.get("price_id"):
+        return p["price_id"]
+    amount = int(p.get("amount_cents") or 0)
+    currency = (p.get("currency") or "CAD").upper()
+    products = products_by_campaign.get(p["campaign_id"])
+    if products is None:
+        products = products_by_campaign[p["campaign_id"]] = _read_campaign_products(cur, p["campaign_id"])
+    for prod in products:
+        if ((prod["product_type"] or "").upper() == "MONTHLY" and prod["amount_cents"] == amount
+                and (prod["currency"] or "").upper() == currency and prod["stripe_price_id"]):
+            return prod["stripe_price_id"]
+    raise ValueError(f"No MONTHLY product for {p['campaign_id']} {amount} {currency}")
+
+def _load_pledge_donors(cur, pledges: List[Dict[str, Any]], import_id: str) -> Dict[str, str]:
+    """
+    Bulk-loads a chunk of donors: CSV -> PUT to the temp table's stage -> COPY ->
+    MERGE into DONOR on EMAIL (existing donors keep their DONOR_ID). Returns
+    external_ref -> DONOR_ID.
+    """
+    cur.execute(
+        "CREATE OR REPLACE TEMPORARY TABLE PLEDGE_IMPORT_DONOR ("
+        + ", ".join(f"{c} {'DATE' if c == 'DOB_DATE' else 'STRING'}" for c in PLEDGE_IMPORT_COLUMNS) + ")"
+    )
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, newline="", encoding="utf-8") as tmp:
+        writer = csv.writer(tmp)
+        for p in pledges:
+            ref_hash = hashlib.sha256(f"{import_id}|{p['external_ref']}".encode("utf-8")).hexdigest()[:24]
+            writer.writerow([p["external_ref"], f"donor-imp-{ref_hash}", p.get("title"), p["first_name"],
+                             p.get("middle_name"), p["last_name"], p.get("dob_iso") or None,
+                             p.get("mobile_e164"), p["email"], p["address1"], p.get("address2"), p["city"],
+                             p["region"], p["postal_code"], p.get("country") or "CA"])
+        tmp_path = tmp.name
+    try:
+        cur.execute(f"PUT file://{tmp_path} @%PLEDGE_IMPORT_DONOR AUTO_COMPRESS=TRUE OVERWRITE=TRUE")
+    finally:
+        try: os.unlink(tmp_path)
+        except Exception: pass
+    cur.execute(
+        """
+        COPY INTO PLEDGE_IMPORT_DONOR FROM @%PLEDGE_IMPORT_DONOR
+        FILE_FORMAT = (TYPE = CSV FIELD_OPTIONALLY_ENCLOSED_BY = '"' EMPTY_FIELD_AS_NULL = TRUE)
+        PURGE = TRUE
+        """
+    )
+    cur.execute(
+        """
+        MERGE INTO DONOR T
+        USING (SELECT * FROM PLEDGE_IMPORT_DONOR QUALIFY ROW_NUMBER() OVER (PARTITION BY EMAIL ORDER BY EXTERNAL_REF) = 1) S
+        ON T.EMAIL = S.EMAIL
+        WHEN MATCHED THEN UPDATE SET
+            TITLE = COALESCE(S.TITLE, T.TITLE), FIRST_NAME = S.FIRST_NAME, MIDDLE_NAME = S.MIDDLE_NAME,
+            LAST_NAME = S.LAST_NAME, DOB_DATE = COALESCE(S.DOB_DATE, T.DOB_DATE),
+            MOBILE_E164 = COALESCE(S.MOBILE_E164, T.MOBILE_E164), ADDRESS1 = S.ADDRESS1, ADDRESS2 = S.ADDRESS2,
+            CITY = S.CITY, REGION = S.REGION, POSTAL_CODE = S.POSTAL_CODE, COUNTRY = S.COUNTRY,
+            UPDATED_AT = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN INSERT
+            (DONOR_ID, TITLE, FIRST_NAME, MIDDLE_NAME, LAST_NAME, DOB_DATE, MOBILE_E164, EMAIL,
+             ADDRESS1, ADDRESS2, CITY, REGION, POSTAL_CODE, COUNTRY, CREATED_AT)
+            VALUES (S.DONOR_ID, S.TITLE, S.FIRST_NAME, S.MIDDLE_NAME, S.LAST_NAME, S.DOB_DATE, S.MOBILE_E164,
+                    S.EMAIL, S.ADDRESS1, S.ADDRESS2, S.CITY, S.REGION, S.POSTAL_CODE, S.COUNTRY, CURRENT_TIMESTAMP())
+        """
+    )
+    rows = cur.execute(
+        "SELECT S.EXTERNAL_REF, D.DONOR_ID FROM PLEDGE_IMPORT_DONOR S JOIN DONOR D ON D.EMAIL = S.EMAIL"
+    ).fetchall()
+    return {ref: donor_id for ref, donor_id in rows}
+
+def _import_pledge_stripe(p: Dict[str, Any], donor_id: str, price_id: str, import_id: str,
+                          state: Dict[str, Any], bucket: TokenBucket) -> Dict[str, Any]:
+    """
+    Customer -> attach PM -> subscription for one pledge. Idempotency keys derive
+    from (import_id, external_ref) and the time parameters are pinned in the
+    checkpoint, so a retried pledge replays instead of duplicating.
+    """
+    ref = p["external_ref"]
+    key_base = f"imp-{import_id}-{ref}"
+    md = {"donor_id": donor_id, "import_id": import_id, "external_ref": ref, "session_id": ""}
+    customer_id = p.get("stripe_customer_id") or _customer_index_get(p["email"])
+    if not customer_id:
+        cust = _stripe_write(bucket, stripe.Customer.create, email=p["email"],
+                             name=" ".join(x for x in (p.get("first_name"), p.get("last_name")) if x),
+                             phone=p.get("mobile_e164") or None, metadata=md,
+                             idempotency_key=f"{key_base}-cus")
+        customer_id = cust.id
+    pm = p.get("payment_method_id")
+    if pm:
+        try:
+            _stripe_write(bucket, lambda **kw: stripe.PaymentMethod.attach(pm, **kw), customer=customer_id,
+                          idempotency_key=f"{key_base}-pm")
+        except stripe.error.InvalidRequestError as e:
+            if "already been attached" not in str(e):
+                raise
+    anchor = state["default_anchor"]
+    if p.get("next_charge_date"):
+        anchor = int(datetime.fromisoformat(p["next_charge_date"]).replace(tzinfo=timezone.utc).timestamp())
+    sub_kwargs = dict(
+        customer=customer_id,
+        items=[{"price": price_id}],
+        cancel_at=state["cancel_at"],
+        collection_method="charge_automatically",
+        billing_cycle_anchor=anchor,
+        proration_behavior="none",
+        metadata=md | {"payment_source": "pledge_import"},
+        idempotency_key=f"{key_base}-sub",
+    )
+    if pm:
+        sub_kwargs["default_payment_method"] = pm
+    sub = _stripe_write(bucket, stripe.Subscription.create, **sub_kwargs)
+    return {"ref": ref, "donor_id": donor_id, "customer_id": customer_id, "email": p["email"],
+            "payment_method_id": pm, "subscription_id": sub.id, "status": sub.status}
+
+def _write_pledge_results(cur, results: List[Dict[str, Any]], state: Dict[str, Any]):
+    """Customer index + PAYMENT / SUBSCRIPTION / PAYMENT_METHOD rows for pledges whose Stripe side exists."""
+    _customer_index_put_many(cur, [(r["email"], r["customer_id"]) for r in results], "IMPORT")
+    _bulk_merge_payments(
+        [(f"sub-{r['subscription_id']}", None, r["donor_id"], "MONTHLY", r["customer_id"],
+          r["subscription_id"], None, r["status"], None) for r in results],
+        [(r["subscription_id"], None, r["donor_id"], r["customer_id"], r["status"], None,
+          state["cancel_at"]) for r in results],
+        [(f"pm-{r['payment_method_id']}", r["donor_id"], r["customer_id"], r["payment_method_id"],
+          "OFF_SESSION") for r in results if r["payment_method_id"]],
+    )
+
+def _read_jsonl(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def import_pledges(path: str, checkpoint_path: str, import_id: Optional[str] = None, fmt: Optional[str] = None,
+                   chunk_size: int = 500, workers: int = 8) -> Dict[str, Any]:
+    """
+    Streams a pledge file in chunks: bulk-loads DONOR rows, then creates Stripe
+    customers/subscriptions on a worker pool behind a shared rate bucket and
+    bulk-writes PAYMENT / PAYMENT_METHOD rows. Each Stripe result is appended to
+    <checkpoint>.created.jsonl as soon as it exists, and its ref to
+    <checkpoint>.done.jsonl once the chunk's MERGE has committed; a rerun writes
+    created-but-not-done results first, then skips every done ref.
+    """
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+    else:
+        state = {
+            "import_id": import_id or hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:12],
+            "cancel_at": years_from_now_utc(50),
+            "default_anchor": int((datetime.now(timezone.utc) + timedelta(days=30)).timestamp()),
+            "created": 0, "failed": 0, "skipped": 0,
+        }
+        _save_checkpoint(checkpoint_path, state)
+    import_id = state["import_id"]
+    done_path = f"{checkpoint_path}.done.jsonl"
+    created_path = f"{checkpoint_path}.created.jsonl"
+    done = {r["ref"] for r in _read_jsonl(done_path)}
+    errors_path = f"{checkpoint_path}.errors.jsonl"
+    bucket = TokenBucket(STRIPE_IMPORT_RPS, capacity=STRIPE_IMPORT_RPS)
+    created_lock = threading.Lock()
+    products_by_campaign: Dict[str, list] = {}   # campaign_id -> active products, read once per import
+
+    ctx = get_snowflake_ctx()
+    try:
+        cur = ctx.cursor()
+        _customer_index_load(cur)
+        with open(done_path, "a") as done_f, open(created_path, "a") as created_f, open(errors_path, "a") as err_f:
+            # Subscriptions created by an interrupted run whose rows never reached Snowflake
+            unwritten = [r for r in _read_jsonl(created_path) if r["ref"] not in done]
+            if unwritten:
+                _write_pledge_results(cur, unwritten, state)
+                for r in unwritten:
+                    done_f.write(json.dumps({"ref": r["ref"]}) + "\n")
+                    done.add(r["ref"])
+                done_f.flush()
+                state["created"] += len(unwritten)
+                _save_checkpoint(checkpoint_path, state)
+                print(f"=== DEBUG: pledge import {import_id}: wrote {len(unwritten)} results from the last run ===")
+            for chunk in _chunks(_read_pledges(path, fmt), chunk_size):
+                todo, invalid = [], []
+                for p in chunk:
+                    missing = [k for k in PLEDGE_REQUIRED_FIELDS if not _nz(str(p.get(k) or ""))]
+                    if missing:
+                        invalid.append((p, f"missing {', '.join(missing)}"))
+                    elif p.get("dob_iso") and not _pledge_age_ok(p["dob_iso"]):
+                        invalid.append((p, "invalid dob_iso or donor under 25"))
+                    elif p["external_ref"] in done:
+                        state["skipped"] += 1
+                    else:
+                        todo.append(p)
+                for p, why in invalid:
+                    err_f.write(json.dumps({"ref": p.get("external_ref"), "error": why}) + "\n")
+                state["failed"] += len(invalid)
+                if not todo:
+                    continue
+
+                donor_ids = _load_pledge_donors(cur, todo, import_id)
+                jobs = []
+                for p in todo:
+                    try:
+                        jobs.append((p, donor_ids[p["external_ref"]], _pledge_price_id(cur, p, products_by_campaign)))
+                    except Exception as e:
+                        err_f.write(json.dumps({"ref": p["external_ref"], "error": str(e)}) + "\n")
+                        state["failed"] += 1
+
+                def run(job):
+                    p, donor_id, price_id = job
+                    try:
+                        res = _import_pledge_stripe(p, donor_id, price_id, import_id, state, bucket)
+                    except Exception as e:
+                        metric_inc("pledge_import.failed")
+                        return None, {"ref": p["external_ref"], "error": str(e)}
+                    with created_lock:
+                        created_f.write(json.dumps(res) + "\n")
+                        created_f.flush()
+                    return res, None
+
+                results = []
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for res, err in pool.map(in_current_workload(run), jobs):
+                        if err:
+                            err_f.write(json.dumps(err) + "\n")
+                            state["failed"] += 1
+                        else:
+                            results.append(res)
+
+                _write_pledge_results(cur, results, state)
+                for r in results:
+                    done_f.write(json.dumps({"ref": r["ref"]}) + "\n")
+                    done.add(r["ref"])
+                done_f.flush()
+                insert_event(cur, LogEventIn(event_type="PLEDGE_IMPORT_CHUNK", attributes={
+                    "import_id": import_id, "created": len(results), "attempted": len(jobs),
+                }))
+                state["created"] += len(results)
+                _save_checkpoint(checkpoint_path, state)
+                err_f.flush()
+                print(f"=== DEBUG: pledge import {import_id}: +{len(results)} subscriptions "
+                      f"(total {state['created']}, failed {state['failed']}, skipped {state['skipped']}) ===")
+    finally:
+        try: cur.close()
+        except Exception: pass
+        ctx.close()
+    return state
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Globalfaces backend maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_snap = sub.add_parser("export-snapshot", help="Write the reference-data snapshot file")
+    p_snap.add_argument("--path", default=REF_SNAPSHOT_PATH)
+    p_rec = sub.add_parser("reconcile", help="Diff Stripe PaymentIntents/Subscriptions/Invoices against Snowflake")
+    p_rec.add_argument("--since", required=True, help="YYYY-MM-DD (UTC, inclusive)")
+    p_rec.add_argument("--until", required=True, help="YYYY-MM-DD (UTC, exclusive)")
+    p_rec.add_argument("--workers", type=int, default=8)
+    p_rec.add_argument("--report", default="reconcile_report.jsonl")
+    p_rec.add_argument("--repair", action="store_true", help="MERGE the fixable discrepancies")
+    p_bf = sub.add_parser("backfill-event-ids", help="Fill NULL SESSION_ID/DONOR_ID on STRIPE_* events")
+    p_bf.add_argument("--checkpoint", default="backfill_event_ids.checkpoint.json")
+    p_bf.add_argument("--batch-size", type=int, default=2000)
+    p_bf.add_argument("--workers", type=int, default=8)
+    p_bf.add_argument("--max-batches", type=int, default=None)
+    p_imp = sub.add_parser("import-pledges", help="Bulk-import monthly pledges from CSV/NDJSON")
+    p_imp.add_argument("path")
+    p_imp.add_argument("--checkpoint", required=True, help="State file; rerun with the same one to resume")
+    p_imp.add_argument("--import-id", default=None)
+    p_imp.add_argument("--format", choices=("csv", "ndjson"), default=None)
+    p_imp.add_argument("--chunk-size", type=int, default=500)
+    p_imp.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    _workload.set("batch")
+
+    if args.command == "export-snapshot":
+        export_reference_snapshot(args.path)
+    elif args.command == "reconcile":
+        reconcile_stripe(
+            datetime.fromisoformat(args.since).replace(tzinfo=timezone.utc),
+            datetime.fromisoformat(args.until).replace(tzinfo=timezone.utc),
+            workers=args.workers, repair=args.repair, report_path=args.report,
+        )
+    elif args.command == "backfill-event-ids":
+        print(backfill_event_ids(args.checkpoint, args.batch_size, args.workers, args.max_batches))
+    elif args.command == "import-pledges":
+        print(import_pledges(args.path, args.checkpoint, args.import_id, args.format, args.chunk_size, args.workers))
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# main.py reads its configuration at import time: point every store at a scratch directory
+_tmp = tempfile.mkdtemp(prefix="globalfaces-tests-")
+os.environ.update({
+    "STORAGE_BACKEND": "sqlite",
+    "LOCAL_DB_PATH": os.path.join(_tmp, "local.sqlite"),
+    "LOCAL_BLOB_DIR": os.path.join(_tmp, "local_blobs"),
+    "WRITE_JOURNAL_PATH": os.path.join(_tmp, "write_journal.sqlite"),
+    "RATE_LIMIT_DB_PATH": os.path.join(_tmp, "rate_limits.sqlite"),
+    "RATE_LIMIT_BACKEND": "memory",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
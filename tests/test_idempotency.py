@@ -0,0 +1,113 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def calls():
+    return {"n": 0}
+
+
+@pytest.fixture
+def client(calls, monkeypatch):
+    # Each test starts with a cold per-worker cache; the durable table is shared, so keys are unique
+    monkeypatch.setattr(main, "_idem_cache", OrderedDict())
+    api = FastAPI()
+
+    @api.post("/things")
+    async def create_thing(request: Request):
+        calls["n"] += 1
+        return JSONResponse({"n": calls["n"], "echo": await request.json()}, status_code=201,
+                            headers={"x-thing": "yes"})
+
+    @api.post("/flaky/{status}")
+    async def flaky(status: int):
+        calls["n"] += 1
+        return JSONResponse({"n": calls["n"]}, status_code=status)
+
+    return TestClient(main.IdempotencyMiddleware(api))
+
+
+def _key() -> str:
+    return f"test-{uuid.uuid4()}"
+
+
+def test_repeat_replays_first_response(client, calls):
+    headers = {"Idempotency-Key": _key()}
+    first = client.post("/things", json={"a": 1}, headers=headers)
+    second = client.post("/things", json={"a": 1}, headers=headers)
+    assert first.status_code == second.status_code == 201
+    assert second.json() == first.json() == {"n": 1, "echo": {"a": 1}}
+    assert second.headers["x-thing"] == "yes"
+    assert second.headers["idempotent-replayed"] == "true"
+    assert calls["n"] == 1
+
+
+def test_without_key_every_request_runs(client, calls):
+    client.post("/things", json={"a": 1})
+    client.post("/things", json={"a": 1})
+    assert calls["n"] == 2
+
+
+def test_key_reused_with_different_body_is_rejected(client, calls):
+    headers = {"Idempotency-Key": _key()}
+    client.post("/things", json={"a": 1}, headers=headers)
+    r = client.post("/things", json={"a": 2}, headers=headers)
+    assert r.status_code == 422
+    assert calls["n"] == 1
+
+
+@pytest.mark.parametrize("status", [500, 503, 429])
+def test_transient_responses_are_not_stored(client, calls, status):
+    headers = {"Idempotency-Key": _key()}
+    assert client.post(f"/flaky/{status}", headers=headers).status_code == status
+    assert client.post(f"/flaky/{status}", headers=headers).json() == {"n": 2}
+
+
+def test_replay_survives_losing_the_worker_cache(client, calls, monkeypatch):
+    headers = {"Idempotency-Key": _key()}
+    first = client.post("/things", json={"a": 1}, headers=headers)
+    monkeypatch.setattr(main, "_idem_cache", OrderedDict())
+    second = client.post("/things", json={"a": 1}, headers=headers)
+    assert second.json() == first.json()
+    assert calls["n"] == 1
+
+
+def test_key_claimed_by_another_worker_gets_409(client, calls):
+    client_key = _key()
+    state, _ = main._idem_db_claim(f"POST /things {client_key}", "other-worker")
+    assert state == "CLAIMED"
+    r = client.post("/things", json={"a": 1}, headers={"Idempotency-Key": client_key})
+    assert r.status_code == 409
+    assert calls["n"] == 0
+
+
+def test_concurrent_claims_have_one_winner():
+    key = f"POST /things {_key()}"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(main._idem_db_claim(key, "fp")[0]))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == ["CLAIMED"] + ["IN_PROGRESS"] * 7
+
+
+def test_only_the_claim_owner_can_complete_or_release():
+    key = f"POST /things {_key()}"
+    _, token = main._idem_db_claim(key, "fp")
+    main._idem_db_complete(key, "not-the-owner", 200, [("content-type", "application/json")], b"{}")
+    main._idem_db_release(key, "not-the-owner")
+    assert main._idem_db_claim(key, "fp")[0] == "IN_PROGRESS"
+    main._idem_db_complete(key, token, 200, [("content-type", "application/json")], b"{}")
+    state, row = main._idem_db_claim(key, "fp")
+    assert state == "COMPLETE"
+    assert row[1] == 200
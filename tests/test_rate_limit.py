@@ -0,0 +1,70 @@
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main
+
+LIMITS = {"r.device": (0.001, 5), "r.to": (0.001, 1), "r.off": (0, 1)}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def limiter(request, tmp_path):
+    if request.param == "memory":
+        backend = main._MemoryLimiterBackend(100)
+    else:
+        backend = main._SqliteLimiterBackend(str(tmp_path / "rate_limits.sqlite"))
+    return main.RateLimiter(backend, LIMITS)
+
+
+def test_burst_then_limited(limiter):
+    waits = [limiter.check("r", {"device": "tab-1"}) for _ in range(6)]
+    assert waits[:5] == [0.0] * 5
+    assert waits[5] > 0
+
+
+def test_rejection_does_not_spend_other_buckets(limiter):
+    assert limiter.check("r", {"device": "tab-1", "to": "+15550000001"}) == 0
+    # The number's bucket is empty: these must not drain the device's remaining 4 tokens
+    for _ in range(10):
+        assert limiter.check("r", {"device": "tab-1", "to": "+15550000001"}) > 0
+    admitted = [limiter.check("r", {"device": "tab-1", "to": f"+1555000010{i}"}) == 0 for i in range(5)]
+    assert admitted == [True, True, True, True, False]
+
+
+def test_keys_are_independent(limiter):
+    for _ in range(5):
+        limiter.check("r", {"device": "tab-1"})
+    assert limiter.check("r", {"device": "tab-1"}) > 0
+    assert limiter.check("r", {"device": "tab-2"}) == 0
+
+
+def test_unconfigured_disabled_and_missing_keys_are_ignored(limiter):
+    for _ in range(10):
+        assert limiter.check("r", {"off": "x", "ip": "10.0.0.1", "device": None}) == 0
+        assert limiter.check("other", {"device": "tab-1"}) == 0
+
+
+def test_backend_errors_fail_open(limiter, monkeypatch):
+    def broken(items):
+        raise main.sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(limiter.backend, "take_all", broken)
+    assert limiter.check("r", {"device": "tab-1"}) == 0
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = main._MemoryLimiterBackend(2)
+    for key in ("a", "b", "a", "c"):
+        backend.take_all([(key, 1.0, 1.0)])
+    assert list(backend._buckets) == ["a", "c"]
+
+
+def test_enforce_rate_limit_raises_429_with_retry_after(monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(main._MemoryLimiterBackend(100), {"r.device": (0.5, 1)}))
+    request = Request({"type": "http", "method": "POST", "path": "/", "headers": [(b"x-device-id", b"tab-9")],
+                       "client": ("10.0.0.1", 1234)})
+    main.enforce_rate_limit("r", request)
+    with pytest.raises(HTTPException) as e:
+        main.enforce_rate_limit("r", request)
+    assert e.value.status_code == 429
+    assert e.value.headers["Retry-After"] == "2"
@@ -0,0 +1,131 @@
+import gzip
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def local(tmp_path):
+    return main.LocalStorage(str(tmp_path / "local.sqlite"), str(tmp_path / "blobs"))
+
+
+@pytest.fixture
+def cur(local):
+    return local.connect().cursor()
+
+
+def test_dialect_params_and_functions():
+    sql = main._sqlite_dialect(
+        "SELECT ATTRIBUTES:amount::NUMBER, %s::DATE FROM EVENT_LOG "
+        "WHERE EVENT_TYPE LIKE 'STRIPE_%%' AND CREATED_AT > DATEADD(minute, -5, CURRENT_TIMESTAMP())",
+        True,
+    )
+    assert "json_extract(ATTRIBUTES, '$.amount')" in sql
+    assert "DATE(?)" in sql
+    assert "LIKE 'STRIPE_%'" in sql
+    assert "DATEADD('minute'," in sql
+    assert main._SQLITE_NOW in sql
+    assert "::" not in sql
+
+
+def test_dialect_leaves_percent_alone_without_params():
+    assert "'a%%'" in main._sqlite_dialect("SELECT 1 WHERE X LIKE 'a%%'", False)
+
+
+def test_ddl_maps_text_types():
+    sql = main._sqlite_dialect("CREATE TABLE T (A STRING, B VARIANT, C NUMBER)", False)
+    assert "A TEXT" in sql and "B TEXT" in sql and "C NUMBER" in sql
+
+
+def test_string_columns_keep_leading_zeros(cur):
+    cur.execute("CREATE OR REPLACE TABLE T (ID STRING, POSTAL STRING)")
+    cur.execute("INSERT INTO T VALUES (%s, %s)", ("a", "01234"))
+    assert cur.execute("SELECT POSTAL FROM T").fetchone() == ("01234",)
+
+
+def test_merge_inserts_then_updates(cur):
+    cur.execute("CREATE OR REPLACE TABLE ITEM (ID STRING, N NUMBER, NOTE STRING)")
+    merge = """
+        MERGE INTO ITEM T USING (SELECT %s AS ID, %s AS N) S ON T.ID = S.ID
+        WHEN MATCHED THEN UPDATE SET N = S.N
+        WHEN NOT MATCHED THEN INSERT (ID, N, NOTE) VALUES (S.ID, S.N, 'new')
+    """
+    cur.execute(merge, ("a", 1))
+    assert cur.rowcount == 1
+    cur.execute(merge, ("a", 2))
+    assert cur.rowcount == 1
+    assert cur.execute("SELECT ID, N, NOTE FROM ITEM").fetchall() == [("a", 2, "new")]
+
+
+def test_merge_matched_condition(cur):
+    cur.execute("CREATE OR REPLACE TABLE ITEM (ID STRING, TS NUMBER)")
+    cur.execute("INSERT INTO ITEM VALUES ('a', 10)")
+    merge = """
+        MERGE INTO ITEM T USING (SELECT %s AS ID, %s AS TS) S ON T.ID = S.ID
+        WHEN MATCHED AND T.TS <= S.TS THEN UPDATE SET TS = S.TS
+        WHEN NOT MATCHED THEN INSERT (ID, TS) VALUES (S.ID, S.TS)
+    """
+    cur.execute(merge, ("a", 5))
+    assert cur.rowcount == 0
+    cur.execute(merge, ("a", 20))
+    assert cur.execute("SELECT TS FROM ITEM").fetchone() == (20,)
+
+
+def test_merge_insert_sees_rows_from_before_the_merge(cur):
+    cur.execute("CREATE OR REPLACE TABLE ITEM (ID STRING, N NUMBER)")
+    cur.execute("CREATE OR REPLACE TEMPORARY TABLE ITEM_FIX (ID STRING, N NUMBER)")
+    cur.executemany("INSERT INTO ITEM_FIX VALUES (%s, %s)", [("a", 1), ("b", 2), ("a", 5)])
+    cur.execute(
+        """
+        MERGE INTO ITEM T USING ITEM_FIX S ON T.ID = S.ID
+        WHEN MATCHED THEN UPDATE SET N = T.N + S.N
+        WHEN NOT MATCHED THEN INSERT (ID, N) VALUES (S.ID, S.N)
+        """
+    )
+    # Both "a" source rows insert: neither matched a row that existed before the MERGE
+    assert cur.rowcount == 3
+    assert sorted(cur.execute("SELECT ID, N FROM ITEM").fetchall()) == [("a", 1), ("a", 5), ("b", 2)]
+
+
+def test_add_column_if_not_exists(cur):
+    cur.execute("CREATE OR REPLACE TABLE T (ID STRING)")
+    for _ in range(2):
+        cur.execute("ALTER TABLE T ADD COLUMN IF NOT EXISTS A STRING, B NUMBER")
+    cur.execute("SELECT ID, A, B FROM T")
+    assert [d[0] for d in cur.description] == ["ID", "A", "B"]
+
+
+def test_put_and_copy_csv(cur, local, tmp_path):
+    cur.execute("CREATE OR REPLACE TEMPORARY TABLE IMP (A STRING, B STRING, D DATE)")
+    src = tmp_path / "rows.csv"
+    src.write_text('x,"1,2",2000-01-02\ny,,\n')
+    cur.execute(f"PUT file://{src} @%IMP AUTO_COMPRESS=TRUE OVERWRITE=TRUE")
+    staged = os.path.join(local.blob_dir, "%IMP", "rows.csv.gz")
+    assert gzip.decompress(open(staged, "rb").read()) == src.read_bytes()
+
+    cur.execute(
+        """
+        COPY INTO IMP FROM @%IMP
+        FILE_FORMAT = (TYPE = CSV FIELD_OPTIONALLY_ENCLOSED_BY = '"' EMPTY_FIELD_AS_NULL = TRUE)
+        PURGE = TRUE
+        """
+    )
+    assert cur.rowcount == 2
+    rows = cur.execute("SELECT A, B, D FROM IMP ORDER BY A").fetchall()
+    assert rows == [("x", "1,2", main.date(2000, 1, 2)), ("y", None, None)]
+    assert not os.path.exists(staged)
+
+
+def test_get_copies_stage_files_out(cur, local, tmp_path):
+    local.put_blob(cur, "@ASSETS_INT/sig/a.png", b"png")
+    cur.execute(f"GET @ASSETS_INT/sig/ file://{tmp_path / 'out'}")
+    assert cur.rowcount == 1
+    assert (tmp_path / "out" / "a.png").read_bytes() == b"png"
+
+
+def test_copy_rejects_other_formats(cur):
+    cur.execute("CREATE OR REPLACE TEMPORARY TABLE IMP (A STRING)")
+    with pytest.raises(ValueError):
+        cur.execute("COPY INTO IMP FROM @%IMP FILE_FORMAT = (TYPE = JSON)")
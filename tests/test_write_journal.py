@@ -0,0 +1,103 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    wj = main.WriteJournal(str(tmp_path / "journal.sqlite"))
+    monkeypatch.setattr(main, "write_journal", wj)
+    return wj
+
+
+@pytest.fixture
+def appliers(monkeypatch):
+    """Records (kind, session_id) per applied entry; kinds listed in `failing` raise a data error."""
+    state = {"applied": [], "failing": set()}
+
+    def make(kind):
+        def apply(cur, p):
+            if kind in state["failing"]:
+                raise ValueError("bad data")
+            state["applied"].append((kind, p.get("session_id")))
+        return apply
+
+    for kind in ("session_start", "donor_upsert", "donor_consent", "signature"):
+        monkeypatch.setitem(main.JOURNAL_APPLIERS, kind, make(kind))
+    return state
+
+
+def _append_two_sessions(journal):
+    journal.append("session_start", "s1", {"session_id": "s1"})
+    journal.append("donor_upsert", "d1", {"session_id": "s1", "donor_id": "d1"})
+    journal.append("donor_consent", "d1", {"session_id": "s1", "donor_id": "d1"})
+    journal.append("session_start", "s2", {"session_id": "s2"})
+    journal.append("signature", "x", {"session_id": "s2", "donor_id": "d2"})
+
+
+def _retry_now(journal):
+    journal._db().execute("UPDATE JOURNAL SET NEXT_TRY_AT = 0")
+    journal._changed()
+
+
+def test_forwards_in_append_order(journal, appliers):
+    _append_two_sessions(journal)
+    assert journal.pending_count() == 5
+    assert main._journal_forward_once() == 5
+    assert appliers["applied"] == [("session_start", "s1"), ("donor_upsert", "s1"), ("donor_consent", "s1"),
+                                   ("session_start", "s2"), ("signature", "s2")]
+    assert journal.stats()["pending"] == 0
+
+
+def test_failed_entry_holds_back_only_its_streams(journal, appliers):
+    appliers["failing"].add("donor_upsert")
+    _append_two_sessions(journal)
+    main._journal_forward_once()
+    # The consent must not overtake the donor it updates; session s2 is unaffected
+    assert appliers["applied"] == [("session_start", "s1"), ("session_start", "s2"), ("signature", "s2")]
+    stats = journal.stats()
+    assert (stats["pending"], stats["held"], stats["dead"]) == (0, 2, 0)
+    assert journal.stream_blocked({"donor_id": "d1"})
+    assert journal.stream_blocked({"session_id": "s1"})
+    assert not journal.stream_blocked({"session_id": "s3", "donor_id": "d3"})
+    # Backing off: nothing is claimable yet, and new writes to the stream queue behind it
+    assert journal.claim(10) == []
+    assert main._should_journal({"session_id": "s1"})
+
+
+def test_parked_entry_replays_before_its_dependents(journal, appliers):
+    appliers["failing"].add("donor_upsert")
+    _append_two_sessions(journal)
+    main._journal_forward_once()
+    appliers["failing"].clear()
+    _retry_now(journal)
+    assert main._journal_forward_once() == 2
+    assert appliers["applied"][-2:] == [("donor_upsert", "s1"), ("donor_consent", "s1")]
+    assert journal.stats()["held"] == 0
+    assert not journal.stream_blocked({"donor_id": "d1"})
+
+
+def test_dead_entry_keeps_its_stream_blocked(journal, appliers, monkeypatch):
+    monkeypatch.setattr(main, "JOURNAL_MAX_ATTEMPTS", 1)
+    appliers["failing"].add("donor_upsert")
+    journal.append("donor_upsert", "d1", {"session_id": "s1", "donor_id": "d1"})
+    main._journal_forward_once()
+    appliers["failing"].clear()
+    journal.append("donor_consent", "d1", {"session_id": "s1", "donor_id": "d1"})
+    journal.append("session_start", "s2", {"session_id": "s2"})
+    _retry_now(journal)
+    main._journal_forward_once()
+    assert appliers["applied"] == [("session_start", "s2")]
+    assert journal.stats()["dead"] == 1
+    assert journal.stream_blocked({"donor_id": "d1"})
+
+
+def test_consent_for_missing_donor_is_not_marked_done(journal):
+    cur = main.get_snowflake_ctx().cursor()
+    payload = {"donor_id": "donor-missing", "session_id": "s1", "event_id": "evt-consent-1",
+               "consent_sms": True, "consent_email": False, "consent_mail": False}
+    with pytest.raises(main.JournalDependencyMissing):
+        main._apply_donor_consent(cur, payload)
+    journal.append("donor_consent", "donor-missing", payload)
+    main._journal_forward_once()
+    assert journal.stats()["held"] == 1